@@ -1,7 +1,7 @@
 import argparse
 import yaml
 
-def create_docker_compose(systemnames, cameras, registry=None, configname=None, image_version="latest"):
+def create_docker_compose(systemnames, cameras, registry=None, configname=None, image_version="latest", per_camera=False):
     services = {}
     network_name = "trol_network"
 
@@ -10,11 +10,14 @@ def create_docker_compose(systemnames, cameras, registry=None, configname=None,
         registry_string = f"{registry}/"
 
     
-    # Add camera services
-    for camera in cameras:
-        service_name = f"screenshot_{camera}"
+    # Add screenshot service(s).  One process handles every camera unless asked for the old one-per-camera layout.
+    if per_camera:
+        screenshot_commands = { f"screenshot_{camera}": f"--config config.yaml --camera_name {camera} --on_fail delayed" for camera in cameras }
+    else:
+        screenshot_commands = { "screenshot": "--config config.yaml --all-cameras --on_fail delayed" }
+    for service_name, command in screenshot_commands.items():
         services[service_name] = {
-            "command": f"--config config.yaml --camera_name {camera} --on_fail delayed",
+            "command": command,
             "image": f"{registry_string}trol2screenshot:{image_version}",
             "restart": "unless-stopped",
             "networks": [network_name]
@@ -59,7 +62,8 @@ def create_docker_compose(systemnames, cameras, registry=None, configname=None,
 def main():
     parser = argparse.ArgumentParser(description="Generate a docker-compose.yml file.")
     parser.add_argument("--registry", type=str, default=None, help="Registry name (e.g. registry.myorg.com)")
-    parser.add_argument("--cameras", type=str, help="Comma-separated list of cameras (e.g. zoom1,zoom2,4k1)")
+    parser.add_argument("--cameras", type=str, help="Comma-separated list of cameras (e.g. zoom1,zoom2,4k1), only used with --per-camera")
+    parser.add_argument("--per-camera", action="store_true", help="One screenshot service per camera instead of one for all of them")
     parser.add_argument("--configname", type=str, help="Optional Docker config system name for config.yaml")
     parser.add_argument("--imageversion", type=str, default='latest', help="Image version tag, defaults to 'latest'")
 
@@ -70,7 +74,7 @@ def main():
         cameras = []
     systemnames = ["obs", "newsrunner", "discord", "ptzhandler", "autocam"]
 
-    create_docker_compose(systemnames, cameras, registry=args.registry, configname=args.configname, image_version=args.imageversion)
+    create_docker_compose(systemnames, cameras, registry=args.registry, configname=args.configname, image_version=args.imageversion, per_camera=args.per_camera)
 
 if __name__ == "__main__":
     main()
@@ -9,7 +9,7 @@ from trol.shared.settings import get_settings
 # in trol doesn't cause a failure.
 KNOWN_CAMERA_KEYS = [
                 'type', 'address', 'rtspurl', 'jpgurl', 'audiourl', 'noaudio', 'ispublic', 'ishidden', 'nice_name', 'nothumb',
-                'failure_count', 'last_screenshot_timestamp', 'screenshot', 'error_message',
+                'failure_count', 'last_screenshot_timestamp', 'screenshot_interval', 'screenshot', 'error_message',
                 'prior_ptz_positions', 'known_ptz_positions', 'ptz_locked', 'ptz_arrived'
             ]
 
@@ -82,7 +82,7 @@ def main():
             raise Exception("Can't determine camera name from provided data.")
         cameras_data = {camera_name: cameras_data}
 
-    mqtt = MQTTConnectionManager(settings.mqtt.host, settings.mqtt.port, settings.mqtt.username, settings.mqtt.password)
+    mqtt = MQTTConnectionManager(settings.mqtt.host, settings.mqtt.port, settings.mqtt.username, settings.mqtt.password, topic_root=settings.mqtt_root)
     cameras = MQTTCameras(mqtt, f"{settings.mqtt_root}/cameras")
     # Initialize the cameras from MQTT:
     mqtt.process_initialization_callbacks()
@@ -96,16 +96,18 @@ def main():
             print(f"Deleted {camera_name}")
         else:
             camera = cameras.addOrGetByName(camera_name)
-            camera.type = camera_info.get('type', 'GENERIC')
-            camera.address = camera_info.get('address', '')
-            camera.rtspurl = camera_info.get('rtspurl', make_rtsp_url(camera.type, camera.address, settings.camera_user, settings.camera_pass))
-            camera.audiourl = camera_info.get('audiourl', make_audio_url(camera.type, camera.address, settings.camera_user, settings.camera_pass))
-            camera.jpgurl = camera_info.get('jpgurl', make_jpg_url(camera.type, camera.address, settings.camera_user, settings.camera_pass))
-            camera.noaudio = camera_info.get('noaudio', False)
-            camera.ispublic = camera_info.get('ispublic', False)
-            camera.ishidden = camera_info.get('ishidden', False)
-            camera.nice_name = camera_info.get('nice_name', None)
-            camera.nothumb = camera_info.get('nothumb', False)
+            with camera.batch():
+                camera.type = camera_info.get('type', 'GENERIC')
+                camera.address = camera_info.get('address', '')
+                camera.rtspurl = camera_info.get('rtspurl', make_rtsp_url(camera.type, camera.address, settings.camera_user, settings.camera_pass))
+                camera.audiourl = camera_info.get('audiourl', make_audio_url(camera.type, camera.address, settings.camera_user, settings.camera_pass))
+                camera.jpgurl = camera_info.get('jpgurl', make_jpg_url(camera.type, camera.address, settings.camera_user, settings.camera_pass))
+                camera.noaudio = camera_info.get('noaudio', False)
+                camera.ispublic = camera_info.get('ispublic', False)
+                camera.ishidden = camera_info.get('ishidden', False)
+                camera.nice_name = camera_info.get('nice_name', None)
+                camera.nothumb = camera_info.get('nothumb', False)
+                camera.screenshot_interval = camera_info.get('screenshot_interval', 0)
 
             print(f"Created {camera_name}")
 
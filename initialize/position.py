@@ -20,7 +20,7 @@ def main():
     position_data = get_settings("position")
     position_data.load_from_yaml_file(args.positionfile)
 
-    mqtt = MQTTConnectionManager(**settings.mqtt)
+    mqtt = MQTTConnectionManager(**settings.mqtt, topic_root=settings.mqtt_root)
     positions = MQTTPositions(mqtt, f"{settings.mqtt_root}/positions")
     # Initialize from MQTT:
     mqtt.process_initialization_callbacks()
@@ -35,11 +35,12 @@ def main():
         print(f"NOTE: Ignore any errors below regarding converting messages from MQTTVariable.")
     else:
         position = positions.addOrGetByName(position_data.name)
-        position.isaudio = position_data.get('isaudio', False)
-        position.nice_name = position_data.get('nice_name', None)
-        position.obs_item_default = position_data.get('obs_item_default', {})
-        position.locked_until = 0
-        position.lock_level = 'Discord user'
+        with position.batch():
+            position.isaudio = position_data.get('isaudio', False)
+            position.nice_name = position_data.get('nice_name', None)
+            position.obs_item_default = position_data.get('obs_item_default', {})
+            position.locked_until = 0
+            position.lock_level = 'Discord user'
         # Not set: active, requested, lock_level
         
         print(f"Created {position_data.name}")
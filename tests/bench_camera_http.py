@@ -0,0 +1,82 @@
+"""
+Snapshot requests to a digest-auth camera: requests.get with a new HTTPDigestAuth every time, as screenshot.py used
+to, vs CameraHTTP's pooled sessions and cached nonces.  Requests per second, p50/p99 latency, and how many
+connections and 401 challenges each took, against a local stub camera that answers after --delay ms.
+
+    python -m tests.bench_camera_http
+"""
+import argparse
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from requests.auth import HTTPDigestAuth
+
+from trol.shared.HTTP import CameraHTTP
+
+NONCE = 'f00dfeed'
+
+class DigestCamera(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    jpeg = os.urandom(200_000)
+    delay = 0
+    stats = {'connections': 0, 'challenges': 0}
+
+    def setup(self):
+        self.stats['connections'] += 1
+        super().setup()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        if f'nonce="{NONCE}"' not in self.headers.get('Authorization', ''):
+            self.stats['challenges'] += 1
+            self.send_response(401)
+            self.send_header('WWW-Authenticate', f'Digest realm="camera", nonce="{NONCE}", qop="auth", algorithm=MD5')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(self.jpeg)))
+        self.end_headers()
+        self.wfile.write(self.jpeg)
+
+def run(name, get, requests_count):
+    DigestCamera.stats.update(connections=0, challenges=0)
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(requests_count):
+        request_started = time.perf_counter()
+        response = get()
+        assert response.status_code == 200 and len(response.content) == len(DigestCamera.jpeg)
+        latencies.append(time.perf_counter() - request_started)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    print(f"{name:>11} {requests_count / elapsed:>7.0f} {latencies[len(latencies) // 2] * 1000:>8.2f} "
+          f"{latencies[int(len(latencies) * 0.99)] * 1000:>8.2f} {DigestCamera.stats['connections']:>12} "
+          f"{DigestCamera.stats['challenges']:>11}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Camera HTTP with digest auth, per-request vs pooled')
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--delay', type=float, default=5, help='Milliseconds the stub camera takes to answer')
+    args = parser.parse_args()
+
+    DigestCamera.delay = args.delay / 1000
+    server = ThreadingHTTPServer(('127.0.0.1', 0), DigestCamera)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/snapshot.jpg"
+    camera_http = CameraHTTP()
+
+    print(f"{'client':>11} {'req/s':>7} {'p50 ms':>8} {'p99 ms':>8} {'connections':>12} {'challenges':>11}")
+    run('per-request', lambda: requests.get(url, auth=HTTPDigestAuth('user', 'pass'), timeout=5), args.requests)
+    run('CameraHTTP', lambda: camera_http.get(url, 'user', 'pass', timeout=5), args.requests)
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
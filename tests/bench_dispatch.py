@@ -0,0 +1,49 @@
+"""
+Deliveries per second to subscription callbacks: working out each callback's arity with inspect.signature on every
+message, as _handle_message used to, vs MQTTSubscription's arity resolved once at subscribe time.
+
+    python -m tests.bench_dispatch
+"""
+import argparse
+import time
+from inspect import signature
+
+from trol.shared.MQTT import MQTTSubscription
+
+class Variable:
+    """ Stands in for MQTTVariable, whose bound _on_message is the most common callback. """
+    def _on_message(self, message):
+        pass
+
+def per_message(callback, payload, topic):
+    """ The old dispatch. """
+    if len(signature(callback).parameters) >= 2:
+        callback(payload, topic)
+    else:
+        callback(payload)
+
+def deliveries_per_second(deliver, seconds):
+    count = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        for _ in range(1000):
+            deliver('"value"', 'trol/cameras/a/nice_name')
+        count += 1000
+    return count / (time.perf_counter() - started)
+
+def main():
+    parser = argparse.ArgumentParser(description='Callback dispatch, per-message signature() vs cached arity')
+    parser.add_argument('--seconds', type=float, default=2, help='How long to run each case')
+    args = parser.parse_args()
+
+    callbacks = {'bound method': Variable()._on_message,
+                 'lambda (message)': lambda message: None,
+                 'lambda (message, topic)': lambda message, topic: None}
+    print(f"{'callback':>24} {'signature/s':>12} {'cached/s':>12}")
+    for name, callback in callbacks.items():
+        before = deliveries_per_second(lambda payload, topic: per_message(callback, payload, topic), args.seconds)
+        after = deliveries_per_second(MQTTSubscription('trol/cameras/a/nice_name', callback).deliver, args.seconds)
+        print(f"{name:>24} {before:>12,.0f} {after:>12,.0f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Startup of an MQTTCameras list, eager vs lazy, at 10, 100 and 1,000 cameras against a real broker: subscriptions made,
+time until every camera's retained attributes are in (reading two of them per camera, as the bot does), and how much
+resident memory that took.  Each case runs in its own process so its RSS is its own.  Gives up on a case after
+--timeout seconds; loaded says how many cameras it had by then.
+
+    python -m tests.bench_lazy_objects --host localhost --port 1883
+
+Publishes retained test cameras under --topic_root and clears them afterwards.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from trol.shared.MQTT import MQTTConnectionManager
+from trol.shared.MQTTCameras import MQTTCameras
+
+from tests.bench_startup import camera_topic, populate
+
+def rss_kb():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+def run_case(args, count, lazy):
+    before = rss_kb()
+    start = time.perf_counter()
+    mqtt = MQTTConnectionManager(args.host, args.port, client_id=f"bench-{os.getpid()}", topic_root=args.topic_root)
+    cameras = MQTTCameras(mqtt, camera_topic(args, count), lazy=lazy)
+    def loaded():
+        return sum(1 for name, camera in cameras.items() if camera.nice_name is not None and camera.ispublic is not None)
+    mqtt.process_initialization_callbacks(timeout=args.timeout)
+    # Mosquitto has sent every retained message by the time the barrier comes back; amqtt may not have.
+    while loaded() < count and time.perf_counter() - start < args.timeout:
+        mqtt.process_callbacks(timeout=0.1)
+    elapsed = time.perf_counter() - start
+    result = {'loaded': loaded(), 'subscriptions': len(mqtt.subscriptions), 'seconds': elapsed,
+              'rss_mb': (rss_kb() - before) / 1024}
+    mqtt.disconnect()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Time and memory for eager vs lazy MQTTCameras at startup')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--topic_root', default='trolbench')
+    parser.add_argument('--counts', default='10,100,1000', help='Comma-separated camera counts')
+    parser.add_argument('--timeout', type=float, default=300, help='Seconds to give each case')
+    parser.add_argument('--case', help=argparse.SUPPRESS)  # count,lazy: run one case in this process
+    args = parser.parse_args()
+
+    if args.case:
+        count, lazy = args.case.split(',')
+        print(json.dumps(run_case(args, int(count), lazy == 'lazy')))
+        return
+
+    print(f"{'cameras':>8} {'mode':>6} {'subscriptions':>14} {'startup s':>10} {'RSS MB':>8} {'loaded':>7}")
+    for count in [int(count) for count in args.counts.split(',')]:
+        populate(args, count)
+        for mode in ('eager', 'lazy'):
+            output = subprocess.run([sys.executable, '-m', 'tests.bench_lazy_objects', '--host', args.host,
+                                     '--port', str(args.port), '--topic_root', args.topic_root, '--timeout', str(args.timeout),
+                                     '--case', f"{count},{mode}"],
+                                    capture_output=True, text=True, check=True, timeout=args.timeout * 2).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{count:>8} {mode:>6} {result['subscriptions']:>14} {result['seconds']:>10.2f} {result['rss_mb']:>8.1f} {result['loaded']:>7}", flush=True)
+            time.sleep(2)  # Give the broker a moment to forget the last client's subscriptions
+        populate(args, count, clear=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Messages per second through MQTTConnectionManager (on_message to callback) with 50, 500 and 5,000 subscriptions,
+matching topics with MQTTTopicRouter vs the old scan of every subscription with topic_matches_sub.  No broker:
+messages are fed straight to the client's on_message.
+
+    python -m tests.bench_router
+"""
+import argparse
+import time
+from unittest import mock
+
+import paho.mqtt.client as paho
+
+from trol.shared.MQTT import MQTTConnectionManager
+
+def scan(mqtt, topic):
+    """ How _handle_message found subscriptions before the router. """
+    return [topic_filter for topic_filter in mqtt.subscriptions if paho.topic_matches_sub(topic_filter, topic)]
+
+def make_manager(subscription_count):
+    """ Cameras' attribute topics, as eager MQTTObjects subscribe them, plus one wildcard per camera. """
+    with mock.patch.object(paho.Client, 'connect'), mock.patch.object(paho.Client, 'loop_forever'), \
+         mock.patch.object(paho.Client, 'is_connected', return_value=False):
+        mqtt = MQTTConnectionManager(client_id='bench')
+    topics = []
+    camera = 0
+    while len(mqtt.subscriptions) < subscription_count:
+        mqtt.subscribe(f"trol/cameras/cam{camera}/+", lambda message: None, raw=True)
+        for attribute in range(9):
+            if len(mqtt.subscriptions) >= subscription_count:
+                break
+            topic = f"trol/cameras/cam{camera}/attribute{attribute}"
+            mqtt.subscribe(topic, lambda message: None)
+            topics.append(topic)
+        camera += 1
+    return mqtt, topics
+
+def messages_per_second(mqtt, topics, seconds):
+    messages = [paho.MQTTMessage(topic=topic.encode()) for topic in topics]
+    for message in messages:
+        message.payload = b'"value"'
+    sent = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        for message in messages[sent % len(messages):][:100]:
+            mqtt.client.on_message(mqtt.client, None, message)
+            sent += 1
+        mqtt.process_callbacks(timeout=0)
+    return sent / (time.perf_counter() - started)
+
+def main():
+    parser = argparse.ArgumentParser(description='MQTT dispatch throughput, topic router vs linear scan')
+    parser.add_argument('--counts', default='50,500,5000', help='Comma-separated subscription counts')
+    parser.add_argument('--seconds', type=float, default=2, help='How long to run each case')
+    args = parser.parse_args()
+
+    print(f"{'subscriptions':>14} {'scan msg/s':>12} {'router msg/s':>13}")
+    for count in [int(count) for count in args.counts.split(',')]:
+        mqtt, topics = make_manager(count)
+        with mock.patch.object(mqtt.router, 'match', lambda topic: scan(mqtt, topic)):
+            before = messages_per_second(mqtt, topics, args.seconds)
+        after = messages_per_second(mqtt, topics, args.seconds)
+        print(f"{count:>14} {before:>12,.0f} {after:>13,.0f}")
+
+if __name__ == '__main__':
+    main()
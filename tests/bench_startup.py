@@ -0,0 +1,93 @@
+"""
+Startup against a real broker: how long process_initialization_callbacks takes to return, with the barrier vs the
+old wait for 0.5s without a new topic, how many of the retained cameras it had loaded by then, and when the last of
+them was actually in.
+
+    python -m tests.bench_startup --host localhost --port 1883
+
+Publishes retained test cameras under --topic_root and clears them afterwards.
+"""
+import argparse
+import json
+import os
+import queue
+import time
+
+import paho.mqtt.client as paho
+
+from trol.shared.MQTT import MQTTConnectionManager
+from trol.shared.MQTTCameras import MQTTCameras, _CAMERA_ATTRIBUTES_
+
+SAMPLE_VALUES = {str: '"sample"', bool: 'true', int: '3', float: '0.25', dict: '{"interval": 5}', list: '[]'}
+SCREENSHOT = bytes(range(256)) * 40  # ~10kB, about what a thumbnail is, and not UTF-8
+
+def camera_topic(args, count):
+    return f"{args.topic_root}/{count}/cameras"
+
+def populate(args, count, clear=False):
+    client = paho.Client(f"bench-populate-{os.getpid()}")
+    client.connect(args.host, args.port)
+    client.loop_start()
+    topic = camera_topic(args, count)
+    names = [f"cam{index}" for index in range(count)]
+    infos = [client.publish(topic, '' if clear else json.dumps(names), qos=1, retain=True)]
+    for name in names:
+        for attribute, value_type in _CAMERA_ATTRIBUTES_:
+            infos.append(client.publish(f"{topic}/{name}/{attribute}", '' if clear else SAMPLE_VALUES[value_type], qos=1, retain=True))
+        infos.append(client.publish(f"{topic}/{name}/screenshot", '' if clear else SCREENSHOT, qos=1, retain=True))
+    for info in infos:
+        info.wait_for_publish()
+    client.loop_stop()
+    client.disconnect()
+
+def quiet_period(mqtt, timeout=0.5):
+    """ process_initialization_callbacks as it was: go until timeout passes without a message on a new topic. """
+    received_topics = set()
+    start_time = time.time()
+    while time.time() - start_time < timeout:
+        try:
+            item = mqtt._next_dispatch_item(timeout=0.1)
+            item['callback']()
+            if 'topic' in item and item['topic'] not in received_topics:
+                received_topics.add(item['topic'])
+                start_time = time.time()
+            mqtt.main_thread_dispatch_queue.task_done()
+        except queue.Empty:
+            pass
+
+def run_case(args, count, initialize):
+    start = time.perf_counter()
+    mqtt = MQTTConnectionManager(args.host, args.port, client_id=f"bench-{os.getpid()}", topic_root=args.topic_root)
+    cameras = MQTTCameras(mqtt, camera_topic(args, count))
+    def loaded():
+        return sum(1 for name, camera in cameras.items()
+                   if all(getattr(camera, attribute) is not None for attribute, _ in _CAMERA_ATTRIBUTES_))
+    initialize(mqtt)
+    returned, loaded_then = time.perf_counter() - start, loaded()
+    while loaded() < count and time.perf_counter() - start < args.timeout:
+        mqtt.process_callbacks(timeout=0.1)
+    all_in = time.perf_counter() - start
+    mqtt.disconnect()
+    return returned, loaded_then, all_in
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup time, initialization barrier vs quiet period')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--topic_root', default='trolbench')
+    parser.add_argument('--counts', default='10,100,500', help='Comma-separated camera counts')
+    parser.add_argument('--timeout', type=float, default=300, help='Seconds to wait for every camera')
+    args = parser.parse_args()
+
+    cases = {'quiet 0.5s': quiet_period, 'barrier': lambda mqtt: mqtt.process_initialization_callbacks()}
+    print(f"{'cameras':>8} {'method':>11} {'returned s':>11} {'loaded':>7} {'all in s':>9}")
+    for count in [int(count) for count in args.counts.split(',')]:
+        populate(args, count)
+        for name, initialize in cases.items():
+            returned, loaded, all_in = run_case(args, count, initialize)
+            print(f"{count:>8} {name:>11} {returned:>11.2f} {loaded:>7} {all_in:>9.2f}", flush=True)
+            time.sleep(2)  # Give the broker a moment to forget the last client's subscriptions
+        populate(args, count, clear=True)
+
+if __name__ == '__main__':
+    main()
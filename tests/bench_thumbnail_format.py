@@ -0,0 +1,64 @@
+"""
+Thumbnails as base64 data URIs vs raw JPEG bytes: what each costs the broker in bytes per camera per minute, and the
+bot in CPU to get JPEG bytes back out of a payload (thumbnail_to_jpeg, as delivered with raw=True).
+
+    python -m tests.bench_thumbnail_format --interval 5
+"""
+import argparse
+import io
+import time
+
+import numpy as np
+from PIL import Image
+
+from trol.shared.Thumbnails import encode_thumbnail, thumbnail_to_jpeg
+
+def camera_frame(width=1920, height=1080, seed=0):
+    """ Something JPEG-ish to compress: smooth shapes plus sensor noise, rather than a flat colour. """
+    rng = np.random.default_rng(seed)
+    coarse = rng.integers(0, 256, (height // 60, width // 60, 3), dtype=np.uint8)
+    image = Image.fromarray(coarse, 'RGB').resize((width, height), Image.BICUBIC)
+    noise = rng.integers(-8, 8, (height, width, 3))
+    pixels = np.clip(np.asarray(image, dtype=np.int16) + noise, 0, 255).astype(np.uint8)
+    data = io.BytesIO()
+    Image.fromarray(pixels, 'RGB').save(data, format='JPEG', quality=85)
+    return data.getvalue()
+
+def thumbnail(frame, width, height):
+    """ As process_screenshot makes them. """
+    data = io.BytesIO()
+    Image.open(io.BytesIO(frame)).resize([width, height]).save(data, format='JPEG')
+    return data.getvalue()
+
+def microseconds_per_call(func, seconds=1):
+    count = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        for _ in range(100):
+            func()
+        count += 100
+    return (time.perf_counter() - started) / count * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description='Thumbnail payload size and decode cost, data_uri vs binary')
+    parser.add_argument('--interval', type=float, default=5, help='Seconds between screenshots of a camera')
+    parser.add_argument('--width', type=int, default=240)
+    parser.add_argument('--height', type=int, default=135)
+    parser.add_argument('--topic', default='trol/cameras/somecamera/screenshot', help='For the per-message overhead')
+    args = parser.parse_args()
+
+    jpeg = thumbnail(camera_frame(), args.width, args.height)
+    per_minute = 60 / args.interval
+    # PUBLISH fixed header (up to 5 bytes), topic length, topic and packet id; screenshots go out at QoS 1.
+    overhead = 5 + 2 + len(args.topic) + 2
+    print(f"{'format':>9} {'bytes/frame':>12} {'kB/camera/min':>14} {'decode us':>10} {'CPU ms/camera/min':>18}")
+    for thumbnail_format in ('data_uri', 'binary'):
+        payload = encode_thumbnail(jpeg, thumbnail_format)
+        delivered = payload.encode('utf-8') if isinstance(payload, str) else payload
+        assert thumbnail_to_jpeg(delivered) == jpeg
+        decode = microseconds_per_call(lambda: thumbnail_to_jpeg(delivered))
+        print(f"{thumbnail_format:>9} {len(delivered):>12,} {(len(delivered) + overhead) * per_minute / 1000:>14.1f} "
+              f"{decode:>10.2f} {decode * per_minute / 1000:>18.4f}")
+
+if __name__ == '__main__':
+    main()
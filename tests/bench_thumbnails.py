@@ -0,0 +1,84 @@
+"""
+Making 240x135 thumbnails from 1080p and 4K camera JPEGs: decoding the whole image and resizing it, as
+process_screenshot used to, vs make_thumbnail's draft-mode pipeline.  Milliseconds per thumbnail and the peak
+resident memory it took, each case in its own process so its peak is its own.
+
+    python -m tests.bench_thumbnails
+"""
+import argparse
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+from trol.shared.Thumbnails import make_thumbnail
+
+from tests.bench_thumbnail_format import camera_frame
+
+RESOLUTIONS = {'1080p': (1920, 1080), '4K': (3840, 2160)}
+
+def full_decode(image_data, width=240, height=135):
+    """ process_screenshot as it was. """
+    image = Image.open(io.BytesIO(image_data))
+    resized_image = image.resize([width, height])
+    thumbIO = io.BytesIO()
+    resized_image.save(thumbIO, format='JPEG')
+    return thumbIO.getvalue()
+
+METHODS = {'full decode': full_decode, 'make_thumbnail': make_thumbnail}
+
+def peak_rss_kb():
+    # Not getrusage's ru_maxrss, which carries over from the parent process across exec.
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+
+def run_case(method, frame_files, repeat):
+    frames = []
+    for frame_file in frame_files:
+        with open(frame_file, 'rb') as frame:
+            frames.append(frame.read())
+    before = peak_rss_kb()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for frame in frames:
+            METHODS[method](frame)
+    elapsed = time.perf_counter() - started
+    return {'ms': elapsed / (repeat * len(frames)) * 1000,
+            'peak_mb': (peak_rss_kb() - before) / 1024}
+
+def main():
+    parser = argparse.ArgumentParser(description='Thumbnail time and peak memory, full decode vs make_thumbnail')
+    parser.add_argument('--repeat', type=int, default=5, help='Passes over the four test frames')
+    parser.add_argument('--case', help=argparse.SUPPRESS)  # method,frame files...: run one case in this process
+    args = parser.parse_args()
+
+    if args.case:
+        method, *frame_files = args.case.split(',')
+        print(json.dumps(run_case(method, frame_files, args.repeat)))
+        return
+
+    print(f"{'resolution':>10} {'method':>15} {'ms/thumbnail':>13} {'peak MB':>8}")
+    with tempfile.TemporaryDirectory() as frame_dir:
+        for resolution, size in RESOLUTIONS.items():
+            # Made here, so the cases' peaks are from thumbnailing rather than making test frames.
+            frame_files = []
+            for seed in range(4):
+                frame_files.append(os.path.join(frame_dir, f"{resolution}-{seed}.jpg"))
+                with open(frame_files[-1], 'wb') as frame:
+                    frame.write(camera_frame(*size, seed=seed))
+            for method in METHODS:
+                output = subprocess.run([sys.executable, '-m', 'tests.bench_thumbnails', '--repeat', str(args.repeat),
+                                         '--case', ','.join([method] + frame_files)],
+                                        capture_output=True, text=True, check=True).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                print(f"{resolution:>10} {method:>15} {result['ms']:>13.1f} {result['peak_mb']:>8.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+A pretend ONVIF camera on localhost for tests: just enough SOAP for onvif-zeep to set up a session, move to presets
+and coords, and hand out a snapshot URI, counting the calls it gets.  Moves are instant and there are no events.
+"""
+import io
+import re
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+NAMESPACES = ('xmlns:s="http://www.w3.org/2003/05/soap-envelope" xmlns:tds="http://www.onvif.org/ver10/device/wsdl" '
+              'xmlns:trt="http://www.onvif.org/ver10/media/wsdl" xmlns:tptz="http://www.onvif.org/ver20/ptz/wsdl" '
+              'xmlns:tt="http://www.onvif.org/ver10/schema"')
+
+def make_jpeg():
+    data = io.BytesIO()
+    Image.new('RGB', (640, 360), 'blue').save(data, 'JPEG')
+    return data.getvalue()
+
+class StubCamera:
+    """ start() it, point ONVIFCamera at 127.0.0.1:port, and look at calls: {SOAP action or 'GET path': count}. """
+    def __init__(self, presets=None):
+        self.calls = Counter()
+        self.position = (0.0, 0.0, 0.0)
+        self.presets = dict(presets or {'1': (0.5, 0.5, 0.1), '2': (-0.5, 0.2, 0.0)})  # token: coords
+        self.jpeg = make_jpeg()
+        self.lock = threading.Lock()
+        self.server = None
+
+    @property
+    def port(self):
+        return self.server.server_port
+
+    def start(self):
+        camera = self
+        class Handler(StubHandler):
+            stub = camera
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def soap_calls(self):
+        """ How many SOAP calls of any kind it's had. """
+        return sum(count for call, count in self.calls.items() if not call.startswith('GET '))
+
+    def respond(self, action, body):
+        base = f"http://127.0.0.1:{self.port}"
+        with self.lock:
+            if action == 'AbsoluteMove':
+                self.position = tuple(float(value) for value in re.findall(r'\b[xy]="([-\d.e]+)"', body)[:3])
+            elif action == 'GotoPreset':
+                self.position = self.presets[re.search(r'PresetToken>([^<]+)<', body).group(1)]
+            elif action == 'SetPreset':
+                token = str(len(self.presets) + 1)
+                self.presets[token] = self.position
+            x, y, z = self.position
+            presets = ''.join(f'<tptz:Preset token="{preset_token}"><tt:Name>p{preset_token}</tt:Name><tt:PTZPosition>'
+                              f'<tt:PanTilt x="{px}" y="{py}"/><tt:Zoom x="{pz}"/></tt:PTZPosition></tptz:Preset>'
+                              for preset_token, (px, py, pz) in self.presets.items())
+        if action == 'GetCapabilities':
+            return (f'<tds:GetCapabilitiesResponse><tds:Capabilities>'
+                    f'<tt:Device><tt:XAddr>{base}/onvif/device_service</tt:XAddr></tt:Device>'
+                    f'<tt:Media><tt:XAddr>{base}/onvif/media</tt:XAddr><tt:StreamingCapabilities>'
+                    f'<tt:RTPMulticast>false</tt:RTPMulticast><tt:RTP_TCP>true</tt:RTP_TCP><tt:RTP_RTSP_TCP>true</tt:RTP_RTSP_TCP>'
+                    f'</tt:StreamingCapabilities></tt:Media>'
+                    f'<tt:PTZ><tt:XAddr>{base}/onvif/ptz</tt:XAddr></tt:PTZ>'
+                    f'</tds:Capabilities></tds:GetCapabilitiesResponse>')
+        if action == 'GetProfiles':
+            return '<trt:GetProfilesResponse><trt:Profiles token="prof0" fixed="true"><tt:Name>main</tt:Name></trt:Profiles></trt:GetProfilesResponse>'
+        if action == 'GetStatus':
+            return (f'<tptz:GetStatusResponse><tptz:PTZStatus><tt:Position><tt:PanTilt x="{x}" y="{y}"/><tt:Zoom x="{z}"/></tt:Position>'
+                    f'<tt:MoveStatus><tt:PanTilt>IDLE</tt:PanTilt><tt:Zoom>IDLE</tt:Zoom></tt:MoveStatus>'
+                    f'<tt:UtcTime>2024-01-01T00:00:00Z</tt:UtcTime></tptz:PTZStatus></tptz:GetStatusResponse>')
+        if action == 'GetPresets':
+            return f'<tptz:GetPresetsResponse>{presets}</tptz:GetPresetsResponse>'
+        if action == 'SetPreset':
+            return f'<tptz:SetPresetResponse><tptz:PresetToken>{token}</tptz:PresetToken></tptz:SetPresetResponse>'
+        if action == 'GetSnapshotUri':
+            return (f'<trt:GetSnapshotUriResponse><trt:MediaUri><tt:Uri>{base}/snapshot.jpg</tt:Uri>'
+                    f'<tt:InvalidAfterConnect>false</tt:InvalidAfterConnect><tt:InvalidAfterReboot>false</tt:InvalidAfterReboot>'
+                    f'<tt:Timeout>PT0S</tt:Timeout></trt:MediaUri></trt:GetSnapshotUriResponse>')
+        return f'<tptz:{action}Response/>'
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    stub = None
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, content_type, data):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.stub.calls[f"GET {self.path}"] += 1
+        self.send('image/jpeg', self.stub.jpeg)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        action = re.search(r'<(?:[\w-]+:)?Body[^>]*>\s*<(?:[\w-]+:)?(\w+)', body).group(1)
+        self.stub.calls[action] += 1
+        envelope = f'<?xml version="1.0" encoding="UTF-8"?><s:Envelope {NAMESPACES}><s:Body>{self.stub.respond(action, body)}</s:Body></s:Envelope>'
+        self.send('application/soap+xml; charset=utf-8', envelope.encode())
@@ -0,0 +1,46 @@
+import unittest
+from unittest import mock
+
+import paho.mqtt.client as paho
+
+from trol.shared.MQTT import MQTTConnectionManager
+
+def message(topic, payload):
+    msg = paho.MQTTMessage(topic=topic.encode())
+    msg.payload = payload.encode()
+    return msg
+
+class TestCoalescing(unittest.TestCase):
+    def setUp(self):
+        # No broker: messages are fed straight to the client's on_message.
+        patches = [mock.patch.object(paho.Client, 'connect'), mock.patch.object(paho.Client, 'loop_forever'),
+                   mock.patch.object(paho.Client, 'is_connected', return_value=False)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.mqtt = MQTTConnectionManager(client_id='test')
+        self.received = []
+
+    def receive(self, *messages):
+        for msg in messages:
+            self.mqtt.client.on_message(self.mqtt.client, None, msg)
+        self.mqtt.process_callbacks(timeout=0)
+
+    def test_only_newest_delivered(self):
+        self.mqtt.subscribe('trol/cameras/a/x', lambda m, t: self.received.append((t, m)), coalesce=True)
+        self.receive(message('trol/cameras/a/x', '1'), message('trol/cameras/a/x', '2'))
+        self.assertEqual(self.received, [('trol/cameras/a/x', '2')])
+        self.assertEqual(self.mqtt.get_dispatch_stats()['coalesced'], 1)
+
+    def test_newest_not_delivered_ahead_of_earlier_messages(self):
+        record = lambda m, t: self.received.append((t, m))
+        self.mqtt.subscribe('trol/cameras/a/x', record, coalesce=True)
+        self.mqtt.subscribe('trol/cameras/a/batch', record)
+        self.receive(message('trol/cameras/a/x', '0'),
+                     message('trol/cameras/a/batch', '{"attributes": {"x": "1"}}'),
+                     message('trol/cameras/a/x', '1'),
+                     message('trol/cameras/a/x', '2'))
+        self.assertEqual(self.received, [('trol/cameras/a/batch', '{"attributes": {"x": "1"}}'), ('trol/cameras/a/x', '2')])
+
+if __name__ == '__main__':
+    unittest.main()
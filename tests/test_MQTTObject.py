@@ -0,0 +1,63 @@
+import unittest
+from unittest import mock
+
+import paho.mqtt.client as paho
+
+from trol.shared.MQTT import MQTTConnectionManager
+from trol.shared.MQTTCameras import MQTTCamera, MQTTCameras
+
+def message(topic, payload):
+    msg = paho.MQTTMessage(topic=topic.encode())
+    msg.payload = payload
+    return msg
+
+class ManagerTestCase(unittest.TestCase):
+    def setUp(self):
+        # No broker: messages are fed straight to the client's on_message.
+        patches = [mock.patch.object(paho.Client, 'connect'), mock.patch.object(paho.Client, 'loop_forever'),
+                   mock.patch.object(paho.Client, 'is_connected', return_value=False)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.mqtt = MQTTConnectionManager(client_id='test')
+
+    def receive(self, *messages):
+        for msg in messages:
+            self.mqtt.client.on_message(self.mqtt.client, None, msg)
+        self.mqtt.process_callbacks(timeout=0)
+
+class TestLazyObject(ManagerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.camera = MQTTCamera(self.mqtt, 'trol/cameras/a', 'a', lazy=True)
+
+    def test_one_wildcard_subscription(self):
+        self.assertEqual(set(self.mqtt.subscriptions), {'trol/cameras/a/+', 'trol/cameras/a/batch'})
+
+    def test_other_topics_are_ignored_undecoded(self):
+        self.receive(message('trol/cameras/a/screenshot', b'\xff\xd8\xff\xe0 not utf-8 \xff'))
+        self.assertEqual(self.camera._raw_payloads, {})
+
+    def test_unused_attribute_is_not_parsed_until_read(self):
+        self.receive(message('trol/cameras/a/failure_count', b'3'))
+        self.assertNotIn('failure_count', self.camera._mqtt_attributes)
+        self.assertEqual(self.camera.failure_count, 3)
+
+    def test_on_demand_attribute_dropped_until_used(self):
+        self.receive(message('trol/cameras/a/ptz_arrived', b'{"position": "window"}'))
+        self.assertNotIn('ptz_arrived', self.camera._raw_payloads)
+        arrivals = []
+        self.camera.add_callback('ptz_arrived', lambda: arrivals.append(self.camera.ptz_arrived))
+        self.receive(message('trol/cameras/a/ptz_arrived', b'{"position": "door"}'))
+        self.assertEqual(arrivals, [{'position': 'door'}])
+
+class TestObjectList(ManagerTestCase):
+    def test_removed_objects_unsubscribe(self):
+        cameras = MQTTCameras(self.mqtt, 'trol/cameras', lazy=True)
+        camera = cameras.addOrGetByName('b')
+        camera.nice_name = 'Bee'
+        cameras.delByName('b')
+        self.assertEqual([topic for topic in self.mqtt.subscriptions if topic.startswith('trol/cameras/b/')], [])
+
+if __name__ == '__main__':
+    unittest.main()
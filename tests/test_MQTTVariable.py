@@ -0,0 +1,78 @@
+import unittest
+
+from trol.shared.MQTTVariable import MQTTVariable
+
+class FakeManager:
+    """ Just enough of MQTTConnectionManager: records publishes and runs call_later callbacks when told to. """
+    def __init__(self):
+        self.published = []
+        self.later = []
+        self.publish_saved_count = 0
+
+    def count_saved_publish(self):
+        self.publish_saved_count += 1
+
+    def subscribe(self, topic, callback, coalesce=False, raw=False):
+        pass
+
+    def unsubscribe(self, topic, callback):
+        pass
+
+    def publish(self, topic, payload, qos=1, retain=True):
+        self.published.append(payload)
+
+    def call_later(self, delay, callback):
+        self.later.append(callback)
+
+    def run_later(self):
+        later, self.later = self.later, []
+        for callback in later:
+            callback()
+
+class TestMQTTVariable(unittest.TestCase):
+    def setUp(self):
+        self.mqtt = FakeManager()
+        self.undo = MQTTVariable(self.mqtt, 'trol/test/undo', list, initial_value=[])
+
+    def test_in_place_edits_publish_once(self):
+        self.undo.value.append(1)
+        self.undo.value.append(2)
+        self.mqtt.run_later()
+        self.assertEqual(self.mqtt.published, ['[1, 2]'])
+
+    def test_echo_before_pending_publish_keeps_edit(self):
+        self.undo.value.append(1)
+        self.mqtt.run_later()
+        self.undo.value.append(2)
+        # The echo of our first publish arrives before the second goes out.
+        self.undo._on_message('[1]')
+        self.assertEqual(self.undo.value, [1, 2])
+        self.mqtt.run_later()
+        self.assertEqual(self.mqtt.published, ['[1]', '[1, 2]'])
+        self.undo._on_message('[1, 2]')
+        self.assertEqual(self.undo.value, [1, 2])
+
+    def test_remote_change_wins_over_pending_edit(self):
+        changes = []
+        self.undo.add_callback(lambda: changes.append(self.undo.value))
+        self.undo.value = [1]
+        self.undo.value.append(2)
+        self.undo._on_message('[7]')
+        self.assertEqual(self.undo.value, [7])
+        self.assertEqual(changes, [[7]])
+        self.mqtt.run_later()
+        self.assertEqual(self.mqtt.published, ['[1]'])
+
+    def test_force_publish_repeats_value(self):
+        self.undo.value = [1]
+        self.undo.force_publish()
+        self.assertEqual(self.mqtt.published, ['[1]', '[1]'])
+
+    def test_incoming_message_replaces_published_value(self):
+        self.undo.value = [1]
+        self.undo._on_message('[3]')
+        self.assertEqual(self.undo.value, [3])
+        self.assertFalse(self.undo.is_unpublished())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import asyncio
+import time
+import unittest
+
+from trol.shared.ThumbnailHistory import ThumbnailHistory, ThumbnailHistoryClient
+
+JPEG = b'\xff\xd8\xff\xe0 a thumbnail'
+
+class LoopbackManager:
+    """ Just enough of MQTTConnectionManager: publishes go straight to whoever subscribed to the topic. """
+    def __init__(self):
+        self.subscriptions = {}
+
+    def subscribe(self, topic, callback, coalesce=False, raw=False):
+        self.subscriptions[topic] = callback
+
+    def publish(self, topic, payload, qos=1, retain=True):
+        if topic in self.subscriptions:
+            self.subscriptions[topic](payload)
+
+class TestThumbnailHistory(unittest.TestCase):
+    def setUp(self):
+        self.mqtt = LoopbackManager()
+        self.history = ThumbnailHistory(self.mqtt, 'trol/thumbnail_history', frames=3)
+        self.client = ThumbnailHistoryClient(self.mqtt, 'trol/thumbnail_history')
+
+    def fetch(self, camera_names, timeout=3):
+        started = time.monotonic()
+        result = asyncio.run(self.client.fetch(camera_names, frames=2, timeout=timeout))
+        return result, time.monotonic() - started
+
+    def test_frames_oldest_first(self):
+        for index in range(4):
+            self.history.add('a', JPEG + bytes([index]), timestamp=index)
+        result, _ = self.fetch(['a'])
+        self.assertEqual(result, {'a': [JPEG + b'\x02', JPEG + b'\x03']})
+
+    def test_camera_without_thumbnails_answered_straight_away(self):
+        self.history.add('a', JPEG)
+        self.history.add_camera('b')
+        result, elapsed = self.fetch(['a', 'b'])
+        self.assertEqual(result, {'a': [JPEG], 'b': []})
+        self.assertLess(elapsed, 1)
+
+    def test_bad_reply_ignored(self):
+        self.client._on_reply('not json')
+        self.client._on_reply('[]')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import threading
+import unittest
+from io import BytesIO
+from unittest import mock
+
+from PIL import Image
+
+from trol.discord.grids import GridCache
+
+def thumbnail(color):
+    bytes_io = BytesIO()
+    Image.new('RGB', (64, 36), color).save(bytes_io, format='JPEG')
+    return bytes_io.getvalue()
+
+class TestGridCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = GridCache()
+        self.labels = ['a', 'b']
+
+    def test_rendered_grid_is_cached(self):
+        data = self.cache.render('key', self.labels, [[thumbnail('red')], [thumbnail('blue')]])
+        self.assertEqual(self.cache.get('key', max_age=60), data)
+        self.assertIsNone(self.cache.get('key', max_age=-1))
+
+    def test_gif_with_one_frame_each_is_still_a_gif(self):
+        # e.g. when the thumbnail history doesn't answer and every camera has just its latest thumbnail.
+        data = self.cache.render('key', self.labels, [[thumbnail('red')], [thumbnail('blue')]], extension='GIF')
+        self.assertEqual(data[:3], b'GIF')
+        self.assertEqual(Image.open(BytesIO(data)).format, 'GIF')
+
+    def test_lookups_do_not_wait_for_rendering(self):
+        encoding, release = threading.Event(), threading.Event()
+        encode = GridCache._encode
+        def slow_encode(*args):
+            encoding.set()
+            release.wait(5)
+            return encode(*args)
+        with mock.patch.object(GridCache, '_encode', side_effect=slow_encode):
+            render = threading.Thread(target=self.cache.render, args=('key', self.labels, [[thumbnail('red')], [thumbnail('blue')]]))
+            render.start()
+            self.assertTrue(encoding.wait(5))
+            try:
+                # Would block until release if render held the cache's lock while encoding.
+                self.assertTrue(self.cache.lock.acquire(timeout=1))
+                self.cache.lock.release()
+                self.assertIsNone(self.cache.get('key', max_age=60))
+                self.assertEqual(self.cache.recent_keys(60), ['key'])
+            finally:
+                release.set()
+                render.join()
+        self.assertIsNotNone(self.cache.get('key', max_age=60))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,13 @@
 import argparse
 import threading
 import time
+from collections import defaultdict
+from datetime import timedelta
+from functools import partial
 from onvif import ONVIFCamera
-import requests
-from requests.auth import HTTPDigestAuth
+from onvif.exceptions import ONVIFError
+from zeep.exceptions import Fault, TransportError, XMLSyntaxError
+from trol.shared.HTTP import get_camera_http
 
 from trol.shared.logger import setup_logger, is_debug
 log = setup_logger(__name__)
@@ -23,57 +27,330 @@ def decode_position(ptzposition):
 def encode_position(coords):
     return {'PanTilt': {'x': coords[0], 'y': coords[1]}, 'Zoom': {'x': coords[2]}}
 
+# What talking to a camera raises when the camera or the connection to it is at fault, as opposed to us.
+# (requests' errors and socket timeouts are OSErrors.)
+SESSION_ERRORS = (ONVIFError, Fault, TransportError, XMLSyntaxError, OSError)
+
 
 # TODO: refactor all the thing.
 def get_service_and_token(camera_ip, port, username, password):
     camera = ONVIFCamera(camera_ip, port, username, password)
+    return get_camera_service_and_token(camera)
+
+def get_camera_service_and_token(camera):
     ptz_service = camera.create_ptz_service()
     media_service = camera.create_media_service()
     profiles = media_service.GetProfiles()
     token = profiles[0].token
     return ptz_service, media_service, profiles, token
 
+EVENTS_NAMESPACE = 'http://www.onvif.org/ver10/events/wsdl'
+PULLPOINT_NAMESPACE = 'http://www.onvif.org/ver10/events/wsdl/PullPointSubscription'
+SUBSCRIPTION_MANAGER_BINDING = '{http://www.onvif.org/ver10/events/wsdl}SubscriptionManagerBinding'
+
+class PTZEvents:
+    """
+    A PullPoint subscription to a camera's events, so waiting on a move can wake up when the camera says something
+    about PTZ instead of sleeping out the whole interval.  Which events a camera sends for PTZ, if any, varies, so any
+    topic mentioning PTZ only counts as a hint to check GetStatus; the subscription is renewed by recreating it.
+
+    Safe to wait() on from several threads, but they take turns: the subscription and the zeep client under it are
+    only good for one call at a time.  close() unsubscribes.
+    """
+    def __init__(self, camera, lifetime: float = 600):
+        self.camera = camera
+        self.lifetime = lifetime
+        self.pullpoint = None
+        self.manager = None  # for Unsubscribe, at the same address as pullpoint
+        self.expires = 0
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def _subscribe(self):
+        self._unsubscribe()
+        events = self.camera.create_events_service()
+        subscription = events.CreatePullPointSubscription({'InitialTerminationTime': timedelta(seconds=self.lifetime)})
+        address = subscription.SubscriptionReference.Address._value_1
+        self.camera.xaddrs[PULLPOINT_NAMESPACE] = address
+        self.pullpoint = self.camera.create_pullpoint_service()
+        self.manager = self.pullpoint.zeep_client.create_service(SUBSCRIPTION_MANAGER_BINDING, address)
+        self.expires = time.monotonic() + self.lifetime * 0.9
+
+    def _unsubscribe(self):
+        if self.manager is None:
+            return
+        try:
+            self.manager.Unsubscribe()
+        except Exception as e:
+            log.debug(f"Couldn't unsubscribe from {self.camera.host} events, leaving it to expire: {e}")
+        self.pullpoint = self.manager = None
+
+    def wait(self, timeout: float) -> bool:
+        """ Wait up to timeout seconds for a PTZ event; True if one came. """
+        deadline = time.monotonic() + timeout
+        if not self.lock.acquire(timeout=timeout):
+            return False
+        try:
+            if self.closed:
+                return False
+            if self.pullpoint is None or time.monotonic() > self.expires:
+                self._subscribe()
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                messages = self.pullpoint.PullMessages({'Timeout': timedelta(seconds=remaining), 'MessageLimit': 32})
+                topics = [str(getattr(message.Topic, '_value_1', '')) for message in messages.NotificationMessage or []]
+                if not topics:
+                    return False
+                if any('PTZ' in topic for topic in topics):
+                    return True
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """ Unsubscribe, once any PullMessages in progress is done.  wait() returns straight away from then on. """
+        with self.lock:
+            self.closed = True
+            self._unsubscribe()
+
+class ONVIFSession:
+    """
+    Everything needed to talk to one camera, set up once.  Creating an ONVIFCamera and its services means fetching
+    and parsing WSDLs plus several SOAP round trips (GetCapabilities, GetProfiles...), so it's worth keeping.
+    """
+    def __init__(self, host: str, port: int, username: str, password: str):
+        self.credentials = (host, port, username, password)
+        self.camera = ONVIFCamera(host, port, username, password)
+        self.ptz_service, self.media_service, self.profiles, self.token = get_camera_service_and_token(self.camera)
+        self._snapshot_uri = None
+        # None until the first wait(); False if the camera has no events or they stopped working.
+        self._events = None if EVENTS_NAMESPACE in self.camera.xaddrs else False
+        self._events_lock = threading.Lock()
+        self._presets = None
+        self._presets_lock = threading.Lock()
+
+    def presets(self) -> 'PresetIndex':
+        """ The camera's presets, fetched the first time they're wanted. """
+        with self._presets_lock:
+            if self._presets is None:
+                self._presets = PresetIndex(self.ptz_service, self.token)
+            return self._presets
+
+    def store_preset(self, preset_name: str):
+        """ Save where the camera is now as a preset, returning its token. """
+        return store_current_position_as_preset(self.ptz_service, self.token, preset_name, self.presets())
+
+    def wait(self, timeout: float):
+        """ Sleep for timeout seconds, or less if the camera sends a PTZ event.  For poll_position_until_complete. """
+        with self._events_lock:
+            if self._events is None:
+                self._events = PTZEvents(self.camera)
+            events = self._events
+        if events is not False:
+            try:
+                events.wait(timeout)
+                return
+            except Exception as e:
+                log.info(f"PullPoint events not working for {self.credentials[0]}, polling only: {e}")
+                with self._events_lock:
+                    self._events = False
+                events.close()
+        time.sleep(timeout)
+
+    def close(self):
+        """ Let go of anything the camera is keeping for us, i.e. our events subscription. """
+        with self._events_lock:
+            events, self._events = self._events, False
+        if events:
+            events.close()
+
+    def snapshot_uri(self):
+        if self._snapshot_uri is None:
+            self._snapshot_uri = get_snapshot_url(self.media_service, self.token)
+        return self._snapshot_uri
+
+    def screenshot(self, timeout: float = 10):
+        host, port, username, password = self.credentials
+        response = get_camera_http().get(self.snapshot_uri(), username, password, timeout=timeout)
+        if response.status_code != 200:
+            raise Exception(f"Request for screenshot {host} returned {response}")
+        return response.content
+
+class ONVIFSessionCache:
+    """
+    ONVIFSessions by camera name.  get() sets one up the first time, or again if the camera's address or credentials
+    have changed; call failed() when a call raises, so the next get() reconnects if the camera was at fault.  Safe to use from several
+    threads, and two threads asking for the same new camera only set it up once.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.camera_locks = defaultdict(threading.Lock)
+
+    def get(self, camera_name: str, host: str, port: int, username: str, password: str) -> ONVIFSession:
+        credentials = (host, port, username, password)
+        with self.lock:
+            camera_lock = self.camera_locks[camera_name]
+        with camera_lock:
+            session = old_session = self.sessions.get(camera_name)
+            if session is None or session.credentials != credentials:
+                log.debug(f"Setting up ONVIF session for {camera_name} at {host}:{port}")
+                session = self.sessions[camera_name] = ONVIFSession(*credentials)
+        if old_session is not None and old_session is not session:
+            old_session.close()
+        return session
+
+    def invalidate(self, camera_name: str):
+        session = self.sessions.pop(camera_name, None)
+        if session is not None:
+            log.debug(f"Dropped ONVIF session for {camera_name}")
+            session.close()
+
+    def failed(self, camera_name: str, error: Exception):
+        """ Drop the camera's session if error is one of SESSION_ERRORS; a missing preset, say, doesn't need a new one. """
+        if isinstance(error, SESSION_ERRORS):
+            self.invalidate(camera_name)
+
 def get_current_position(ptz_service, token):
     status = ptz_service.GetStatus({'ProfileToken': token})
     position = status.Position
     return decode_position(position)
 
+def decode_move_status(move_status):
+    """ True if MoveStatus says anything is moving, False if it's all IDLE, None if the camera doesn't say. """
+    states = [str(state).upper() for state in (getattr(move_status, 'PanTilt', None), getattr(move_status, 'Zoom', None)) if state]
+    if 'MOVING' in states:
+        return True
+    if states and all(state == 'IDLE' for state in states):
+        return False
+    return None
+
+def get_status(ptz_service, token):
+    """ (position, moving), moving as decode_move_status(). """
+    status = ptz_service.GetStatus({'ProfileToken': token})
+    return decode_position(status.Position), decode_move_status(getattr(status, 'MoveStatus', None))
+
 def are_coords_equal(c1, c2, tolerance=0.01):
     return all(abs(a - b) <= tolerance for a, b in zip(c1, c2))
 
-def poll_position_until_complete(ptz_service, token, target_position, callback=None, max_checks_without_change=2, sleep_interval=0.5):
-    last_position = None
-    current_position = None
+# Seems like the cameras use (0,1.0,0) as code for "Position not set."
+UNSET_POSITION = (0, 1.0, 0)
+
+class PresetIndex:
+    """
+    A camera's presets from one GetPresets, by token, so moving to a preset doesn't have to fetch and scan the list
+    first.  Call refresh() after changing presets.
+    """
+    def __init__(self, ptz_service, token):
+        self.ptz_service = ptz_service
+        self.token = token
+        self.lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        presets = self.ptz_service.GetPresets({'ProfileToken': self.token})
+        by_token = {}  # preset token: (name, coords)
+        for preset in presets:
+            if preset.PTZPosition is None:
+                continue
+            by_token[str(preset.token)] = (preset.Name, decode_position(preset.PTZPosition))
+        with self.lock:
+            self.by_token = by_token
+        log.debug(f"Loaded {len(by_token)} presets.")
+
+    def get(self, preset_token) -> tuple:
+        """ Coords of the preset, or None if the camera has no such preset. """
+        with self.lock:
+            preset = self.by_token.get(str(preset_token))
+        return preset[1] if preset else None
+
+    def positions(self):
+        """ [(token, coords), ...] of the presets that are set, in the camera's order. """
+        with self.lock:
+            return [(preset_token, coords) for preset_token, (name, coords) in self.by_token.items()
+                    if not are_coords_equal(coords, UNSET_POSITION, tolerance=0)]
+
+    def named_positions(self):
+        """ {name: coords} of the presets that are set; ones without a name are called preset<token>. """
+        with self.lock:
+            return {name or f"preset{preset_token}": coords for preset_token, (name, coords) in self.by_token.items()
+                    if not are_coords_equal(coords, UNSET_POSITION, tolerance=0)}
+
+def coords_distance(c1, c2):
+    # Pan, tilt and zoom move at the same time, so the furthest one to go sets how long a move takes.
+    return max(abs(a - b) for a, b in zip(c1, c2))
+
+def poll_position_until_complete(ptz_service, token, target_position, callback=None, max_checks_without_change=2,
+                                 start_position=None, wait=time.sleep, min_interval=0.1, max_interval=1.0, timeout=30):
+    """
+    Wait for a move to finish, then callback(position).  Finished is the camera's MoveStatus going from MOVING to
+    IDLE, or, for cameras that don't report it, being at the target or stopped somewhere else.  The first check is
+    after min_interval; after that, checks come when the camera's speed so far says it should arrive (at most
+    max_interval apart), and back off towards max_interval if it's taking longer.  wait(seconds) does the waiting and may return early, e.g. ONVIFSession.wait on a
+    PTZ event.  Gives up after timeout seconds, reporting wherever the camera is.
+    """
+    started = time.monotonic()
+    last_position, last_checked = start_position, started
+    interval = min_interval
+    seen_moving = False
     checks_without_change = 0
 
     while True:
-        current_position = get_current_position(ptz_service, token)
-        if are_coords_equal(current_position, target_position):
+        wait(interval)
+        current_position, moving = get_status(ptz_service, token)
+        now = time.monotonic()
+        if moving:
+            seen_moving = True
+        elif are_coords_equal(current_position, target_position):
+            break
+        elif moving is False and seen_moving:
+            log.debug(f"Movement stopped at {current_position}, short of {target_position}.")
             break
-
-        # The above is probably sufficient but we're going belt+suspenders
-        # Check to make sure the camera hasn't stopped moving somewhere else
-        if last_position and are_coords_equal(current_position, last_position, tolerance = 0):
-            checks_without_change += 1
         else:
-            checks_without_change = 0
-
-        if checks_without_change >= max_checks_without_change:
-            log.warn(f"Movement stopped without reaching target.")
+            # Belt and suspenders for cameras that don't report MoveStatus: has it stopped somewhere else?
+            if last_position and are_coords_equal(current_position, last_position, tolerance = 0):
+                checks_without_change += 1
+            else:
+                checks_without_change = 0
+            # Some cameras take a moment to start, so only believe it's stopped once it's had max_interval to get going.
+            if checks_without_change >= max_checks_without_change and now - started >= max_interval:
+                log.warn(f"Movement stopped without reaching target.")
+                break
+
+        if now - started > timeout:
+            log.warn(f"Gave up waiting for move to {target_position} after {timeout}s, at {current_position}.")
             break
 
-        last_position = current_position
-        time.sleep(sleep_interval)
+        speed = coords_distance(current_position, last_position) / (now - last_checked) if last_position else 0
+        if speed > 0:
+            interval = min(max(coords_distance(current_position, target_position) / speed, min_interval), max_interval)
+        else:
+            interval = min(interval * 2, max_interval)
+        interval = min(interval, max(started + timeout - now, 0))
+        last_position, last_checked = current_position, now
 
     if callback:
         callback(current_position)
 
-def relative_move(ptz_service, token, vector, callback=None):
+def watch_until_complete(ptz_service, token, target_position, callback, poller=None, **watch_options):
+    """
+    Poll for arrival in the background: with poller(func, *args) if given (e.g. a pool's), else on a new thread.
+    watch_options go to poll_position_until_complete.
+    """
+    poll = partial(poll_position_until_complete, **watch_options)
+    if poller is None:
+        threading.Thread(target=poll, args=(ptz_service, token, target_position, callback)).start()
+    else:
+        poller(poll, ptz_service, token, target_position, callback)
+
+def relative_move(ptz_service, token, vector, callback=None, poller=None, **watch_options):
     position = get_current_position(ptz_service, token)
     destination = tuple(max(min(a+b,1),-1) for a,b in zip(position, vector))
-    move_to_position(ptz_service, token, destination, callback)
+    watch_options.setdefault('start_position', position)
+    move_to_position(ptz_service, token, destination, callback, poller, **watch_options)
 
-def move_to_position(ptz_service, token, coords, callback=None):
+def move_to_position(ptz_service, token, coords, callback=None, poller=None, **watch_options):
     position = encode_position(coords)
     request = ptz_service.create_type('AbsoluteMove')
     request.ProfileToken = token
@@ -81,44 +358,42 @@ def move_to_position(ptz_service, token, coords, callback=None):
     ptz_service.AbsoluteMove(request)
     
     if callback:
-        threading.Thread(target=poll_position_until_complete, args=(ptz_service, token, coords, callback)).start()
+        watch_until_complete(ptz_service, token, coords, callback, poller, **watch_options)
 
 # Function to move to a stored position
-def move_to_stored_position(ptz_service, token, position_number, callback=None):
-    presets = ptz_service.GetPresets({'ProfileToken': token})
-    target_preset = None
-    for preset in presets:
-        log.debug(f"Target preset: {preset}")
-        if preset.token == str(position_number):
-            target_preset = preset
-            break
-
-    if target_preset:
-        ptz_service.GotoPreset({'ProfileToken': token, 'PresetToken': target_preset.token})
+def move_to_stored_position(ptz_service, token, position_number, callback=None, poller=None, presets=None, **watch_options):
+    # Without a PresetIndex to look in, fetch the presets just for this.
+    if presets is None:
+        presets = PresetIndex(ptz_service, token)
+    coords = presets.get(position_number)
+    if coords is None:
+        # Maybe it's been stored since we looked.
+        presets.refresh()
+        coords = presets.get(position_number)
+
+    if coords is not None:
+        log.debug(f"Target preset: {position_number} at {coords}")
+        ptz_service.GotoPreset({'ProfileToken': token, 'PresetToken': str(position_number)})
         
         if callback:
-            threading.Thread(target=poll_position_until_complete, args=(ptz_service, token, decode_position(target_preset.PTZPosition), callback)).start()
+            watch_until_complete(ptz_service, token, coords, callback, poller, **watch_options)
     else:
         raise Exception(f"Preset position {position_number} not found.")
 
 # Function to store the current position as a preset
-def store_current_position_as_preset(ptz_service, token, preset_name):
+def store_current_position_as_preset(ptz_service, token, preset_name, presets=None):
     # Create a new preset with the current position
     request = ptz_service.create_type('SetPreset')
     request.ProfileToken = token
     request.PresetName = preset_name
     response = ptz_service.SetPreset(request)
+    if presets is not None:
+        presets.refresh()
     return response
 
 # TODO: add/move this to screenshot.py in an accessable way
 def get_screenshot(camera_ip, port, username, password):
-    _, media_service, profiles, token = get_service_and_token(camera_ip, port, username, password);
-    snapshot_uri = media_service.GetSnapshotUri({'ProfileToken': profiles[0].token}).Uri
-    # Download the image
-    response = requests.get(snapshot_uri, auth=HTTPDigestAuth(username, password),timeout=10)
-    if response.status_code != 200:
-        raise Exception(f"Request for screenshot {camera_ip} returned {response}")
-    return response.content
+    return ONVIFSession(camera_ip, port, username, password).screenshot()
 
 def get_snapshot_url(media_service, token):
     return  media_service.GetSnapshotUri({'ProfileToken': token}).Uri
@@ -143,11 +418,7 @@ def reboot_camera(camera_ip, port, username, password):
 
 # Function to return all stored positions as (number, coords)
 def get_all_stored_positions(ptz_service, token):
-    presets = ptz_service.GetPresets({'ProfileToken': token})
-    # Seems like the cameras use (0,1.0,0) as code for "Position not set."
-    positions = [(preset.token, decode_position(preset.PTZPosition)) for preset in presets 
-                 if not are_coords_equal(decode_position(preset.PTZPosition), (0,1.0,0), tolerance=0)]
-    return positions
+    return PresetIndex(ptz_service, token).positions()
 
 def main():
     parser = argparse.ArgumentParser(description="PTZ Camera Control")
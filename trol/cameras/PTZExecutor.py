@@ -0,0 +1,115 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from traceback import format_exc
+from typing import Callable, Dict, Deque
+
+from trol.shared.logger import setup_logger
+log = setup_logger(__name__)
+
+class _Job:
+    __slots__ = ('func', 'args', 'collapsible', 'queued_at')
+
+    def __init__(self, func, args, collapsible):
+        self.func = func
+        self.args = args
+        self.collapsible = collapsible
+        self.queued_at = time()
+
+class PTZExecutor:
+    """
+    Runs PTZ commands off the MQTT dispatch thread.  Commands for different cameras run at the same time, on up to
+    workers threads, so one slow or unreachable camera only holds up its own commands; commands for the same camera
+    run one at a time, in the order they came in.
+
+    A command submitted as collapsible (a move to an absolute target) replaces a collapsible command still waiting at
+    the back of its camera's queue, so a burst of moves ends up going straight to the last one.  Anything else, e.g. a
+    relative move, waits its turn and isn't replaced.
+
+    Polling a moving camera until it arrives runs on a separate pool of poll_workers threads via watch(), so it can't
+    starve commands and a flood of moves can't start a thread each.
+    """
+    def __init__(self, workers: int = 8, poll_workers: int = 4):
+        self.lock = threading.Lock()
+        self.commands = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ptz')
+        self.pollers = ThreadPoolExecutor(max_workers=poll_workers, thread_name_prefix='ptz arrival')
+        self.queues = {}  # type: Dict[str, Deque[_Job]]
+        self.running = set()  # cameras with a command running or about to
+        self.polls = 0  # arrival polls queued or running
+        self.collapsed = 0
+        self.completed = 0
+        self.failed = 0
+
+    def submit(self, camera_name: str, func: Callable, *args, collapsible: bool = False):
+        """ Queue func(*args) to run after any commands already queued for camera_name. """
+        job = _Job(func, args, collapsible)
+        with self.lock:
+            queue = self.queues.setdefault(camera_name, deque())
+            if collapsible and queue and queue[-1].collapsible:
+                log.debug(f"Replacing queued move for {camera_name} with {args}")
+                job.queued_at = queue[-1].queued_at
+                queue[-1] = job
+                self.collapsed += 1
+                return
+            queue.append(job)
+            if camera_name in self.running:
+                return
+            self.running.add(camera_name)
+        self.commands.submit(self._run_next, camera_name)
+
+    def _run_next(self, camera_name: str):
+        # One command per call, then back in line behind other cameras, so a busy camera doesn't hog a thread.
+        with self.lock:
+            job = self.queues[camera_name].popleft()
+        try:
+            job.func(*job.args)
+            succeeded = True
+        except Exception as e:
+            succeeded = False
+            log.error(f"Error in PTZ command for {camera_name}: {e}\n{format_exc()}")
+        with self.lock:
+            if succeeded:
+                self.completed += 1
+            else:
+                self.failed += 1
+            if not self.queues[camera_name]:
+                del self.queues[camera_name]
+                self.running.discard(camera_name)
+                return
+        self.commands.submit(self._run_next, camera_name)
+
+    def watch(self, func: Callable, *args):
+        """ Run func(*args), an arrival poll, on the poll pool. """
+        with self.lock:
+            self.polls += 1
+        future = self.pollers.submit(func, *args)
+        future.add_done_callback(self._poll_done)
+        return future
+
+    def _poll_done(self, future):
+        with self.lock:
+            self.polls -= 1
+        if not future.cancelled() and future.exception() is not None:
+            log.error(f"Error polling PTZ arrival: {future.exception()}")
+
+    def get_stats(self):
+        """ Commands waiting (in all, per camera, and the longest wait in seconds), busy cameras and counters. """
+        now = time()
+        with self.lock:
+            depths = {camera_name: len(queue) for camera_name, queue in self.queues.items() if queue}
+            oldest = min((queue[0].queued_at for queue in self.queues.values() if queue), default=now)
+            return {
+                'queued': sum(depths.values()),
+                'busy_cameras': len(self.running),
+                'cameras': depths,
+                'oldest_wait': round(now - oldest, 1),
+                'arrival_polls': self.polls,
+                'collapsed': self.collapsed,
+                'completed': self.completed,
+                'failed': self.failed,
+            }
+
+    def shutdown(self):
+        self.commands.shutdown(wait=False, cancel_futures=True)
+        self.pollers.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,210 @@
+import argparse
+import threading
+import subprocess
+import time
+import random
+import ffmpeg
+
+from trol.shared.logger import setup_logger
+log = setup_logger(__name__)
+
+JPEG_START = b'\xff\xd8'
+JPEG_END = b'\xff\xd9'
+
+class RTSPGrabber:
+    """
+    Keeps an ffmpeg process connected to a stream, writing frames as MJPEG to a pipe, and holds on to the most recent
+    one so a screenshot is just a copy instead of a fresh connect/handshake/wait-for-keyframe every time.
+
+    By default only keyframes are decoded, which is plenty for thumbnails and a fraction of the CPU of decoding every
+    frame.  If ffmpeg exits or stops producing frames for stall_timeout seconds we kill it and reconnect, backing off
+    exponentially (with jitter) while the stream keeps failing.
+
+    Anything ffmpeg can read works as url, so for testing a local file can stand in for a camera:
+        RTSPGrabber('test.mp4', input_options={'re': None, 'stream_loop': -1}, keyframes_only=False)
+    """
+    def __init__(self, url: str, input_options: dict = None, keyframes_only: bool = True, stall_timeout: float = 30,
+                 min_backoff: float = 1, max_backoff: float = 60):
+        self.url = url
+        if input_options is None:
+            input_options = {'rtsp_transport': 'tcp'} if url.lower().startswith('rtsp:') else {}
+        self.input_options = dict(input_options)
+        if keyframes_only:
+            self.input_options['skip_frame'] = 'nokey'
+        self.stall_timeout = stall_timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+        self.lock = threading.Lock()
+        self.frame = None
+        self.frame_time = None  # time.monotonic() of the last frame
+        self.frame_count = 0
+        self.restart_count = 0
+        self.last_error = None
+
+        self._process = None
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"grabber {self._safe_url()}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._stop_event.set()
+        self._kill_process()
+
+    def get_frame(self, max_age: float = None, wait: float = 0):
+        """
+        JPEG bytes of the latest frame.  Waits up to wait seconds for a first frame (e.g. just after starting) and
+        raises if there is none, or if it is older than max_age seconds.
+        """
+        deadline = time.monotonic() + wait
+        while True:
+            with self.lock:
+                frame, frame_time, error = self.frame, self.frame_time, self.last_error
+            if frame is not None or time.monotonic() >= deadline:
+                break
+            time.sleep(0.1)
+        if frame is None:
+            raise Exception(f"No frame yet from {self._safe_url()}" + (f": {error}" if error else ""))
+        age = time.monotonic() - frame_time
+        if max_age is not None and age > max_age:
+            raise Exception(f"Latest frame from {self._safe_url()} is {age:.0f}s old" + (f": {error}" if error else ""))
+        return frame
+
+    def _safe_url(self):
+        # URLs usually carry credentials; keep them out of logs.
+        scheme, sep, rest = self.url.partition('://')
+        return f"{scheme}{sep}{rest.rpartition('@')[2]}" if sep else self.url
+
+    def _start_process(self):
+        return (
+            ffmpeg
+            .input(self.url, **self.input_options)
+            .output('pipe:', format='image2pipe', vcodec='mjpeg', **{'q:v': 2})
+            .global_args('-loglevel', 'error', '-nostdin')
+            .run_async(pipe_stdout=True)
+        )
+
+    def _kill_process(self):
+        process = self._process
+        if process is not None and process.poll() is None:
+            process.kill()
+
+    def _run(self):
+        backoff = self.min_backoff
+        while not self._stop_event.is_set():
+            frames_before = self.frame_count
+            try:
+                self._process = self._start_process()
+                self._read_frames(self._process)
+            except Exception as e:
+                with self.lock:
+                    self.last_error = str(e)
+            finally:
+                self._kill_process()
+                if self._process is not None:
+                    self._process.wait()
+            if self._stop_event.is_set():
+                break
+            if self.frame_count > frames_before:
+                # It worked for a while, so this is a fresh failure rather than more of the same.
+                backoff = self.min_backoff
+            self.restart_count += 1
+            delay = backoff * random.uniform(0.5, 1.5)
+            log.info(f"Stream {self._safe_url()} ended ({self.last_error}), reconnecting in {delay:.1f}s")
+            self._stop_event.wait(delay)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def _read_frames(self, process):
+        """ Split ffmpeg's MJPEG output into frames until it ends or stalls. """
+        # A reader thread does the blocking reads so we can notice a stream that's connected but silent.
+        buffer = bytearray()
+        state = {'last_data': time.monotonic()}
+        def reader():
+            while True:
+                chunk = process.stdout.read1(65536)
+                if not chunk:
+                    return
+                state['last_data'] = time.monotonic()
+                buffer.extend(chunk)
+                self._take_frames(buffer)
+        reader_thread = threading.Thread(target=reader, name=f"grabber reader {self._safe_url()}", daemon=True)
+        reader_thread.start()
+        while reader_thread.is_alive():
+            reader_thread.join(1)
+            if self._stop_event.is_set():
+                return
+            if time.monotonic() - state['last_data'] > self.stall_timeout:
+                with self.lock:
+                    self.last_error = f"no data for {self.stall_timeout}s"
+                return
+        try:
+            # Our end of the pipe closing usually means ffmpeg is on its way out.
+            error = f"ffmpeg exited with {process.wait(timeout=5)}"
+        except subprocess.TimeoutExpired:
+            error = "ffmpeg closed its output"
+        with self.lock:
+            self.last_error = error
+
+    def _take_frames(self, buffer: bytearray):
+        # ffmpeg's mjpeg encoder doesn't embed thumbnails, so the first end marker after a start marker ends the frame.
+        while True:
+            start = buffer.find(JPEG_START)
+            if start < 0:
+                del buffer[:-1]  # Keep a trailing 0xff in case it's half a start marker.
+                return
+            end = buffer.find(JPEG_END, start + 2)
+            if end < 0:
+                del buffer[:start]
+                return
+            frame = bytes(buffer[start:end + 2])
+            del buffer[:end + 2]
+            with self.lock:
+                self.frame = frame
+                self.frame_time = time.monotonic()
+                self.frame_count += 1
+                self.last_error = None
+
+_grabbers = {}
+_grabbers_lock = threading.Lock()
+
+def get_grabber(url: str) -> RTSPGrabber:
+    """ The running grabber for url, starting one if needed.  Safe to call from any thread. """
+    with _grabbers_lock:
+        grabber = _grabbers.get(url)
+        if grabber is None:
+            grabber = _grabbers[url] = RTSPGrabber(url).start()
+        return grabber
+
+def close_grabber(url: str):
+    with _grabbers_lock:
+        grabber = _grabbers.pop(url, None)
+    if grabber is not None:
+        grabber.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Grab frames from a stream (or a local file standing in for one)')
+    parser.add_argument('url', help='rtsp:// URL or anything else ffmpeg can read')
+    parser.add_argument('--seconds', type=float, default=20, help='How long to run')
+    parser.add_argument('--all_frames', action='store_true', help='Decode every frame, not just keyframes')
+    parser.add_argument('--loop_file', action='store_true', help='Treat url as a file: read it at native speed, forever')
+    args = parser.parse_args()
+
+    input_options = {'re': None, 'stream_loop': -1} if args.loop_file else None
+    grabber = RTSPGrabber(args.url, input_options=input_options, keyframes_only=not args.all_frames).start()
+    end_time = time.monotonic() + args.seconds
+    try:
+        while time.monotonic() < end_time:
+            time.sleep(1)
+            try:
+                frame = grabber.get_frame(max_age=5)
+                print(f"frames: {grabber.frame_count} restarts: {grabber.restart_count} latest: {len(frame)} bytes")
+            except Exception as e:
+                print(e)
+    finally:
+        grabber.close()
+
+if __name__ == '__main__':
+    main()
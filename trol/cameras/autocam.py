@@ -1,7 +1,6 @@
 from typing import Callable, Any
 
 import requests as requests
-from requests.auth import HTTPDigestAuth
 
 from trol.shared.settings import get_settings
 settings = get_settings()
@@ -15,6 +14,7 @@ from trol.shared.MQTTVariable import MQTTVariable
 from trol.shared.MQTTPositions import MQTTPositions, MQTTPosition
 from trol.shared.MQTTCameras import MQTTCameras, MQTTCamera
 from trol.shared.MQTTCommands import OBSCommands
+from trol.shared.HTTP import get_camera_http
 
 mqtt = None
 cameras = None
@@ -87,7 +87,7 @@ class CameraMonitor:
         try:
             url = self.camera.pingurl or self.camera.rtspurl
             # log.debug(f"Checking for connection to {url}")
-            response = requests.get(url, timeout=2)
+            response = get_camera_http().get(url, timeout=2)
             # log.debug(f"response is: {response}")
             if response.status_code == 200:
                 if self.state == 'offline':
@@ -118,9 +118,9 @@ def main():
     global positions
     global obs
 
-    mqtt = MQTTConnectionManager(settings.mqtt.host, settings.mqtt.port, settings.mqtt.username, settings.mqtt.password)
-    cameras = MQTTCameras(mqtt, f"{settings.mqtt_root}/cameras")
-    positions = MQTTPositions(mqtt, f"{settings.mqtt_root}/positions")
+    mqtt = MQTTConnectionManager(settings.mqtt.host, settings.mqtt.port, settings.mqtt.username, settings.mqtt.password, topic_root=settings.mqtt_root)
+    cameras = MQTTCameras(mqtt, f"{settings.mqtt_root}/cameras", lazy=True)
+    positions = MQTTPositions(mqtt, f"{settings.mqtt_root}/positions", lazy=True)
     obs = OBSCommands(mqtt, settings.mqtt_root)
     recording = MQTTVariable(mqtt, f"{settings.mqtt_root}/obs/is_recording", value_type = bool, initial_value = False)
     recording.add_callback(lambda: handle_recording_toggled(recording.value))
@@ -2,10 +2,9 @@ import json
 from urllib.parse import urlparse, urlunparse
 from typing import Callable, Any
 import traceback
+import threading
+from concurrent.futures import Future
 
-from PIL import Image
-import io
-import base64
 
 from trol.shared.settings import get_settings
 import argparse
@@ -16,66 +15,90 @@ log = setup_logger(__name__)
 from trol.shared.MQTT import MQTTConnectionManager
 from trol.shared.MQTTCameras import MQTTCameras
 from trol.shared.MQTTCommands import CameraCommands
+from trol.shared.Thumbnails import make_thumbnail, thumbnail_options, encode_thumbnail
 
-from .ONVIF import get_service_and_token, move_to_stored_position, move_to_position, get_current_position, relative_move, get_screenshot
+from .ONVIF import ONVIFSessionCache, move_to_stored_position, move_to_position, get_current_position, relative_move
+from .PTZExecutor import PTZExecutor
 
 ap = argparse.ArgumentParser()
 ap.add_argument('--config', type=str, default='./config.yaml', help='Config filename (default: ./config.yaml)')
+ap.add_argument('--workers', type=int, default=8, help='Cameras that can be sent commands at once (default: 8)')
+ap.add_argument('--poll_workers', type=int, default=4, help='Moves that can be watched for arrival at once (default: 4)')
+ap.add_argument('--arrival_timeout', type=float, default=30, help='Seconds to wait for a move to finish before reporting wherever the camera is (default: 30)')
+ap.add_argument('--stats_interval', type=float, default=5, help='Seconds between checks for new queue stats to publish (default: 5)')
 args = ap.parse_args()
 
 settings = get_settings()
 settings.load_from_yaml_file(args.config)
 
-mqtt = MQTTConnectionManager(settings.mqtt.host, settings.mqtt.port, settings.mqtt.username, settings.mqtt.password)
-cameras = MQTTCameras(mqtt, f"{settings.mqtt_root}/cameras")
+mqtt = MQTTConnectionManager(settings.mqtt.host, settings.mqtt.port, settings.mqtt.username, settings.mqtt.password, topic_root=settings.mqtt_root)
+cameras = MQTTCameras(mqtt, f"{settings.mqtt_root}/cameras", lazy=True)
 cameraCommands = CameraCommands(mqtt, settings.mqtt_root)
+sessions = ONVIFSessionCache()
+executor = PTZExecutor(args.workers, args.poll_workers)
 
 # How many prior_ptz_positions to save
 MAX_PTZ_HISTORY = 5
 
-def getConnection(camera):
-    url = urlparse(camera.rtspurl)
-    # TODO: Don't log username/passwords!
-    # log.debug(f"Connecting to {url.hostname} with username {url.username}")
-    host, port, user, password = get_credentials(camera._name)
-    ptz_service, media_service, profiles, token = get_service_and_token(host, port, user, password )
-    return ptz_service, token
+# Command handlers run on the executor and arrival reports on its poll pool, but camera state in MQTT is only touched
+# on the dispatch thread: what a command needs is read when it's submitted, and changes go back with mqtt.call_later.
 
-def get_credentials(camera_name: str):
-    camera = cameras.getByName(camera_name)
-    if camera is None:
+def submit_command(camera_name, handler, *args, collapsible=False):
+    """ On the dispatch thread: queue handler(camera_name, credentials, *args) behind the camera's other commands. """
+    if cameras.getByName(camera_name) is None:
         log.error(f"Couldn't get camera: {camera_name}")
+        return
+    executor.submit(camera_name, handler, camera_name, get_credentials(camera_name), *args, collapsible=collapsible)
+
+def on_dispatch_thread(func, *args, timeout: float = 30):
+    """ For handlers that must see camera state as of their turn: run func(*args) on the dispatch thread and wait. """
+    future = Future()
+    def run():
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+    mqtt.call_later(0, run)
+    return future.result(timeout)
 
+def warm_sessions():
+    """
+    Connect to every camera and load its presets in the background now, rather than making each one's first command
+    wait for it.
+    """
+    credentials = {camera_name: get_credentials(camera_name) for camera_name, camera in cameras.items() if camera.rtspurl}
+    def warm():
+        for camera_name, camera_credentials in credentials.items():
+            try:
+                session = sessions.get(camera_name, *camera_credentials)
+                send_presets(camera_name, session.presets())
+            except Exception as e:
+                log.info(f"No ONVIF session for {camera_name} yet: {e}")
+    threading.Thread(target=warm, name="ONVIF warmup", daemon=True).start()
+
+def get_credentials(camera_name: str):
+    camera = cameras.getByName(camera_name)
     url = urlparse(camera.rtspurl)
     return (url.hostname, 80, url.username, url.password)
 
-def getCurrentPosition(camera, ptz_service=None, token=None):
-    url = urlparse(camera.rtspurl)
-    try:
-        if ptz_service is None or token is None:
-            ptz_service, token = getConnection(camera)
-        position = get_current_position(ptz_service, token)
-    except Exception as e:
-        stack_trace = traceback.format_exc()
-        log.error(f"Exception getting current position for {camera._name}: {e}\n{stack_trace}")
-    return position
-
-def add_position_to_undo_stack(camera, ptz_service=None, token=None):
-    coords = getCurrentPosition(camera, ptz_service, token)
-    prior_ptz = camera.prior_ptz_positions
-    if camera.prior_ptz_positions is None:
-        camera.prior_ptz_positions = []
-    camera.prior_ptz_positions.append(coords)
-    camera.prior_ptz_positions = camera.prior_ptz_positions[-MAX_PTZ_HISTORY:]
-    log.debug(f"Updated prior ptz for {camera._name} now {camera.prior_ptz_positions}.")
-
-def handle_go_back(camera, negative_index):
-    """ Go back to the abs negative_indexth prior coords """
-    prior_ptz = camera.prior_ptz_positions
-    if prior_ptz is None or len(prior_ptz) == 0:
-        prior_ptz = []
-        log.warn(f"Request for {camera._name} to go back but no priors stored.")
-        return
+def add_position_to_undo_stack(camera_name, session):
+    """ Where the camera is now, also pushed onto its prior_ptz_positions. """
+    coords = get_current_position(session.ptz_service, session.token)
+    mqtt.call_later(0, lambda: push_prior_position(camera_name, coords))
+    return coords
+
+def push_prior_position(camera_name, coords):
+    camera = cameras.getByName(camera_name)
+    camera.prior_ptz_positions = (list(camera.prior_ptz_positions or []) + [coords])[-MAX_PTZ_HISTORY:]
+    log.debug(f"Updated prior ptz for {camera_name} now {camera.prior_ptz_positions}.")
+
+def pop_prior_position(camera_name, negative_index):
+    """ Take the abs negative_indexth prior coords, and any after them, off the camera's prior_ptz_positions. """
+    camera = cameras.getByName(camera_name)
+    prior_ptz = list(camera.prior_ptz_positions or [])
+    if not prior_ptz:
+        log.warn(f"Request for {camera_name} to go back but no priors stored.")
+        return None
 
     if abs(negative_index) > len(prior_ptz):
         # If the negative index is larger than the list, go to the oldest position and clear the list
@@ -86,68 +109,138 @@ def handle_go_back(camera, negative_index):
         coords = prior_ptz[negative_index]
         # Remove any skipped history
         del prior_ptz[negative_index:]
-
-    log.info(f"Handling request for {camera._name} to go back to {coords}")
-    handle_goto_coords(camera, coords)
     camera.prior_ptz_positions = prior_ptz
-    log.debug(f"Updated prior ptz for {camera._name} now {prior_ptz}.")
+    log.debug(f"Updated prior ptz for {camera_name} now {prior_ptz}.")
+    return coords
+
+def send_presets(camera_name, presets):
+    """ Have the camera's presets mirrored into MQTT, from whichever thread has them. """
+    named = {name: list(coords) for name, coords in presets.named_positions().items()}
+    mqtt.call_later(0, lambda: mirror_presets(camera_name, named))
 
-def handle_goto_number(camera_name, position_number=None):
+def mirror_presets(camera_name, named):
+    """
+    Copy the camera's presets into its known_ptz_positions, so Discord can find them by name.  A position saved from
+    Discord keeps its name; a preset called the same isn't copied.  What we copied is kept in mirrored_ptz_presets, so
+    presets the camera no longer has are removed even after a restart.
+    """
+    camera = cameras.getByName(camera_name)
+    if camera is None:
+        return
+    known = dict(camera.known_ptz_positions or {})
+    # Ours are the entries still holding what we copied; anything else under one of those names was saved since.
+    ours = {name for name, coords in (camera.mirrored_ptz_presets or {}).items() if known.get(name) == coords}
+    updated = {name: coords for name, coords in known.items() if name not in ours}
+    mirrored = {name: coords for name, coords in named.items() if name not in updated}
+    updated.update(mirrored)
+    with camera.batch():
+        if updated != known:
+            log.debug(f"Mirroring {len(mirrored)} presets into known_ptz_positions for {camera_name}")
+            camera.known_ptz_positions = updated
+        if mirrored != camera.mirrored_ptz_presets:
+            camera.mirrored_ptz_presets = mirrored
+
+def watch_options(session, start_position):
+    """ How to watch a move for arrival: on the shared pool, woken by the camera's PTZ events if it sends them. """
+    return {'poller': executor.watch, 'wait': session.wait, 'start_position': start_position,
+            'timeout': args.arrival_timeout}
+
+def arrival_reporter(camera_name, session):
+    return lambda coords: report_position_arrival(camera_name, session, coords)
+
+def handle_go_back(camera_name, credentials, negative_index):
+    """ Go back to the abs negative_indexth prior coords """
+    # Read in our turn, so it includes where the camera's earlier commands started from.
+    coords = on_dispatch_thread(pop_prior_position, camera_name, negative_index)
+    if coords is None:
+        return
+    log.info(f"Handling request for {camera_name} to go back to {coords}")
+    handle_goto_coords(camera_name, credentials, coords)
+
+def handle_goto_number(camera_name, credentials, position_number=None):
     log.debug(f"Request to move {camera_name} to position {position_number}")
+    if position_number < 0:
+        handle_go_back(camera_name, credentials, position_number)
+        return
     try:
-        camera = cameras.getByName(camera_name)
-        if position_number < 0:
-            handle_go_back(camera, position_number)
-            return
-        ptz_service, token = getConnection(camera)
-        add_position_to_undo_stack(camera, ptz_service=ptz_service, token=token)
-        move_to_stored_position(ptz_service, token, position_number, callback = lambda coords, c=camera, s=ptz_service, t=token: report_position_arrival(c, coords, s, t))
+        session = sessions.get(camera_name, *credentials)
+        start_position = add_position_to_undo_stack(camera_name, session)
+        presets = session.presets()
+        move_to_stored_position(session.ptz_service, session.token, position_number, callback = arrival_reporter(camera_name, session), presets=presets, **watch_options(session, start_position))
+        # The lookup may have refreshed the presets.
+        send_presets(camera_name, presets)
     except Exception as e:
+        sessions.failed(camera_name, e)
         stack_trace = traceback.format_exc()
         log.error(f"Exception moving {camera_name} to position {position_number}: {e}\n{stack_trace}")
 
-def handle_goto_coords(camera_name, coords=None, ptz_service=None, token=None):
+def handle_goto_coords(camera_name, credentials, coords=None):
     log.debug(f"Request to move {camera_name} to coords: {coords}")
     try:
-        camera = cameras.getByName(camera_name)
-        if ptz_service is None or token is None:
-            ptz_service, token = getConnection(camera)
-        add_position_to_undo_stack(camera, ptz_service=ptz_service, token=token)
+        session = sessions.get(camera_name, *credentials)
+        start_position = add_position_to_undo_stack(camera_name, session)
         log.debug(f"Handling request for {camera_name} to xyz {coords}")
-        move_to_position(ptz_service, token, coords, callback = lambda coords, c=camera, s=ptz_service, t=token: report_position_arrival(c, coords, s, t))
+        move_to_position(session.ptz_service, session.token, coords, callback = arrival_reporter(camera_name, session), **watch_options(session, start_position))
     except Exception as e:
+        sessions.failed(camera_name, e)
         stack_trace = traceback.format_exc()
         log.error(f"Exception moving {camera_name} to position {coords}: {e}\n{stack_trace}")
 
-def handle_vector_move(camera_name, vector):
+def handle_vector_move(camera_name, credentials, vector):
     log.debug(f"Got request for relative move to {vector} for {camera_name}")
-    camera = cameras.getByName(camera_name)
-    ptz_service, token = getConnection(camera)
-    add_position_to_undo_stack(camera, ptz_service=ptz_service, token=token)
-    relative_move(ptz_service, token, vector, callback = lambda coords, c=camera, s=ptz_service, t=token: report_position_arrival(c, coords, s, t))
-
-def report_position_arrival(camera, coords, ptz_service, token):
-    creds = get_credentials(camera._name)
-    screenshot_data = screenshot_data_to_trol2(get_screenshot(*creds))
-    topic = f"{camera.get_topic()}/ptz_arrived"
+    try:
+        session = sessions.get(camera_name, *credentials)
+        start_position = add_position_to_undo_stack(camera_name, session)
+        relative_move(session.ptz_service, session.token, vector, callback = arrival_reporter(camera_name, session), **watch_options(session, start_position))
+    except Exception as e:
+        sessions.failed(camera_name, e)
+        raise
+
+def handle_store_position(camera_name, credentials, position_name):
+    log.debug(f"Request to store {camera_name}'s position as preset {position_name}")
+    try:
+        session = sessions.get(camera_name, *credentials)
+        preset_token = session.store_preset(position_name)
+        log.info(f"Stored {camera_name}'s position as preset {preset_token} ({position_name})")
+        send_presets(camera_name, session.presets())
+    except Exception as e:
+        sessions.failed(camera_name, e)
+        raise
+
+def report_position_arrival(camera_name, session, coords):
+    try:
+        screenshot_data = screenshot_data_to_trol2(session.screenshot())
+    except Exception as e:
+        sessions.failed(camera_name, e)
+        log.error(f"Exception getting screenshot for {camera_name} after move: {e}\n{traceback.format_exc()}")
+        return
+    topic = f"{cameras.get_topic()}/{camera_name}/ptz_arrived"
     log.debug(f"Reporting completed move on {topic}: {coords}")
-    mqtt.publish(topic, json.dumps({'coords': coords, 'screenshot': screenshot_data}), retain=False)
+    payload = json.dumps({'coords': coords, 'screenshot': screenshot_data})
+    mqtt.call_later(0, lambda: mqtt.publish(topic, payload, retain=False))
 
 def screenshot_data_to_trol2(data: bytes):
-    # TODO: this is a common function and should be trol.shared.someplace instead of duplicated
-    image = Image.open(io.BytesIO(data))
-    resized_image = image.resize([settings.thumbnail_width, settings.thumbnail_height])
-    thumbIO = io.BytesIO()
-    resized_image.save(thumbIO, format='JPEG')
-    return "data:image/jpg;base64," + str(base64.b64encode(thumbIO.getvalue()), 'utf8')
-
+    # Always a data URI; it travels inside the JSON of ptz_arrived.
+    return encode_thumbnail(make_thumbnail(data, **thumbnail_options(settings)))
 
+def publish_stats(last_stats=None):
+    """ Publish the executor's queue stats when they've changed, then check again in --stats_interval. """
+    stats = executor.get_stats()
+    if stats != last_stats:
+        mqtt.publish(f"{settings.mqtt_root}/ptz/stats", json.dumps(stats))
+    mqtt.call_later(args.stats_interval, lambda: publish_stats(stats))
 
 def main():
-    cameraCommands.goto_relative_vector = handle_vector_move
-    cameraCommands.goto_absolute_coords = handle_goto_coords
-    cameraCommands.goto_ptz_position = handle_goto_number
+    # Handlers run on the executor, not the MQTT dispatch thread, so a camera that's slow to answer only delays itself.
+    # A move to an absolute target replaces one still waiting for the same camera; relative moves and go-backs
+    # depend on where the camera was, so they always run.
+    cameraCommands.goto_relative_vector = lambda camera_name, vector: submit_command(camera_name, handle_vector_move, vector)
+    cameraCommands.goto_absolute_coords = lambda camera_name, coords: submit_command(camera_name, handle_goto_coords, coords, collapsible=True)
+    cameraCommands.goto_ptz_position = lambda camera_name, position_number: submit_command(camera_name, handle_goto_number, position_number, collapsible=position_number >= 0)
+    cameraCommands.store_ptz_position = lambda camera_name, position_name: submit_command(camera_name, handle_store_position, position_name)
     mqtt.process_initialization_callbacks()
+    warm_sessions()
+    publish_stats()
 
     log.info(f"Startup completed.")
     try:
@@ -156,6 +249,7 @@ def main():
     except KeyboardInterrupt:
         log.info("Shutting down by user request.")
 
+    executor.shutdown()
     mqtt.disconnect()
 
     log.info("Program exiting.")
@@ -1,13 +1,11 @@
 import argparse
 import json
 import time
-import threading
+import random
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import requests
-from requests.auth import HTTPDigestAuth
 import io
 from PIL import Image
-import base64
 import numpy as np
 from urllib.parse import urlparse
 import ffmpeg
@@ -17,42 +15,31 @@ import os
 from trol.shared.settings import get_settings
 
 from trol.shared.MQTT import MQTTConnectionManager
+from trol.shared.HTTP import get_camera_http
+from trol.shared.MQTTCameras import MQTTCameras, MQTTCamera
+from trol.shared.MQTTPositions import MQTTPositions
 from trol.shared.MQTTVariable import MQTTVariable
+from trol.shared.ThumbnailHistory import ThumbnailHistory
+from trol.shared.Thumbnails import THUMBNAIL_FORMATS, encode_thumbnail, make_thumbnail, thumbnail_options, thumbnail_signature, change_score
+from trol.cameras.RTSPGrabber import get_grabber, close_grabber
 
 from trol.shared.logger import setup_logger, is_debug
 log = setup_logger(__name__)
 
-failure_count = None
-last_error = None
-
 def make_static(thumb_width, thumb_height):
     random_data = np.random.randint(100, 150, (thumb_height, thumb_width), dtype=np.uint8)
     image = Image.fromarray(random_data, 'L')
     thumbIO = io.BytesIO()
     image.save(thumbIO, format='JPEG')
-    return "data:image/jpg;base64," + str(base64.b64encode(thumbIO.getvalue()), 'utf8')
+    return thumbIO.getvalue()
 
-def process_screenshot(c, thumb_width = 240, thumb_height = 135):
-    ### Convert response content into resized image represented as b64 string
-    image = Image.open(io.BytesIO(c))
-    # TODO: get resolution from config
-    resized_image = image.resize([thumb_width, thumb_height])
-    thumbIO = io.BytesIO()
-    resized_image.save(thumbIO, format='JPEG')
-    return "data:image/jpg;base64," + str(base64.b64encode(thumbIO.getvalue()), 'utf8')
+def process_screenshot(c, options = None):
+    ### Convert response content into resized JPEG bytes; options are make_thumbnail's, e.g. from thumbnail_options()
+    return make_thumbnail(c, **(options or {}))
 
 def get_screenshot_http(screenshot_address, camera_user = None, camera_pass = None, timeout=5):
-    # If no creds supplied, see if they're embedded in URL
-    if not camera_user:
-        purl = urlparse(screenshot_address)
-        if purl.username:
-            camera_user = purl.username
-            camera_pass = purl.password
-
-    if camera_user:
-        r = requests.get(screenshot_address,auth=HTTPDigestAuth(camera_user, camera_pass),timeout=timeout)
-    else:
-        r = requests.get(screenshot_address,timeout=timeout)
+    # If no creds supplied, any embedded in the URL are used.
+    r = get_camera_http().get(screenshot_address, camera_user, camera_pass, timeout=timeout)
     sc = r.status_code
     if sc == 200:
         return r.content
@@ -60,6 +47,7 @@ def get_screenshot_http(screenshot_address, camera_user = None, camera_pass = No
         raise Exception(f"Request for {screenshot_address} returned {sc}")
 
 def get_screenshot_stream(screenshot_address, _camera_user, _camera_pass):
+    """ One-off: connect, grab a frame and disconnect.  See get_screenshot_grabber for the usual way. """
     with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as tmpfile:
         try:
             # Capture frame and write to the temporary file
@@ -77,66 +65,282 @@ def get_screenshot_stream(screenshot_address, _camera_user, _camera_pass):
             os.remove(tmpfile.name)
     return file_data
 
+def get_screenshot_grabber(screenshot_address, timeout=5):
+    """ Latest frame from a long-lived connection to the stream, which is started on first use. """
+    # A new grabber needs a moment to connect and see a keyframe; after that frames older than timeout mean trouble.
+    return get_grabber(screenshot_address).get_frame(max_age=timeout, wait=timeout)
+
 def is_rtsp(url):
     parsed_url = urlparse(url)
     return parsed_url.scheme.lower() == 'rtsp'
 
-def get_camera_screenshot(screenshot_address, camera_user, camera_pass, thumb_width, thumb_height, timeout=5):
-    global last_error
-    try:
-        if is_rtsp(screenshot_address):
-            return process_screenshot(get_screenshot_stream(screenshot_address, camera_user, camera_pass), thumb_width, thumb_height)
-        else:
-            return process_screenshot(get_screenshot_http(screenshot_address, camera_user, camera_pass, timeout), thumb_width, thumb_height)
-    except Exception as e:
-        # Take a note.
-        last_error = f"{datetime.now().isoformat()} -- {e}";
-    return None
+def get_camera_screenshot(screenshot_address, camera_user, camera_pass, options = None, timeout=5, rtsp_oneshot=False):
+    """ Thumbnail JPEG bytes for a camera.  Raises on failure.  Touches no MQTT state, so is safe on a worker thread. """
+    if is_rtsp(screenshot_address):
+        if rtsp_oneshot:
+            return process_screenshot(get_screenshot_stream(screenshot_address, camera_user, camera_pass), options)
+        return process_screenshot(get_screenshot_grabber(screenshot_address, timeout), options)
+    else:
+        return process_screenshot(get_screenshot_http(screenshot_address, camera_user, camera_pass, timeout), options)
 
 
-def publish_camera_status(mqtt_manager, camera_root, jpgurl, camera_user = None, camera_pass = None, thumb_width = None, thumb_height = None, timeout = None, on_fail = 'delayed'):
-    global failure_count
+def publish_camera_status(mqtt_manager, camera: MQTTCamera, screenshot, error = None, thumb_width = None, thumb_height = None, on_fail = 'delayed', thumbnail_format = 'data_uri', unchanged = False):
+    camera_root      = camera.get_topic()
     screenshot_topic = f"{camera_root}/screenshot"
     timestamp_topic  = f"{camera_root}/last_screenshot_timestamp"
     error_topic      = f"{camera_root}/error_message"
 
-    log.debug(f"Getting screenshot for {camera_root} from {jpgurl}")
-    screenshot = get_camera_screenshot(jpgurl, camera_user, camera_pass, thumb_width, thumb_height, timeout)
     if screenshot:
-        failure_count.value = 0
+        camera.failure_count = 0
         mqtt_manager.publish(timestamp_topic, datetime.now().isoformat())
+        if unchanged:
+            # Subscribers already have this picture, near enough; just tell them it's still current.
+            return
     else:
-        failure_count.value += 1
-        mqtt_manager.publish(error_topic, last_error)
-        log.info(f"{camera_root} screenshot {failure_count.value} error(s): {last_error}")
-        # TODO: Have an option to do nothing until X failures/X time since last success, then send clear.
-        # Or just make that how it always works.
-        # TODO: Make this an option:
-        if failure_count.value > 50:
-            raise Exception("Failure count reached 50, dying so Docker can restart us.")
+        camera.failure_count = (camera.failure_count or 0) + 1
+        mqtt_manager.publish(error_topic, error)
+        log.info(f"{camera_root} screenshot {camera.failure_count} error(s): {error}")
         if on_fail == 'static':
             screenshot = make_static(thumb_width, thumb_height)
         elif on_fail == 'clear':
-            screenshot = ''
+            screenshot = b''
         elif on_fail == 'delayed':
-            if failure_count.value > 20:
-                screenshot = ''
+            if camera.failure_count > 20:
+                screenshot = b''
         else:
             # don't publish any screenshot data.
             return
-    mqtt_manager.publish(screenshot_topic, screenshot)
+    # Blank means "camera is dead" in either format.
+    mqtt_manager.publish(screenshot_topic, encode_thumbnail(screenshot, thumbnail_format) if screenshot else '')
+
+class CameraScreenshotter:
+    """ Schedule for one camera. """
+    def __init__(self, name: str, camera: MQTTCamera, default_interval: float, jitter: bool = True):
+        self.name = name
+        self.camera = camera
+        self.default_interval = default_interval
+        self.in_flight = False
+        self.started = None  # time.monotonic() the current or last capture started
+        self.url = None  # jpgurl we last took a screenshot from, so we can let go of its stream when it changes
+        self.last_signature = None  # thumbnail_signature() of the last screenshot we published
+        self.last_full_publish = 0
+        # Spread first captures across an interval so a restart doesn't hit every camera at the same moment.
+        self.next_due = time.monotonic() + (random.uniform(0, self.interval()) if jitter else 0)
+
+    def interval(self):
+        """ The camera's own screenshot_interval if it has one, otherwise ours. """
+        return self.camera.screenshot_interval or self.default_interval
+
+class ScreenshotScheduler:
+    """
+    Takes screenshots for any number of cameras from one process.  Captures (network, ffmpeg and PIL work) run on a
+    bounded pool of worker threads and hand their results back through the MQTT manager, so MQTT state is still only
+    touched from the thread processing callbacks.  A camera never has more than one capture going at a time.
+
+    How often depends on who's looking: cameras on screen or in a Discord poll every --active_interval seconds,
+    hidden, non-public and nothumb cameras every --idle_interval, everything else every --interval (or the camera's
+    own screenshot_interval).  A failing camera backs off exponentially from there, up to --max_backoff.  Each
+    camera's current interval and the reason for it are published on its screenshot_schedule topic.
+
+    The last --history_frames thumbnails published for each camera are kept for anyone who asks; see ThumbnailHistory.
+    """
+    def __init__(self, mqtt_manager: MQTTConnectionManager, settings, args):
+        self.mqtt = mqtt_manager
+        self.settings = settings
+        self.args = args
+        self.screenshotters = {}
+        self.executor = ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='screenshot')
+        self.history = ThumbnailHistory(mqtt_manager, f"{settings.mqtt_root}/thumbnail_history", args.history_frames)
+        self.on_screen = set()
+        self.in_poll = set()
+        self.poll_ends = 0
+
+    def add_camera(self, name: str, camera: MQTTCamera, jitter: bool = True):
+        if name in self.screenshotters:
+            return
+        log.info(f"Taking screenshots for {name}")
+        self.screenshotters[name] = CameraScreenshotter(name, camera, self.args.interval, jitter)
+        self.history.add_camera(name)
+
+    def remove_camera(self, name: str):
+        log.info(f"No longer taking screenshots for {name}")
+        screenshotter = self.screenshotters.pop(name)
+        self.history.forget(name)
+        if not screenshotter.in_flight:
+            # Otherwise _finish_capture does it, so the capture can't start the stream back up after we close it.
+            self._release_url(screenshotter)
+
+    def follow(self, cameras: MQTTCameras):
+        """ Keep our cameras in step with the camera list, including cameras added or removed while we run. """
+        def camlist_changed():
+            for name, camera in cameras.items():
+                if name in cameras.mqtt_name_list.value:
+                    self.add_camera(name, camera)
+            for name in list(self.screenshotters):
+                if name not in cameras.mqtt_name_list.value:
+                    self.remove_camera(name)
+        cameras.add_callback(camlist_changed)
+        camlist_changed()
+
+    def follow_demand(self, positions: MQTTPositions, poll: MQTTVariable):
+        """ Track which cameras are on screen (active in a position) and which are in a running Discord poll. """
+        def demand_changed():
+            for position in positions.values():
+                position.add_callback('active', demand_changed)  # Replaces itself; covers positions added later.
+            poll_state = poll.value or {}
+            self._set_demand({position.active for position in positions.values() if position.active},
+                             set(poll_state.get('cameras', [])), poll_state.get('ends', 0))
+        positions.add_callback(demand_changed)
+        poll.add_callback(demand_changed)
+        demand_changed()
+
+    def _set_demand(self, on_screen: set, in_poll: set, poll_ends: float):
+        newly_wanted = (on_screen | in_poll) - (self.on_screen | self.in_poll)
+        self.on_screen, self.in_poll, self.poll_ends = on_screen, in_poll, poll_ends
+        # Don't leave a camera that just went on screen waiting out its idle interval.
+        now = time.monotonic()
+        for name in newly_wanted:
+            screenshotter = self.screenshotters.get(name)
+            if screenshotter is not None and not screenshotter.in_flight:
+                screenshotter.next_due = min(screenshotter.next_due, now)
+
+    def _choose_interval(self, screenshotter: CameraScreenshotter):
+        """ (seconds until the next screenshot, why) for a camera, before backoff. """
+        camera = screenshotter.camera
+        if screenshotter.name in self.on_screen:
+            return self.args.active_interval, 'on screen'
+        if screenshotter.name in self.in_poll and time.time() < self.poll_ends:
+            return self.args.active_interval, 'in poll'
+        if camera.nothumb:
+            return self.args.idle_interval, 'nothumb'
+        if camera.jpgurl is None:
+            return self.args.idle_interval, 'no jpgurl'
+        if camera.screenshot_interval:
+            return camera.screenshot_interval, 'screenshot_interval'
+        if camera.ishidden or not camera.ispublic:
+            return self.args.idle_interval, 'idle'
+        return screenshotter.default_interval, 'default'
+
+    def _reschedule(self, screenshotter: CameraScreenshotter, start: float):
+        interval, reason = self._choose_interval(screenshotter)
+        failures = screenshotter.camera.failure_count or 0
+        if failures:
+            interval = min(interval * 2 ** min(failures, 16), max(self.args.max_backoff, interval))
+            reason = f"{reason}, {failures} failure(s)"
+            # Spread retries out so cameras that failed together (say, a switch rebooting) don't retry together.
+            screenshotter.next_due = start + interval * random.uniform(0.5, 1.5)
+        else:
+            screenshotter.next_due = start + interval
+        screenshotter.camera.screenshot_schedule = {'interval': interval, 'reason': reason}
+
+    def run(self):
+        while True:
+            now = time.monotonic()
+            for screenshotter in list(self.screenshotters.values()):
+                if not screenshotter.in_flight and now >= screenshotter.next_due:
+                    self._start_capture(screenshotter, now)
+            next_due = min((screenshotter.next_due for screenshotter in self.screenshotters.values() if not screenshotter.in_flight), default=now + 1)
+            self.mqtt.process_callbacks_for_time(min(max(next_due - time.monotonic(), 0.1), 1))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        for screenshotter in self.screenshotters.values():
+            self._release_url(screenshotter)
+
+    def _release_url(self, screenshotter: CameraScreenshotter):
+        if screenshotter.url is not None and is_rtsp(screenshotter.url):
+            close_grabber(screenshotter.url)
+        screenshotter.url = None
+
+    def _start_capture(self, screenshotter: CameraScreenshotter, now: float):
+        camera = screenshotter.camera
+        self._reschedule(screenshotter, now)
+        if camera.jpgurl is None:
+            log.error(f"No screenshot URL for {screenshotter.name}")
+            # We don't give up here because someone could provide a screenshot address while we're running via mqtt
+            return
+        if camera.nothumb:
+            log.debug(f"Not retrieving thumbnail for {screenshotter.name} because nothumb is set.")
+            # Keep checking, this could change.  No point holding a stream open meanwhile, though.
+            self._release_url(screenshotter)
+            return
+        if camera.jpgurl != screenshotter.url:
+            self._release_url(screenshotter)
+            screenshotter.url = camera.jpgurl
+        # Reload these every time in case they change in settings.
+        camera_user = self.args.camera_user or self.settings.camera_user
+        camera_pass = self.args.camera_pass or self.settings.camera_pass
+        log.debug(f"Getting screenshot for {screenshotter.name} from {camera.jpgurl}")
+        screenshotter.in_flight = True
+        screenshotter.started = now
+        future = self.executor.submit(self._capture, camera.jpgurl, camera_user, camera_pass)
+        future.add_done_callback(lambda f: self.mqtt.call_later(0, lambda: self._finish_capture(screenshotter, f)))
+
+    def _capture(self, screenshot_address, camera_user, camera_pass):
+        """ Runs on a worker thread. """
+        screenshot = get_camera_screenshot(screenshot_address, camera_user, camera_pass, thumbnail_options(self.settings),
+                                           self.args.timeout, self.args.rtsp_oneshot)
+        return screenshot, thumbnail_signature(screenshot)
+
+    def _is_unchanged(self, screenshotter: CameraScreenshotter, signature):
+        """ Whether a screenshot is close enough to the last one we published not to publish it again. """
+        now = time.monotonic()
+        if screenshotter.last_signature is not None:
+            score = change_score(signature, screenshotter.last_signature)
+            screenshotter.camera.change_score = round(score, 4)
+            if score < self.args.change_threshold and now - screenshotter.last_full_publish < self.args.max_unchanged_interval:
+                return True
+        # Compare later screenshots to this one, not the one before, so a slow change still adds up to a publish.
+        screenshotter.last_signature = signature
+        screenshotter.last_full_publish = now
+        return False
+
+    def _finish_capture(self, screenshotter: CameraScreenshotter, future):
+        screenshotter.in_flight = False
+        if self.screenshotters.get(screenshotter.name) is not screenshotter:
+            # Camera went away while we were busy, and the capture may have (re)started a stream for it.
+            self._release_url(screenshotter)
+            return
+        try:
+            (screenshot, signature), error = future.result(), None
+            unchanged = self._is_unchanged(screenshotter, signature)
+        except Exception as e:
+            screenshot, error, unchanged = None, f"{datetime.now().isoformat()} -- {e}", False
+            # Whatever on_fail published, the next good screenshot has to go out.
+            screenshotter.last_signature = None
+        publish_camera_status(self.mqtt, screenshotter.camera, screenshot, error,
+                              thumb_width = self.settings.thumbnail_width,
+                              thumb_height = self.settings.thumbnail_height,
+                              on_fail = self.args.on_fail,
+                              thumbnail_format = self.args.thumbnail_format,
+                              unchanged = unchanged)
+        if screenshot and not unchanged:
+            self.history.add(screenshotter.name, screenshot)
+        # Now we know how it went, e.g. whether to back off.
+        self._reschedule(screenshotter, screenshotter.started)
 
 def get_args():
     parser = argparse.ArgumentParser(description='Camera Screenshot Publisher')
     parser.add_argument('--config', type=str, required=True, help='Config filename (default: ./config.yaml)')
 
-    parser.add_argument('--camera_name', type=str, required=True, help='Name of the camera')
+    which = parser.add_mutually_exclusive_group(required=True)
+    which.add_argument('--camera_name', type=str, help='Name of the camera')
+    which.add_argument('--all-cameras', action='store_true', help='Take screenshots for every camera, including ones added later, from this one process')
     parser.add_argument('--camera_user', type=str, help='Camera username')
     parser.add_argument('--camera_pass', type=str, help='Camera password')
 
     parser.add_argument('--on_fail', type=str, choices=['static', 'clear', 'nothing', 'delayed'], default='nothing', help='What to do on camera fail')
-    parser.add_argument('--interval', type=int, default=5, help='Interval in seconds between screenshots')
+    parser.add_argument('--interval', type=float, default=5, help="Interval in seconds between screenshots, unless the camera's screenshot_interval says otherwise")
+    parser.add_argument('--active_interval', type=float, default=2, help='Interval for cameras on screen or in a Discord poll')
+    parser.add_argument('--idle_interval', type=float, default=30, help='Interval for hidden, non-public and nothumb cameras')
+    parser.add_argument('--max_backoff', type=float, default=300, help='Longest interval to back off to while a camera keeps failing')
     parser.add_argument('--timeout', type=int, default=10, help='Timeout waiting for screenshot')
+    parser.add_argument('--workers', type=int, default=4, help='Most screenshots to take at the same time')
+    parser.add_argument('--rtsp_oneshot', action='store_true', help='Run ffmpeg for each rtsp:// screenshot instead of keeping the stream open')
+    parser.add_argument('--change_threshold', type=float, default=0.005, help="Only publish a screenshot if at least this fraction of the picture changed since the last one published (0 publishes every screenshot)")
+    parser.add_argument('--max_unchanged_interval', type=float, default=60, help='Publish a screenshot at least this often in seconds, changed or not')
+    parser.add_argument('--history_frames', type=int, default=5, help='How many recent thumbnails per camera to keep for thumbnail_history requests')
+    parser.add_argument('--thumbnail_format', type=str, choices=THUMBNAIL_FORMATS, help="Publish thumbnails as base64 data URIs or raw JPEG bytes (default: thumbnail_format setting, or data_uri)")
     
     args = parser.parse_args()
 
@@ -146,7 +350,6 @@ def get_args():
 
 def main():
     global args
-    global failure_count
 
     args = get_args()
 
@@ -156,48 +359,31 @@ def main():
         settings.load_from_yaml_file(args.config)
 
     if settings is not None:
-        if not args.camera_user:
-            args.camera_user = settings.camera_user
-        if not args.camera_pass:
-            args.camera_pass = settings.camera_pass
+        if not args.thumbnail_format:
+            args.thumbnail_format = settings.get('thumbnail_format', 'data_uri')
         
-    mqtt_manager = MQTTConnectionManager(**settings.mqtt)
-    camera_root  = f"{settings.mqtt_root}/cameras/{args.camera_name}"
-    jpg_address  = MQTTVariable(mqtt_manager, f"{camera_root}/jpgurl")
-    nothumb      = MQTTVariable(mqtt_manager, f"{camera_root}/nothumb", value_type = bool, initial_value=False)
-    failure_count = MQTTVariable(mqtt_manager, f"{camera_root}/failure_count", value_type = int, initial_value=0)
-
-    mqtt_manager.process_callbacks(timeout=1)
+    mqtt_manager = MQTTConnectionManager(**settings.mqtt, topic_root=settings.mqtt_root)
+    scheduler = ScreenshotScheduler(mqtt_manager, settings, args)
+    if args.all_cameras:
+        cameras = MQTTCameras(mqtt_manager, f"{settings.mqtt_root}/cameras", lazy=True)
+    else:
+        camera = MQTTCamera(mqtt_manager, f"{settings.mqtt_root}/cameras/{args.camera_name}", args.camera_name, lazy=True)
+    positions = MQTTPositions(mqtt_manager, f"{settings.mqtt_root}/positions", lazy=True)
+    poll = MQTTVariable(mqtt_manager, f"{settings.mqtt_root}/discord/poll", dict, initial_value={})
+    mqtt_manager.process_initialization_callbacks()
+    scheduler.follow_demand(positions, poll)
+    if args.all_cameras:
+        scheduler.follow(cameras)
+    else:
+        scheduler.add_camera(args.camera_name, camera, jitter=False)
 
     # MAIN LOOP
     try:
-        while True:
-            # Get screenshot
-            if jpg_address.value is None:
-                log.error(f"No screenshot URL for {args.camera_name}")
-                # We don't die here because someone could provide a screenshot address while we're running via mqtt
-            if nothumb.value:
-                log.debug(f"Not retrieving thumbnail for {args.camera_name} because nothumb is set.")
-                # We don't die here because this could change and dying/restarting is probably more strain than just looping.
-            else:
-                # Reload these at every loop in case they change in settings.
-                camera_user = args.camera_user or settings.camera_user
-                camera_pass = args.camera_pass or settings.camera_pass
-                # TODO: Refactor, and get timeout from settings
-                publish_camera_status(mqtt_manager, camera_root, jpg_address.value, 
-                                      camera_user = camera_user, 
-                                      camera_pass = camera_pass, 
-                                      thumb_width = settings.thumbnail_width, 
-                                      thumb_height = settings.thumbnail_height, 
-                                      timeout = args.timeout, 
-                                      on_fail = args.on_fail)
-
-            mqtt_manager.process_callbacks_for_time(args.interval)
-    
+        scheduler.run()
     except KeyboardInterrupt:
+        scheduler.shutdown()
         mqtt_manager.disconnect()
         log.debug("Disconnected from MQTT broker")
 
 if __name__ == '__main__':
     main()
-
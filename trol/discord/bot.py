@@ -1,15 +1,18 @@
 import discord
-from discord.ext import commands, tasks
+from discord.ext import commands
 import asyncio
 import traceback
 
 from trol.shared.settings import get_settings
 
 from trol.shared.logger import setup_logger
-from trol.shared.MQTT import MQTTConnectionManager
+from trol.shared.MQTT import AsyncMQTTConnectionManager
 from trol.shared.MQTTCameras import MQTTCameras
 from trol.shared.MQTTPositions import MQTTPositions
 from trol.shared.MQTTVariable import MQTTVariable
+from trol.shared.Thumbnails import thumbnail_to_jpeg
+from trol.shared.ThumbnailHistory import ThumbnailHistoryClient
+from trol.discord.imagework import ImageWorkers
 import trol.discord.common as common
 
 log = setup_logger(__name__)
@@ -34,21 +37,19 @@ def camlist_changed(mqtt, mqtt_root, cameras, ptzdata, camthumbs):
     for camname in cameras.keys():
         if camname not in camthumbs:
             log.debug(f"New cam: {camname}")
-            mqtt.subscribe(f"{mqtt_root}/cameras/{camname}/screenshot", lambda x,t,c=camname: thumbnail_receive(c,x,camthumbs))
+            mqtt.subscribe(f"{mqtt_root}/cameras/{camname}/screenshot", lambda x,t,c=camname: thumbnail_receive(c,x,camthumbs), raw=True)
 
 
 def thumbnail_receive(camname, thumbnail, camthumbs):
-    if thumbnail == '':
+    # Keep plain JPEG bytes whatever format the publisher uses, so nobody downstream has to decode them again.
+    thumbnail = thumbnail_to_jpeg(thumbnail)
+    if not thumbnail:
         log.debug(f"Thumb for {camname} is dead.")
         return
     if camname not in camthumbs:
         log.debug(f"Got first thumbnail for {camname}")
-        camthumbs[camname] = []
-
-    # new screenshot goes at front of array, and delete all but the most recent 
-    # TODO: Any good reason not to do this on the populating end and keep several in MQTT?
-    camthumbs[camname].append(thumbnail)
-    del camthumbs[camname][:-5]
+    # Only the latest; the screenshot service keeps the history (see getCameraThumbHistory).
+    camthumbs[camname] = thumbnail
 
 
 def main():
@@ -62,10 +63,12 @@ async def async_main():
     bot.settings = get_settings()
     bot.settings.load_from_command_line()
 
-    bot.mqtt = MQTTConnectionManager(**bot.settings.mqtt)
-    bot.cameras = MQTTCameras(bot.mqtt, f"{bot.settings.mqtt_root}/cameras")
-    bot.positions = MQTTPositions(bot.mqtt, f"{bot.settings.mqtt_root}/positions")
+    bot.mqtt = AsyncMQTTConnectionManager(**bot.settings.mqtt, topic_root=bot.settings.mqtt_root)
+    bot.cameras = MQTTCameras(bot.mqtt, f"{bot.settings.mqtt_root}/cameras", lazy=True)
+    bot.positions = MQTTPositions(bot.mqtt, f"{bot.settings.mqtt_root}/positions", lazy=True)
     bot.camthumbs = {}
+    bot.thumbnail_history = ThumbnailHistoryClient(bot.mqtt, f"{bot.settings.mqtt_root}/thumbnail_history")
+    bot.image_workers = ImageWorkers()
     bot.ptzdata = {}
 
     bot.settings.sync_via_mqtt(bot.mqtt, f"{bot.settings.mqtt_root}/settings")
@@ -83,15 +86,11 @@ async def async_main():
     @bot.event
     async def on_ready():
         log.info("Bot ready.")
-        MQTT_events.start()
+        # MQTT callbacks run on our event loop from here on, as messages arrive.
+        bot.mqtt.start_dispatch()
         channel = bot.get_channel(int(bot.settings.discord.admin_channel))
         await channel.send("I'm back! Did I miss anything good?")
 
-    # MQTT event processing loop
-    @tasks.loop(seconds=1)
-    async def MQTT_events():
-        bot.mqtt.process_callbacks_for_time(1, quit_early=True)
-
     bot.cameras.add_callback( lambda: camlist_changed(bot.mqtt, bot.settings.mqtt_root, bot.cameras, bot.ptzdata, bot.camthumbs) )
 
     log.info("Populating global subscriptions")
@@ -3,9 +3,8 @@ import asyncio
 import json
 from discord.ext import commands, tasks
 from discord.ui import Select, View
-from .common import onlyChannel, trolRol, requestCameraInPosition, get_positions_containing_camera, send_to_channel
+from .common import onlyChannel, trolRol, requestCameraInPosition, get_positions_containing_camera, send_to_channel, getCameraThumbHistory
 from io import BytesIO
-from base64 import b64decode
 from time import time
 from datetime import datetime
 from PIL import Image, ImageDraw, ImageFont
@@ -27,7 +26,7 @@ def create_gif(imgdat):
     try:
         imgs = []
         for d in imgdat: 
-            imgs.append(iio.imread(b64decode(d.removeprefix("data:image/jpg;base64,")), extension=".jpg"))
+            imgs.append(iio.imread(d, extension=".jpg"))
         return BytesIO(iio.imwrite("<bytes>", imgs, extension=".gif", duration=500, loop=0))
     except:
         log.error(format_exc())
@@ -94,7 +93,9 @@ class CameraCog(commands.Cog):
             message += self.get_caminfo_string(camera_name, camera)
             message += "```"
 
-            await ctx.send(message, file=discord.File(create_gif(self.bot.camthumbs.get(camera_name, [])), filename=f"camera {camera_name}.gif"))
+            thumbnails = (await getCameraThumbHistory([camera_name])).get(camera_name, [])
+            gif = await self.bot.image_workers.run(create_gif, thumbnails)
+            await ctx.send(message, file=discord.File(gif, filename=f"camera {camera_name}.gif"))
         except Exception as e:
             log.warning(f"got exception {e} attempting camera check")
             await ctx.send(f"There was an error checking {camera_name}. To err is human so this is probably your fault.")
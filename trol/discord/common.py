@@ -2,7 +2,6 @@ import discord
 from discord.ext import commands
 from trol.shared.logger import setup_logger, set_debug
 from io import BytesIO
-from base64 import b64decode
 from PIL import Image
 from time import time
 
@@ -81,6 +80,14 @@ def getCameraThumbs(access_level='Discord user'):
             if test(camname)
         }
 
+async def getCameraThumbHistory(camera_names, frames=5):
+        """ {camname: [jpeg, ...]} oldest first, from the screenshot service, or just the latest if it doesn't answer. """
+        history = await bot.thumbnail_history.fetch(camera_names, frames)
+        return {
+            camname: history.get(camname) or [bot.camthumbs[camname]]
+            for camname in camera_names if history.get(camname) or camname in bot.camthumbs
+        }
+
 def get_positions_containing_camera(camname: str):
         poslist = []
         for posname, pos in bot.positions.items():
@@ -109,8 +116,6 @@ def requestCameraInPosition(camera_name, position_name, lock_time=0, access_leve
         position.requested = camera_name
         bot.positions.lockPosition(position_name, access_level)
 
-def thumbnail_to_BytesIO(thumbnail: str):
-    image_data_b64 = thumbnail.removeprefix("data:image/jpg;base64,")
-    image_data = b64decode(image_data_b64)
-    return BytesIO(image_data)
+def thumbnail_to_BytesIO(thumbnail: bytes):
+    return BytesIO(thumbnail)
 
@@ -0,0 +1,238 @@
+import argparse
+import math
+import threading
+from io import BytesIO
+from time import time, perf_counter
+from functools import lru_cache
+from typing import Dict, Hashable, List, Sequence
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from trol.shared.logger import setup_logger
+log = setup_logger(__name__)
+
+@lru_cache(maxsize=None)
+def load_font(font_size: int):
+    try:
+        font = ImageFont.truetype("DejaVuSans.ttf", font_size)
+        log.debug("Loaded DejaVuSans.ttf")
+    except IOError:
+        font = ImageFont.load_default()
+        log.debug("Loaded default font.")
+    return font
+
+def decode_image(jpeg: bytes):
+    return Image.open(BytesIO(jpeg))
+
+@lru_cache(maxsize=1024)
+def label_overlay(text: str, font_size: int, cell_size):
+    """
+    A label rasterized once as an alpha mask, cropped to where it has any ink: ((top, bottom, left, right), alpha),
+    alpha being uint32 so blending can't overflow.  Labels almost never change, so this is nearly always cached.
+    """
+    mask = Image.new('L', cell_size, 0)
+    ImageDraw.Draw(mask).text((10, 10), text, fill=255, font=load_font(font_size))
+    left, top, right, bottom = mask.getbbox() or (0, 0, 0, 0)
+    alpha = np.asarray(mask, dtype=np.uint32)[top:bottom, left:right, np.newaxis]
+    return (top, bottom, left, right), alpha
+
+def blend_white(pixels: np.ndarray, alpha: np.ndarray):
+    """ Blend white over pixels (uint8 RGB, in place) by alpha, with exactly the rounding PIL uses drawing text. """
+    blended = pixels.astype(np.uint32) * (255 - alpha) + 255 * alpha + 128
+    pixels[...] = (blended + (blended >> 8)) >> 8
+
+class CameraGrid:
+    """
+    Thumbnails in a square-ish grid, each labelled in white in its top left corner.  Remembers what it drew in each
+    cell so update() only redraws cells whose thumbnail changed.  Cells are slices of one preallocated array;
+    thumbnails are copied straight in and their label blended over them, so nothing spills into a neighbouring
+    cell (a thumbnail that isn't cell_size is cropped or padded with black.)
+    """
+    def __init__(self, labels: Sequence[str], cell_size, font_size: int = 25):
+        self.labels = list(labels)
+        self.cell_size = cell_size
+        self.font_size = font_size
+        self.grid_size = math.ceil(math.sqrt(len(self.labels)))
+        width, height = cell_size
+        self.pixels = np.zeros((self.grid_size * height, self.grid_size * width, 3), dtype=np.uint8)
+        self.cells = [None] * len(self.labels)  # thumbnail drawn in each cell
+
+    @property
+    def image(self):
+        return Image.fromarray(self.pixels)
+
+    def update(self, thumbnails: Sequence[bytes]) -> int:
+        """ Draw thumbnails (JPEG bytes, one per label) that differ from what's there.  Returns how many were drawn. """
+        width, height = self.cell_size
+        drawn = 0
+        for index, thumbnail in enumerate(thumbnails):
+            if thumbnail is self.cells[index] or thumbnail == self.cells[index]:
+                continue
+            x = (index % self.grid_size) * width
+            y = (index // self.grid_size) * height
+            cell = self.pixels[y:y + height, x:x + width]
+            image = decode_image(thumbnail)
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            image = np.asarray(image)[:height, :width]
+            if image.shape != cell.shape:
+                cell[...] = 0
+            cell[:image.shape[0], :image.shape[1]] = image
+            (top, bottom, left, right), alpha = label_overlay(self.labels[index], self.font_size, self.cell_size)
+            blend_white(cell[top:bottom, left:right], alpha)
+            self.cells[index] = thumbnail
+            drawn += 1
+        return drawn
+
+class _CachedGrid:
+    def __init__(self, labels, cell_size, frame_count, font_size):
+        self.labels = labels
+        self.cell_size = cell_size
+        self.frames = [CameraGrid(labels, cell_size, font_size) for _ in range(frame_count)]
+        self.render_lock = threading.Lock()  # held while drawing into frames and encoding them
+        self.data = None  # encoded image
+        self.rendered = 0  # time() data was last brought up to date
+        self.last_used = time()  # time() someone last asked for it, as opposed to us refreshing it
+
+class GridCache:
+    """
+    Encoded camera grids (a JPEG of the latest thumbnails, or an animated GIF of recent ones) kept by key, usually
+    something like (kind, access level, camera names), and brought up to date by redrawing only changed cells.
+    Re-encoding is skipped entirely when nothing changed.  Safe to use from several threads: the cache-wide lock is
+    only ever held to look up or swap entries, so get() and recent_keys() never wait on drawing and can be called
+    from the event loop; each grid has its own lock for rendering.
+    """
+    def __init__(self, font_size: int = 25):
+        self.font_size = font_size
+        self.grids = {}  # type: Dict[Hashable, _CachedGrid]
+        self.lock = threading.Lock()  # guards grids, never held while drawing or encoding
+
+    def get(self, key: Hashable, max_age: float) -> bytes:
+        """
+        The cached grid for key if it was brought up to date in the last max_age seconds, otherwise None.  Either
+        way, counts as someone wanting the grid for recent_keys().
+        """
+        with self.lock:
+            grid = self.grids.get(key)
+            if grid is None:
+                return None
+            grid.last_used = time()
+            if grid.data is None or time() - grid.rendered > max_age:
+                return None
+            return grid.data
+
+    def render(self, key: Hashable, labels: Sequence[str], thumbnails: Sequence[Sequence[bytes]],
+               extension: str = 'JPEG', duration_ms: int = 500) -> bytes:
+        """
+        thumbnails holds a list of frames (JPEG bytes) per label.  One frame each makes a still image in extension
+        format; more makes a GIF with a frame every duration_ms.  Cameras with fewer frames than the others hold
+        their last one.  With extension 'GIF' it's a GIF whatever the number of frames.
+        """
+        labels = list(labels)
+        frame_count = max(len(frames) for frames in thumbnails)
+        cell_size = decode_image(thumbnails[0][-1]).size  # Only reads the header.
+        with self.lock:
+            grid = self.grids.get(key)
+        if grid is None or grid.labels != labels or grid.cell_size != cell_size or len(grid.frames) != frame_count:
+            grid = _CachedGrid(labels, cell_size, frame_count, self.font_size)
+            with self.lock:
+                self.grids[key] = grid
+
+        with grid.render_lock:
+            drawn = 0
+            for index, frame in enumerate(grid.frames):
+                drawn += frame.update([frames[min(index, len(frames) - 1)] for frames in thumbnails])
+            if drawn or grid.data is None:
+                log.debug(f"Redrew {drawn} cell(s) of grid {key}")
+                grid.data = self._encode([frame.image for frame in grid.frames], extension, duration_ms)
+            grid.rendered = time()
+            return grid.data
+
+    def recent_keys(self, max_idle: float) -> List[Hashable]:
+        """ Keys asked for in the last max_idle seconds; forgets the rest. """
+        now = time()
+        with self.lock:
+            for key in [key for key, grid in self.grids.items() if now - grid.last_used > max_idle]:
+                del self.grids[key]
+            return list(self.grids)
+
+    @staticmethod
+    def _encode(images, extension, duration_ms):
+        bytes_io = BytesIO()
+        if len(images) == 1 and extension != 'GIF':
+            images[0].save(bytes_io, format=extension)
+        else:
+            # Pillow's default palette for a GIF (median cut) takes ~25x as long as an octree for no visible gain here.
+            frames = [image.quantize(256, method=Image.FASTOCTREE) for image in images]
+            frames[0].save(bytes_io, format='GIF', save_all=True, append_images=frames[1:], duration=duration_ms, loop=0)
+        return bytes_io.getvalue()
+
+def create_image_grid(images, text_labels, font_size = 25):
+    """ voting.create_image_grid as it was before CameraGrid, unchanged, for main() to check CameraGrid against. """
+    grid_size = math.ceil(math.sqrt(len(images)))
+    img_width, img_height = images[0].size
+
+    grid_img_width = grid_size * img_width
+    grid_img_height = grid_size * img_height
+    grid_img = Image.new('RGB', (grid_img_width, grid_img_height), color='black')
+
+    try:
+        font = ImageFont.truetype("DejaVuSans.ttf", font_size)
+        log.debug("Loaded DejaVuSans.ttf")
+    except IOError:
+        font = ImageFont.load_default()
+        log.debug("Loaded default font.")
+
+    for index, image in enumerate(images):
+        x = (index % grid_size) * img_width
+        y = (index // grid_size) * img_height
+        grid_img.paste(image, (x, y))
+
+        draw = ImageDraw.Draw(grid_img)
+        text_label = text_labels[index]
+        draw.text((x + 10, y + 10), text_label, fill="white", font=font)
+
+    return grid_img
+
+def main():
+    parser = argparse.ArgumentParser(description='Check CameraGrid against the old create_image_grid, and time them both')
+    parser.add_argument('--cameras', type=int, default=40)
+    parser.add_argument('--frames', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    random = np.random.default_rng(0)
+    def thumbnail():
+        # A gradient with some grain compresses about like a real camera thumbnail.
+        gradient = np.linspace(0, 200, 240)[np.newaxis, :, np.newaxis] * random.random(3)
+        pixels = (gradient + random.random((135, 240, 3)) * 40).astype(np.uint8)
+        bytes_io = BytesIO()
+        Image.fromarray(pixels).save(bytes_io, format='JPEG')
+        return bytes_io.getvalue()
+    thumbnails = [[thumbnail() for _ in range(args.cameras)] for _ in range(args.frames)]
+    labels = [f"Camera {index}" for index in range(args.cameras)]
+    load_font(25)
+
+    def best_of(draw):
+        times = []
+        for _ in range(args.repeat):
+            start = perf_counter()
+            draw()
+            times.append(perf_counter() - start)
+        return min(times) * 1000
+
+    def create_image_grid_from(frame):
+        return create_image_grid([decode_image(thumbnail) for thumbnail in frame], labels)
+
+    for frame in thumbnails:
+        grid = CameraGrid(labels, (240, 135))
+        grid.update(frame)
+        if not np.array_equal(grid.pixels, np.asarray(create_image_grid_from(frame))):
+            raise SystemExit("CameraGrid and create_image_grid differ!")
+    print(f"{args.cameras} cameras x {args.frames} frames, identical to create_image_grid.")
+    print(f"create_image_grid: {best_of(lambda: [create_image_grid_from(frame) for frame in thumbnails]):.1f} ms")
+    print(f"CameraGrid:        {best_of(lambda: [CameraGrid(labels, (240, 135)).update(frame) for frame in thumbnails]):.1f} ms")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable
+
+from trol.shared.logger import setup_logger
+log = setup_logger(__name__)
+
+class ImageWorkers:
+    """
+    Runs CPU-heavy image work (decoding, drawing, GIF encoding) on a few threads so it doesn't hold up the event loop,
+    and with it Discord heartbeats and every other command.  PIL releases the GIL while it decodes, resamples,
+    quantizes and encodes, which is nearly all the time these jobs take, so threads are enough, and unlike a process
+    pool they can share cached grids.
+
+    At most workers jobs run at once; the rest wait their turn on the event loop, where they can still be cancelled.
+    A job that runs past its timeout raises asyncio.TimeoutError.  A job that has already started can't be stopped
+    so it runs to the end, but nobody waits for it.
+    """
+    def __init__(self, workers: int = 2, timeout: float = 60):
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='imagework')
+        self.slots = asyncio.Semaphore(workers)
+
+    async def run(self, func: Callable[..., Any], *args, timeout: float = None, **kwargs):
+        """ await func(*args, **kwargs) on a worker thread. """
+        if timeout is None:
+            timeout = self.timeout
+        loop = asyncio.get_running_loop()
+        async with self.slots:
+            job = loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+            try:
+                return await asyncio.wait_for(job, timeout)
+            except asyncio.TimeoutError:
+                log.warning(f"Image work {getattr(func, '__name__', func)} took longer than {timeout}s; giving up on it.")
+                raise
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,74 @@
+import heapq
+from itertools import count
+from typing import Dict, FrozenSet, Hashable, Iterable, List, Tuple
+
+class VoteLedger:
+    """
+    Running tally for a poll where each voter picks any number of choices and can change their mind until it closes.
+
+    vote() only touches the counts of choices the voter added or dropped, and top() reads the leaders off a heap, so
+    showing live results doesn't mean recounting every ballot.  The heap isn't updated in place: every change pushes
+    the choice's new count and top() skips entries that are out of date, rebuilding the heap now and then so they
+    don't pile up.  Ties go to whichever choice got its first vote first.
+
+    Nothing here knows about Discord:
+        ledger = VoteLedger()
+        ledger.vote('alice', ['cam1', 'cam2'])
+        ledger.vote('bob', ['cam2'])
+        ledger.top(1)  # [('cam2', 2)]
+    """
+    def __init__(self):
+        self.ballots = {}  # type: Dict[Hashable, FrozenSet[str]]
+        self.counts = {}  # type: Dict[str, int]
+        self.total = 0  # Sum of counts, i.e. every selection on every ballot
+        self._first_vote = {}  # type: Dict[str, int]
+        self._sequence = count()
+        self._heap = []  # type: List[Tuple[int, int, str]] (-count, first vote, choice), some out of date
+
+    def vote(self, voter: Hashable, choices: Iterable[str]):
+        """ Replace voter's selections with choices (empty to withdraw.) """
+        new = frozenset(choices)
+        old = self.ballots.get(voter, frozenset())
+        for choice in old - new:
+            self._adjust(choice, -1)
+        for choice in new - old:
+            self._adjust(choice, 1)
+        if new:
+            self.ballots[voter] = new
+        else:
+            self.ballots.pop(voter, None)
+
+    def _adjust(self, choice: str, delta: int):
+        if choice not in self._first_vote:
+            self._first_vote[choice] = next(self._sequence)
+        self.counts[choice] = self.counts.get(choice, 0) + delta
+        self.total += delta
+        heapq.heappush(self._heap, (-self.counts[choice], self._first_vote[choice], choice))
+
+    def top(self, k: int) -> List[Tuple[str, int]]:
+        """ Up to k (choice, count) with the most votes, most first.  Choices nobody currently picks are left out. """
+        if len(self._heap) > 2 * len(self.counts) + k:
+            self._compact()
+        leaders = []
+        popped = []
+        seen = set()
+        while self._heap and len(leaders) < k:
+            entry = heapq.heappop(self._heap)
+            negative_count, _, choice = entry
+            if -negative_count != self.counts[choice] or choice in seen:
+                continue  # Out of date, or a duplicate of one we already have; either way done with.
+            popped.append(entry)
+            seen.add(choice)
+            if negative_count < 0:
+                leaders.append((choice, -negative_count))
+        for entry in popped:
+            heapq.heappush(self._heap, entry)
+        return leaders
+
+    def _compact(self):
+        self._heap = [(-votes, self._first_vote[choice], choice) for choice, votes in self.counts.items()]
+        heapq.heapify(self._heap)
+
+    def __len__(self):
+        """ Number of voters with at least one selection. """
+        return len(self.ballots)
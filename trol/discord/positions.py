@@ -0,0 +1,70 @@
+import math
+from typing import Dict, Sequence, Tuple
+
+import numpy as np
+
+class PositionIndex:
+    """
+    A camera's named PTZ positions, for finding the one nearest some (pan, tilt, zoom) without comparing against each
+    in Python.  Distance is per axis, like the tolerance check it replaces: the biggest of the pan, tilt and zoom
+    differences, with zoom's multiplied by zoom_weight.  With a pan_period, pan wraps around, e.g. for a camera whose
+    pan runs -1 to 1 all the way round, -0.95 and 0.95 are 0.1 apart.
+
+    Names can be set and removed one at a time, or sync() brings it in line with a whole {name: coords} dict by
+    touching only the entries that differ.
+    """
+    def __init__(self, zoom_weight: float = 1.0, pan_period: float = 2.0):
+        self.weights = np.array([1.0, 1.0, zoom_weight])
+        self.pan_period = pan_period
+        self.names = []  # name in each row of coords
+        self.rows = {}  # type: Dict[str, int]
+        self.coords = np.empty((8, 3))  # first len(names) rows are in use
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    def set(self, name: str, coords: Sequence[float]):
+        row = self.rows.get(name)
+        if row is None:
+            row = len(self.names)
+            if row == len(self.coords):
+                self.coords = np.concatenate([self.coords, np.empty_like(self.coords)])
+            self.names.append(name)
+            self.rows[name] = row
+        self.coords[row] = coords
+
+    def remove(self, name: str):
+        row = self.rows.pop(name, None)
+        if row is None:
+            return
+        # Move the last row into the hole so the rows in use stay together.
+        last = len(self.names) - 1
+        if row != last:
+            self.coords[row] = self.coords[last]
+            self.names[row] = self.names[last]
+            self.rows[self.names[row]] = row
+        self.names.pop()
+
+    def sync(self, positions: Dict[str, Sequence[float]]):
+        """ Make the index hold exactly positions. """
+        for name in [name for name in self.rows if name not in positions]:
+            self.remove(name)
+        for name, coords in positions.items():
+            row = self.rows.get(name)
+            if row is None or not np.array_equal(self.coords[row], coords):
+                self.set(name, coords)
+
+    def nearest(self, coords: Sequence[float]) -> Tuple[str, float]:
+        """ (name, distance) of the position nearest coords, or (None, inf) if there aren't any. """
+        if not self.names:
+            return None, math.inf
+        differences = np.abs(self.coords[:len(self.names)] - np.asarray(coords, dtype=float))
+        if self.pan_period:
+            pan = differences[:, 0] % self.pan_period
+            differences[:, 0] = np.minimum(pan, self.pan_period - pan)
+        distances = (differences * self.weights).max(axis=1)
+        row = int(distances.argmin())
+        return self.names[row], float(distances[row])
@@ -10,6 +10,7 @@ from traceback import format_exc
 import functools
 
 from trol.shared.MQTTCommands import CameraCommands
+from .positions import PositionIndex
 
 from trol.shared.logger import setup_logger, set_debug
 log = setup_logger('CamcontrolCog')
@@ -28,10 +29,6 @@ VECTORS = {'left': (-0.2,0,0),
            'bigzoomout': (0,0,-1)
            }
 
-# TODO: This is duplicated, should be in common code
-def are_coords_equal(c1, c2, tolerance=0.01):
-    return all(abs(a - b) <= tolerance for a, b in zip(c1, c2))
-
 def str_to_coords(vector_string):
     floats = tuple(map(float, vector_string.split(',')))
     if len(floats) != 3:
@@ -50,6 +47,7 @@ class PTZCog(commands.Cog):
         # If this is set to a string, then the next ptz_arrived we get, we will save under that name.
         self.save_next_position_as = None
         self.cameraCommands = CameraCommands(bot.mqtt, bot.settings.mqtt_root)
+        self.position_indexes = {}  # camera name: PositionIndex of its known_ptz_positions
         for camera_name, camera in bot.cameras.items():
             callback = functools.partial(self.report_camera_arrived, camera_name)
             camera.add_callback('ptz_arrived', callback)
@@ -97,12 +95,22 @@ class PTZCog(commands.Cog):
             return camera.known_ptz_positions[ptz_name]
         return None
 
+    def position_index(self, camera):
+        """ The camera's PositionIndex, kept in step with its known_ptz_positions from then on. """
+        index = self.position_indexes.get(camera._name)
+        if index is None:
+            index = self.position_indexes[camera._name] = PositionIndex(
+                zoom_weight=self.bot.settings.get('ptz_zoom_weight', 1.0),
+                pan_period=2.0 if self.bot.settings.get('ptz_pan_wraps', True) else None)
+            index.sync(camera.known_ptz_positions or {})
+            camera.add_callback('known_ptz_positions', lambda c=camera, i=index: i.sync(c.known_ptz_positions or {}))
+        return index
+
     def get_name_by_coords(self, camera, search_coords):
-        if not camera.known_ptz_positions:
-            return None
-        for ptz_name, coords in camera.known_ptz_positions.items():
-            if are_coords_equal(search_coords, coords, tolerance=self.bot.settings.ptz_position_tolerance):
-                return ptz_name
+        """ Name of the known position nearest search_coords, if it's within ptz_position_tolerance. """
+        ptz_name, distance = self.position_index(camera).nearest(search_coords)
+        if distance <= self.bot.settings.ptz_position_tolerance:
+            return ptz_name
         return None
 
     @commands.command()
@@ -140,8 +148,9 @@ class PTZCog(commands.Cog):
                 raise Exception(f"{camera_name} is not public")
 
             if coords:
-                coords_to_save = str_to_coords(vector)
+                coords_to_save = str_to_coords(coords)
                 camera.known_ptz_positions[position_name] = coords_to_save
+                self.position_index(camera).set(position_name, coords_to_save)
                 await ctx.send(f"Assigned {camera_name} new position {position_name} at ({coords_to_save})")
                 return
             self.save_next_position_as = position_name
@@ -162,6 +171,7 @@ class PTZCog(commands.Cog):
                 raise Exception(f"{camera_name} is not public")
 
             del camera.known_ptz_positions[position_name] 
+            self.position_index(camera).remove(position_name)
             await ctx.send(f"Deleted {position_name} from {camera_name}")
         except Exception as e:
             log.warning(f"Failed to save position: {camera_name} {position_name}")
@@ -235,6 +245,7 @@ class PTZCog(commands.Cog):
             log.debug(f"Got camera arrival: {camera_name}, {position}, {screenshot_data[:30]}")
             if self.save_next_position_as:
                 camera.known_ptz_positions[self.save_next_position_as] = position
+                self.position_index(camera).set(self.save_next_position_as, position)
                 self.save_next_position_as = None
             position_name = self.get_name_by_coords(camera, position)
             if not position_name:
@@ -2,30 +2,34 @@ import discord
 import asyncio
 from discord.ext import commands, tasks
 from discord.ui import Select, View
-from .common import onlyChannel, trolRol, send_to_channel, requestCameraInPosition, getCameraThumbs
+from .common import onlyChannel, trolRol, send_to_channel, requestCameraInPosition, getCameraThumbs, getCameraThumbHistory
 from io import BytesIO
-from base64 import b64decode
 from time import time
 from datetime import datetime
 
-from PIL import Image, ImageDraw, ImageFont
 from traceback import format_exc
+from trol.shared.MQTTVariable import MQTTVariable
+from .grids import GridCache
+from .ledger import VoteLedger
 
-import math
 from trol.shared.logger import setup_logger, set_debug
 log = setup_logger('VotingCog')
 set_debug(log)
 
+# How often refresh_grids brings cached grids up to date, and how long it keeps at it for a grid nobody asks for.
+GRID_REFRESH_SECONDS = 15
+GRID_KEEP_SECONDS = 3600
+
 
 class CamVotingMenu(discord.ui.Select):
-    def __init__(self, options, vote_storage, nice_name_map):
+    def __init__(self, options, ledger, nice_name_map):
         super().__init__(
             placeholder="Choose one or more options...",
             min_values=1,
             max_values=len(options),
             options=options,
         )
-        self.vote_storage = vote_storage
+        self.ledger = ledger
         self.nice_name_map = nice_name_map
 
     async def callback(self, interaction: discord.Interaction):
@@ -33,49 +37,18 @@ class CamVotingMenu(discord.ui.Select):
         user_id = interaction.user.id
 
         # Store the latest selections of the user
-        self.vote_storage[user_id] = selected_options
+        self.ledger.vote(user_id, selected_options)
         log.debug(f"{interaction.user.name} selected {selected_options}")
         nice_selected_options = [self.nice_name_map[camname] for camname in selected_options]
         await interaction.response.send_message(f"You selected: {', '.join(nice_selected_options)}", ephemeral=True)
 
 class CamVotingView(discord.ui.View):
-    def __init__(self, options, vote_storage, nice_name_map):
+    def __init__(self, options, ledger, nice_name_map):
         super().__init__()
-        self.vote_storage = vote_storage
-        self.menu = CamVotingMenu(options, vote_storage, nice_name_map)
+        self.ledger = ledger
+        self.menu = CamVotingMenu(options, ledger, nice_name_map)
         self.add_item(self.menu)
 
-def create_image_grid(images, text_labels, font_size = 25):
-    grid_size = math.ceil(math.sqrt(len(images)))
-    img_width, img_height = images[0].size
-
-    grid_img_width = grid_size * img_width
-    grid_img_height = grid_size * img_height
-    grid_img = Image.new('RGB', (grid_img_width, grid_img_height), color='black')
-
-    try:
-        font = ImageFont.truetype("DejaVuSans.ttf", font_size)
-        log.debug("Loaded DejaVuSans.ttf")
-    except IOError:
-        font = ImageFont.load_default()
-        log.debug("Loaded default font.")
-
-    for index, image in enumerate(images):
-        x = (index % grid_size) * img_width
-        y = (index // grid_size) * img_height
-        grid_img.paste(image, (x, y))
-
-        draw = ImageDraw.Draw(grid_img)
-        text_label = text_labels[index]
-        draw.text((x + 10, y + 10), text_label, fill="white", font=font)
-
-    return grid_img
-
-def decode_image(b64_string):
-    image_data_b64 = b64_string.removeprefix("data:image/jpg;base64,")
-    image_data = b64decode(image_data_b64)
-    return Image.open(BytesIO(image_data))
-
 # TODO: Maybe put this in common.
 async def get_ctx_from_channel(bot, channel: discord.TextChannel):
     # Create a fake message object
@@ -117,6 +90,10 @@ class VotingCog(commands.Cog):
         self.auto_poll_status_message = None
         self.last_auto_poll = time()
         self.poll_active = False
+        # Tells the screenshot service which cameras people are looking at in a poll: {cameras: [...], ends: epoch}
+        self.poll_state = MQTTVariable(bot.mqtt, f"{bot.settings.mqtt_root}/discord/poll", dict, initial_value={})
+        self.grid_cache = GridCache()
+        self.refresh_grids.start()
 
     async def make_user_channel_message(self, text=""):
         c = self.bot.get_channel(int(self.bot.settings.discord.user_channel))
@@ -217,6 +194,7 @@ class VotingCog(commands.Cog):
 
     def cog_unload(self):
         self.auto_poll_cameras.cancel()
+        self.refresh_grids.cancel()
 
 
     @commands.command()
@@ -322,27 +300,28 @@ class VotingCog(commands.Cog):
 
         vote_duration = self.bot.settings.discord.voting.duration
         display_duration = self.bot.settings.discord.voting.display_duration
-        filedata = self.create_grid_gif(eligible_cameras = cameras_touse, access_level=access_level)
+        filedata = await self.create_grid_gif(eligible_cameras = cameras_touse, access_level=access_level, max_age=2 * GRID_REFRESH_SECONDS)
         filename = "camgrid.gif"
         embed.set_image(url=f"attachment://{filename}")
-        vote_storage = {}
+        ledger = VoteLedger()
 
         # Post the vote
         nice_name_map = {camera_name: self.bot.cameras.getByName(camera_name).nice_name for camera_name in cameras_touse}
         vote_view = CamVotingView(self.getCamVotingOptions(eligible_cameras = cameras_touse, 
                                                            selected_cameras = pre_selected_cameras,
                                                            access_level=access_level ),
-                                  vote_storage,
+                                  ledger,
                                   nice_name_map)
 
         self.poll_active = True
+        self.poll_state.value = {'cameras': list(cameras_touse), 'ends': time() + vote_duration}
         message = await ctx.send(embed=embed, 
                                  file=discord.File(filedata, filename=filename), 
                                  delete_after=self.bot.settings.discord.voting.display_duration, 
                                  view=vote_view )
 
         # Schedule the vote tallying task
-        self.tally_cam_votes.start(ctx, message.id, vote_storage, position_list)
+        self.tally_cam_votes.start(ctx, message.id, ledger, position_list)
 
     def getCamVotingOptions(self, access_level='Discord user', eligible_cameras=None, selected_cameras=None):
         public_camthumbs = getCameraThumbs(access_level)
@@ -367,7 +346,7 @@ class VotingCog(commands.Cog):
 
 
     @tasks.loop(count=1)
-    async def tally_cam_votes(self, ctx, message_id, vote_storage, position_list):
+    async def tally_cam_votes(self, ctx, message_id, ledger, position_list):
         try: # Discord.py eats our exceptions unless we specifically catch them.
             duration = self.bot.settings.discord.voting.duration
             display_duration = self.bot.settings.discord.voting.display_duration
@@ -378,20 +357,9 @@ class VotingCog(commands.Cog):
             # Loop to update the message every X seconds
             update_interval = 3  # Adjust this value to change how often the message updates
             for remaining in range(duration, 0, -update_interval):
-                # Tally the votes so far
-                vote_count = {}
-                for votes in vote_storage.values():
-                    for vote in votes:
-                        if vote in vote_count:
-                            vote_count[vote] += 1
-                        else:
-                            vote_count[vote] = 1
-
-                # Calculate total votes
-                total_votes = sum(vote_count.values())
-
-                # Sort votes by count, descending
-                sorted_votes = sorted(vote_count.items(), key=lambda item: item[1], reverse=True)[:5]
+                # The votes so far
+                total_votes = ledger.total
+                sorted_votes = ledger.top(5)
 
                 current_cameras_message = f"Current cameras (tagged with icon in poll options):\n"
                 for position_name in self.bot.settings.discord.voting.positions:
@@ -419,16 +387,8 @@ class VotingCog(commands.Cog):
                 await asyncio.sleep(update_interval)
 
             # Final tally after time is up
-            vote_count = {}
-            for votes in vote_storage.values():
-                for vote in votes:
-                    if vote in vote_count:
-                        vote_count[vote] += 1
-                    else:
-                        vote_count[vote] = 1
-
-            total_votes = sum(vote_count.values())
-            sorted_votes = sorted(vote_count.items(), key=lambda item: item[1], reverse=True)[:5]
+            total_votes = ledger.total
+            sorted_votes = ledger.top(5)
 
             # Final results message
             if total_votes == 0:
@@ -447,6 +407,7 @@ class VotingCog(commands.Cog):
             await self.handle_vote_results(ctx, sorted_votes, position_list)
             await self.reset_auto_poll()
             self.poll_active = False
+            self.poll_state.value = {}
 
         except Exception as e:
             log.error(f"Caught exception {e}: \n{format_exc()}")
@@ -499,70 +460,69 @@ class VotingCog(commands.Cog):
             requestCameraInPosition(camera_name, position_touse, access_level=access_level)
             position_list.remove(position_touse)
 
-    def create_grid_single(self, access_level='Discord user', extension='JPEG', eligible_cameras=None):
+    def grid_labels(self, camera_names, access_level):
+        if access_level == 'admin':
+            return list(camera_names)
+        return [self.camera_name_to_nice_name(camname) for camname in camera_names]
+
+    async def create_grid_single(self, access_level='Discord user', extension='JPEG', eligible_cameras=None, max_age=0):
+        """ max_age lets a grid drawn (by refresh_grids) up to that many seconds ago do; None is refresh_grids itself. """
         public_camthumbs = getCameraThumbs(access_level)
         if eligible_cameras:
             public_camthumbs = { camname: public_camthumbs[camname] for camname in eligible_cameras }
 
-        images = [decode_image(thumbs[-1]) for thumbs in public_camthumbs.values()]
-        if access_level == 'admin':
-            text_labels = list(public_camthumbs.keys())
-        else:
-            text_labels = [self.camera_name_to_nice_name(camname) for camname in public_camthumbs.keys()]
-
+        key = ('single', access_level, extension, tuple(public_camthumbs.keys()))
+        data = None if max_age is None else self.grid_cache.get(key, max_age)
+        if data is None:
+            data = await self.bot.image_workers.run(self.grid_cache.render, key,
+                                                    self.grid_labels(public_camthumbs.keys(), access_level),
+                                                    [[thumb] for thumb in public_camthumbs.values()], extension=extension)
+        return BytesIO(data)
 
-        grid_image = create_image_grid(images, text_labels)
-        bytes_io = BytesIO()
-        grid_image.save(bytes_io, format=extension)
-        bytes_io.seek(0)
-        return bytes_io
-
-    def create_grid_gif(self, access_level='Discord user', duration_ms=500, eligible_cameras=None):
+    async def create_grid_gif(self, access_level='Discord user', duration_ms=500, eligible_cameras=None, max_age=0):
+        """ max_age lets a grid drawn (by refresh_grids) up to that many seconds ago do; None is refresh_grids itself. """
         public_camthumbs = getCameraThumbs(access_level)
         if eligible_cameras:
             public_camthumbs = { camname: public_camthumbs[camname] for camname in eligible_cameras }
 
+        key = ('gif', access_level, duration_ms, tuple(public_camthumbs.keys()))
+        data = None if max_age is None else self.grid_cache.get(key, max_age)
+        if data is None:
+            # Always 3 frames
+            gif_frames = 3
+            public_camthumbs = await getCameraThumbHistory(public_camthumbs.keys(), gif_frames)
+            data = await self.bot.image_workers.run(self.grid_cache.render, key,
+                                                    self.grid_labels(public_camthumbs.keys(), access_level),
+                                                    list(public_camthumbs.values()), extension='GIF', duration_ms=duration_ms)
+        return BytesIO(data)
+
+    @tasks.loop(seconds=GRID_REFRESH_SECONDS)
+    async def refresh_grids(self):
+        """ Keep the grids people have asked for lately, and the one the next autopoll will want, up to date. """
+        await self.bot.wait_until_ready()
+        try:
+            if self.bot.settings.discord.voting.enable_autopoll:
+                position_list, cameras_touse = self.get_poll_positions_and_cameras()
+                if position_list and cameras_touse:
+                    await self.create_grid_gif(eligible_cameras=cameras_touse, max_age=0)
+            for kind, access_level, option, camera_names in self.grid_cache.recent_keys(GRID_KEEP_SECONDS):
+                # Cameras may have gone away or lost their thumbnail since; the next person to ask gets a new grid.
+                camera_names = [camname for camname in camera_names if camname in getCameraThumbs(access_level)]
+                if not camera_names:
+                    continue
+                if kind == 'gif':
+                    await self.create_grid_gif(access_level, option, camera_names, max_age=None)
+                else:
+                    await self.create_grid_single(access_level, option, camera_names, max_age=None)
+        except Exception as e:
+            log.error(f"Exception {e} refreshing grids.\n{format_exc()}")
 
-        # Always 3 frames
-        gif_frames = 3
-        for camname, thumbs in public_camthumbs.items():
-            while len(thumbs) < gif_frames:
-                thumbs.append(thumbs[-1])
-
-        # Transpose the thumbs
-        images = [
-            [decode_image(thumbs[i]) for thumbs in public_camthumbs.values()]
-            for i in range(gif_frames)
-        ]
-
-        if access_level == 'admin':
-            text_labels = list(public_camthumbs.keys())
-        else:
-            text_labels = [self.camera_name_to_nice_name(camname) for camname in public_camthumbs.keys()]
-
-        grid_images = [create_image_grid(images_b64, text_labels)
-                       for images_b64 in images]
-
-        # Convert grid images to BytesIO objects and then to PIL Images
-        frames = []
-        for grid_image in grid_images:
-            bytes_io = BytesIO()
-            grid_image.save(bytes_io, format='PNG')
-            bytes_io.seek(0)
-            frames.append(Image.open(bytes_io))
-
-        # Save frames as a GIF
-        gif_bytes_io = BytesIO()
-        frames[0].save(gif_bytes_io, format='GIF', save_all=True, append_images=frames[1:], duration=duration_ms, loop=0)
-        gif_bytes_io.seek(0)
-        return gif_bytes_io
-         
     @commands.command()
     @onlyChannel()
     @trolRol()
     async def camgrid(self, ctx):
         """ Display a GIF of all cameras together. """
-        gif_bytes_io = self.create_grid_gif(access_level='admin')
+        gif_bytes_io = await self.create_grid_gif(access_level='admin', max_age=2 * GRID_REFRESH_SECONDS)
         await send_to_channel("Here's all the cameras.", filedata=gif_bytes_io, filename=f"camera_grid.gif", duration=60)
 
     @commands.command()
@@ -570,7 +530,7 @@ class VotingCog(commands.Cog):
     @trolRol()
     async def camgridjpg(self, ctx):
         """ Display a JPG of all cameras together. """
-        gif_bytes_io = self.create_grid_single(access_level='admin')
+        gif_bytes_io = await self.create_grid_single(access_level='admin', max_age=2 * GRID_REFRESH_SECONDS)
         await send_to_channel("Here's all the cameras.", filedata=gif_bytes_io, filename=f"camera_grid.jpg", duration=60)
 
     @commands.command()
@@ -38,9 +38,9 @@ if(args.debug):
 
 obs.connect()
 
-mqtt = MQTTConnectionManager(settings.mqtt.host, settings.mqtt.port, settings.mqtt.username, settings.mqtt.password)
-cameras = MQTTCameras(mqtt, f"{settings.mqtt_root}/cameras")
-positions = MQTTPositions(mqtt, f"{settings.mqtt_root}/positions")
+mqtt = MQTTConnectionManager(settings.mqtt.host, settings.mqtt.port, settings.mqtt.username, settings.mqtt.password, topic_root=settings.mqtt_root)
+cameras = MQTTCameras(mqtt, f"{settings.mqtt_root}/cameras", lazy=True)
+positions = MQTTPositions(mqtt, f"{settings.mqtt_root}/positions", lazy=True)
 
 RTMP_SETTINGS = {'close_when_inactive': True, 
                  'ffmpeg_options': 'rtsp_transport=tcp rtsp_flags=prefer_tcp', 
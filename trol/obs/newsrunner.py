@@ -36,7 +36,7 @@ if(is_debug(log)):
     obs.register(lambda x: log.debug(f"OBS Event Received: {x}"))
 obs.connect()
 
-mqtt = MQTTConnectionManager(settings.mqtt.host, settings.mqtt.port, settings.mqtt.username, settings.mqtt.password)
+mqtt = MQTTConnectionManager(settings.mqtt.host, settings.mqtt.port, settings.mqtt.username, settings.mqtt.password, topic_root=settings.mqtt_root)
 
 
 def for_all_items_named(name: str, callback: Callable[[Any, Any],None]): # Honestly, I have no idea what type 'item' is, is it just a dict?
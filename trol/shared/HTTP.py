@@ -0,0 +1,81 @@
+import threading
+from typing import Dict, Tuple, Union
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPDigestAuth
+
+from trol.shared.logger import setup_logger
+log = setup_logger(__name__)
+
+class CameraHTTP:
+    """
+    Shared HTTP client for talking to cameras.  One requests.Session per host keeps connections alive between
+    requests, and one HTTPDigestAuth per host and user remembers the server's nonce, so after the first request we
+    send credentials up front rather than taking a 401 round trip every time.
+
+    Safe to use from several threads; HTTPDigestAuth keeps its nonce state per thread.
+    """
+    def __init__(self, default_timeout: float = 10, pool_size: int = 4):
+        self.default_timeout = default_timeout
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self.sessions = {}  # type: Dict[str, requests.Session]
+        self.auths = {}  # type: Dict[Tuple[str, str, str], HTTPDigestAuth]
+
+    @staticmethod
+    def _host_key(url: str):
+        parsed = urlparse(url)
+        return f"{parsed.scheme}://{parsed.hostname}:{parsed.port}"
+
+    def _session(self, host_key: str):
+        with self.lock:
+            session = self.sessions.get(host_key)
+            if session is None:
+                session = requests.Session()
+                # Cameras talk to one client at a time anyway; a small pool per host is plenty.
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.sessions[host_key] = session
+            return session
+
+    def _auth(self, host_key: str, username: str, password: str):
+        with self.lock:
+            auth = self.auths.get((host_key, username, password))
+            if auth is None:
+                auth = self.auths[(host_key, username, password)] = HTTPDigestAuth(username, password)
+            return auth
+
+    def get(self, url: str, username: str = None, password: str = None, timeout: Union[float, Tuple[float, float]] = None, **kwargs):
+        """
+        Like requests.get.  Uses digest auth with username/password, or with credentials embedded in the URL if
+        there are any.  Without either no auth is sent.  timeout is seconds or (connect, read) seconds; default_timeout
+        if not given.
+        """
+        host_key = self._host_key(url)
+        if not username:
+            parsed = urlparse(url)
+            username, password = parsed.username, parsed.password
+        if username:
+            kwargs['auth'] = self._auth(host_key, username, password)
+        if timeout is None:
+            timeout = self.default_timeout
+        return self._session(host_key).get(url, timeout=timeout, **kwargs)
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+
+_camera_http = None
+_camera_http_lock = threading.Lock()
+
+def get_camera_http() -> CameraHTTP:
+    """ The process-wide CameraHTTP, so all camera traffic shares connections and nonces. """
+    global _camera_http
+    with _camera_http_lock:
+        if _camera_http is None:
+            _camera_http = CameraHTTP()
+        return _camera_http
@@ -1,6 +1,9 @@
 import threading
 import queue
-from typing import Callable, Dict, List
+import asyncio
+from traceback import format_exc
+from collections import deque
+from typing import Callable, Dict, List, Tuple, Union
 import argparse
 import paho.mqtt.client as mqtt
 import time
@@ -8,9 +11,38 @@ import random
 import json
 from inspect import signature
 
+from trol.shared.MQTTRouter import MQTTTopicRouter
 from trol.shared.logger import setup_logger
 log = setup_logger(__name__)
 
+# Most items we pull off the dispatch queue in one go.
+DISPATCH_BATCH_SIZE = 100
+
+class MQTTSubscription:
+    """ A callback registered on a topic filter, with its arity resolved once at subscribe time. """
+    __slots__ = ('topic', 'callback', 'arity', 'coalesce', 'raw', 'message_count')
+
+    def __init__(self, topic: str, callback: Callable[..., None], coalesce: bool = False, raw: bool = False):
+        self.topic = topic
+        self.callback = callback
+        # Callbacks may want message only, or message and topic.
+        self.arity = 2 if len(signature(callback).parameters) >= 2 else 1
+        # Subscriber only cares about the newest message on a topic, so pending older ones may be dropped.
+        self.coalesce = coalesce
+        # Subscriber wants the payload as bytes, e.g. binary thumbnails, rather than decoded to str.
+        self.raw = raw
+        self.message_count = 0
+
+    def deliver(self, payload, topic: str):
+        self.message_count += 1
+        if self.arity == 2:
+            self.callback(payload, topic)
+        else:
+            self.callback(payload)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(topic={self.topic}, callback={self.callback!r}, arity={self.arity}, coalesce={self.coalesce}, raw={self.raw}, message_count={self.message_count})"
+
 class MQTTConnectionManager:
 
     def __init__(self,
@@ -18,16 +50,31 @@ class MQTTConnectionManager:
                  port: int = 1883,
                  username: str = None,
                  password: str = None,
-                 client_id: str = None):
+                 client_id: str = None,
+                 barrier_topic: str = None,
+                 topic_root: str = 'trol'):
 
         if client_id is None:
             # Generate a unique client_id
             client_id = f"{username}_{int(time.time())}_{random.randint(1000, 9999)}"
 
         self.client = mqtt.Client(client_id)
-        self.subscriptions = {}  # type: Dict[str, Callable[..., None]] can accept 1 or 2 str params (message, topic)
+        # Private topic we bounce a non-retained message off to know the broker has sent us everything before it.
+        self.barrier_topic = barrier_topic or f"{topic_root}/barrier/{client_id}"
+        self.barrier_count = 0
+        self.barrier_received = None
+        self.subscription_count = 0  # Bumped for every new topic subscribed, so we can tell if a barrier is stale.
+        self.connected_event = threading.Event()
+        self.subscriptions = {}  # type: Dict[str, List[MQTTSubscription]]
+        self.router = MQTTTopicRouter()  # Index of self.subscriptions keys for matching incoming topics
         self.lock = threading.Lock()
         self.main_thread_dispatch_queue = queue.Queue()
+        self.dispatch_batch = deque()  # Items taken off the dispatch queue but not yet processed
+        self.pending_messages = {}  # type: Dict[str, Tuple[mqtt.MQTTMessage, int]] newest undelivered message per coalescing topic, and its place in the queue
+        self.pending_sequence = 0
+        self.message_count = 0
+        self.coalesced_count = 0
+        self.publish_saved_count = 0  # Publishes skipped by MQTTVariable because nothing changed
         self.publish_event = threading.Event()
         self.publish_count = 0
         self.publish_ack_count = 0
@@ -37,23 +84,41 @@ class MQTTConnectionManager:
             # We need to (re)subscribe to known subscriptions on connect.  This will cause our clients to get
             # retained messages again, which hopefully is something they're OK with, as tracking that is not something
             # I care to do.
-            for topic in self.subscriptions.keys():
+            with self.lock:
+                topics = list(self.subscriptions.keys())
+            for topic in topics:
                 self.client.subscribe(topic)
+            self.connected_event.set()
 
-            self.main_thread_dispatch_queue.put({'type': 'connect', 'callback': lambda: self._handle_connect(rc)})
+            self._dispatch({'type': 'connect', 'callback': lambda: self._handle_connect(rc)})
 
         def on_disconnect(_client, _userdata, rc):
             log.debug(f"Disconnected {client_id}, result code {rc}")
-            self.main_thread_dispatch_queue.put({'type': 'disconnect', 'callback': lambda: self._handle_disconnect(rc)})
+            self.connected_event.clear()
+            self._dispatch({'type': 'disconnect', 'callback': lambda: self._handle_disconnect(rc)})
 
         def on_message(_client, _userdata, msg):
             #log.debug(f"Received message '{str(msg.payload)[:100]}' on topic '{msg.topic}'")
-            payload = msg.payload.decode('utf-8') if isinstance(msg.payload, bytes) else msg.payload
-            self.main_thread_dispatch_queue.put({'type': 'message', 'topic': msg.topic, 'callback': lambda: self._handle_message(msg, payload)})
+            with self.lock:
+                self.message_count += 1
+                coalesce = self._is_coalescing(msg.topic)
+                if coalesce:
+                    # If a message for this topic is already waiting in the queue, the newer one supersedes it.  It
+                    # takes the newer one's place in the queue, not the old one's, so it's never delivered ahead of
+                    # messages on other topics that arrived before it (e.g. a batch that it's newer than.)
+                    if msg.topic in self.pending_messages:
+                        self.coalesced_count += 1
+                    self.pending_sequence += 1
+                    sequence = self.pending_sequence
+                    self.pending_messages[msg.topic] = (msg, sequence)
+            if coalesce:
+                self._dispatch({'type': 'message', 'topic': msg.topic, 'callback': lambda: self._handle_pending_message(msg.topic, sequence)})
+                return
+            self._dispatch({'type': 'message', 'topic': msg.topic, 'callback': lambda: self._handle_message(msg)})
 
         def on_subscribe(_client, _userdata, mid, granted_qos):
             log.debug(f"Subscription acknowledged, mid: {mid}, granted QoS: {granted_qos}")
-            self.main_thread_dispatch_queue.put({'type': 'subscribe', 'callback': lambda: self._handle_subscribe(mid, granted_qos)})
+            self._dispatch({'type': 'subscribe', 'callback': lambda: self._handle_subscribe(mid, granted_qos)})
 
         def on_publish(_client, _userdata, mid):
             log.debug(f"Message published, mid: {mid}")
@@ -61,7 +126,7 @@ class MQTTConnectionManager:
                 self.publish_ack_count += 1
                 if self.publish_ack_count == self.publish_count:
                     self.publish_event.set()
-            self.main_thread_dispatch_queue.put({'type': 'publish', 'callback': lambda: self._handle_publish(mid)})
+            self._dispatch({'type': 'publish', 'callback': lambda: self._handle_publish(mid)})
 
         self.client.on_connect = on_connect
         self.client.on_disconnect = on_disconnect
@@ -78,6 +143,10 @@ class MQTTConnectionManager:
         self.mqtt_thread = threading.Thread(target=self.client.loop_forever, daemon=True)
         self.mqtt_thread.start()
 
+    def _dispatch(self, item):
+        """ Hand an event from the MQTT thread over to whoever processes callbacks. """
+        self.main_thread_dispatch_queue.put(item)
+
     def _handle_connect(self, rc):
         # Handle the connect event in the main thread
         pass
@@ -86,22 +155,42 @@ class MQTTConnectionManager:
         # Handle the disconnect event in the main thread
         pass
 
-    def _handle_message(self, msg, payload):
+    def _handle_message(self, msg):
         # Handle the message event in the main thread
         # Because sometimes a callback will initiate new subscriptions or unsubscribe,
         # changing the number of items in the subscriptions dict during our loop, 
         # we need to do this in two steps for safety.
-        callbacks = []
-        for topic in self.subscriptions:
-            if mqtt.topic_matches_sub(topic, msg.topic):
-                callbacks.extend(self.subscriptions[topic])
-        for cb in callbacks:
-            # TODO: hacky
-            # Allow for callbacks that want message only and ones that get message, topic:
-            if len(signature(cb).parameters) >= 2:
-                cb(payload, msg.topic)
-            else:
-                cb(payload)
+        matched = []
+        for topic in self.router.match(msg.topic):
+            matched.extend(self.subscriptions.get(topic, []))
+        text = None
+        for subscription in matched:
+            if subscription.raw or not isinstance(msg.payload, bytes):
+                subscription.deliver(msg.payload, msg.topic)
+                continue
+            # Decode once, and only if somebody wants text.
+            if text is None:
+                try:
+                    text = msg.payload.decode('utf-8')
+                except UnicodeDecodeError:
+                    log.warning(f"Dropping non-UTF-8 message on {msg.topic} for {subscription.callback!r}; subscribe with raw=True for binary topics.")
+                    continue
+            subscription.deliver(text, msg.topic)
+
+    def _handle_pending_message(self, topic, sequence):
+        # Deliver the newest message for a coalescing topic when we reach its place in the queue; earlier places
+        # belong to messages it superseded, and are skipped.
+        with self.lock:
+            pending = self.pending_messages.get(topic)
+            if pending is None or pending[1] != sequence:
+                return
+            del self.pending_messages[topic]
+        self._handle_message(pending[0])
+
+    def _is_coalescing(self, topic):
+        # Only coalesce when every subscriber on the topic has asked for it.  Call with self.lock held.
+        subscriptions = [subscription for topic_filter in self.router.match(topic) for subscription in self.subscriptions.get(topic_filter, [])]
+        return bool(subscriptions) and all(subscription.coalesce for subscription in subscriptions)
 
     def _handle_subscribe(self, mid, granted_qos):
         # Handle the subscribe event in the main thread
@@ -111,32 +200,43 @@ class MQTTConnectionManager:
         # Handle the publish event in the main thread
         pass
 
-    def subscribe(self, topic: str, callback: Callable[[str], None]):
+    def subscribe(self, topic: str, callback: Callable[..., None], coalesce: bool = False, raw: bool = False):
+        """
+        callback can accept 1 or 2 str params (message, topic)
+        Pass coalesce=True for state topics where only the latest value matters; if several messages for the topic
+        are waiting to be processed only the last is delivered, in its own turn (so long as every other subscriber
+        agrees.)
+        Pass raw=True to get the message as bytes instead of str.
+        """
         with self.lock:
             if topic not in self.subscriptions:
                 self.subscriptions[topic] = []
+                self.router.add(topic)
+                self.subscription_count += 1
                 # TODO: Check how paho mqtt handles duplicate subscriptions.
                 if self.client.is_connected():
                     self.client.subscribe(topic)
 
-            if callback not in self.subscriptions[topic]:
-                self.subscriptions[topic].append(callback)
+            if all(subscription.callback != callback for subscription in self.subscriptions[topic]):
+                self.subscriptions[topic].append(MQTTSubscription(topic, callback, coalesce, raw))
             else:
                 log.warning(f"Duplicate {topic} callback subscription?? This will really mess up a client at unsubscribe()")
 
-    def unsubscribe(self, topic: str, callback: Callable[[str], None]):
+    def unsubscribe(self, topic: str, callback: Callable[..., None]):
         with self.lock:
             if topic in self.subscriptions:
-                self.subscriptions[topic] = [cb for cb in self.subscriptions[topic] if cb != callback]
+                self.subscriptions[topic] = [subscription for subscription in self.subscriptions[topic] if subscription.callback != callback]
                 if not self.subscriptions[topic]:
                     # last sub for this topic has been unsubbed.
                     del self.subscriptions[topic]
+                    self.router.remove(topic)
                     self.client.unsubscribe(topic)
             else:
                 log.warning(f"Duplicate {topic} unsubscribe?? This is messed up.")
 
-    def publish(self, topic: str, payload: str, qos: int = 1, retain: bool = True):
-        log.debug(f"Attempt publish: '{payload}' on '{topic}'")
+    def publish(self, topic: str, payload: Union[str, bytes], qos: int = 1, retain: bool = True):
+        # Payloads can be whole thumbnails; don't build a giant string for a log line nobody reads.
+        log.debug(f"Attempt publish: {payload!r:.100} on '{topic}'")
         with self.lock:
             self.publish_count += 1
             self.publish_event.clear()
@@ -146,13 +246,50 @@ class MQTTConnectionManager:
         self.client.disconnect()
         self.mqtt_thread.join()
 
+    def call_later(self, delay: float, callback: Callable[[], None]):
+        """ Run callback where we process callbacks, after delay seconds (0 means on the next pass.) """
+        item = {'type': 'call', 'callback': callback}
+        if delay <= 0:
+            self._dispatch(item)
+            return
+        timer = threading.Timer(delay, self._dispatch, args=(item,))
+        timer.daemon = True
+        timer.start()
+
+    def count_saved_publish(self):
+        """ For MQTTVariable, from whatever thread: a publish skipped because the broker already has the value. """
+        with self.lock:
+            self.publish_saved_count += 1
+
+    def get_dispatch_stats(self):
+        """ Counters for messages received, messages dropped because a newer one superseded them, and publishes skipped. """
+        with self.lock:
+            return {
+                'received': self.message_count,
+                'coalesced': self.coalesced_count,
+                'queued': self.main_thread_dispatch_queue.qsize() + len(self.dispatch_batch),
+                'publishes_saved': self.publish_saved_count,
+            }
+
+    def _next_dispatch_item(self, timeout):
+        """ Get the next item to process, refilling our local batch from the dispatch queue when it runs dry. """
+        if not self.dispatch_batch:
+            # Block for the first item, then take everything else that's already waiting in one go.
+            self.dispatch_batch.append(self.main_thread_dispatch_queue.get(timeout=timeout))
+            dispatch_queue = self.main_thread_dispatch_queue
+            with dispatch_queue.mutex:
+                while dispatch_queue.queue and len(self.dispatch_batch) < DISPATCH_BATCH_SIZE:
+                    self.dispatch_batch.append(dispatch_queue.queue.popleft())
+                dispatch_queue.not_full.notify_all()
+        return self.dispatch_batch.popleft()
+
     def process_callbacks(self, timeout=1):
         """ Process callbacks, only timing out if we receive no messages within timeout.  """
         # This is the "traditional" timeout style.  May never return if you recv messages
         # faster than 1/timeout.  Passing timeout=0 quits as soon as the queue is empty.
         while True:
             try:
-                item = self.main_thread_dispatch_queue.get(timeout=timeout)
+                item = self._next_dispatch_item(timeout=timeout)
                 # We got one, so reset the timeout
                 timeout_begin = time.time()
                 item['callback']()
@@ -167,7 +304,7 @@ class MQTTConnectionManager:
         start_time = time.time()
         while time.time() - start_time < max_time:
             try:
-                item = self.main_thread_dispatch_queue.get(timeout=0.1)
+                item = self._next_dispatch_item(timeout=0.1)
                 item['callback']()
                 self.main_thread_dispatch_queue.task_done()
             except queue.Empty:
@@ -175,38 +312,116 @@ class MQTTConnectionManager:
                     break # Quit as soon as there's no pending messages.
                 pass # Continue processing until max_time is reached.
 
-    def process_initialization_callbacks(self, timeout = 0.5):
+    def process_initialization_callbacks(self, timeout = 10):
         """ used mainly by MQTTVariable and derivatives for ensuring initialization from retained messages """
-        # I *think* (but have not tested thoroughly) that the timeout of 0.1 we pass below will guarantee
-        # that we get all the retained messages IF AND ONLY IF we do not have a lag of > 100ms to the 
-        # mqtt server.
-
-        # I also think we could quit the minute we get a message for a topic we've seen before, instead of 
-        # using the timeout.  Reason being, it seems like MQTT always delivers all the retained messages first.
-        # (I also have not verified this.)
-
-        # I *think* it makes sense to count multiple calls to this function as distinct as far as counting new
-        # topics, therefore:
-        self.received_topics = set()
-
+        # The broker handles our packets in order, so once a message we publish after subscribing comes back to us,
+        # every retained message for the subscriptions made before it has already been delivered.  (Mosquitto does;
+        # amqtt, for one, sends retained messages separately and can answer the barrier first.)
+        # Callbacks commonly subscribe to more topics as data arrives (e.g. MQTTObjectList creating objects when it
+        # gets its name list) so we keep going until a barrier completes with no new subscriptions made meanwhile.
+        if self.barrier_topic not in self.subscriptions:
+            self.subscribe(self.barrier_topic, self._handle_barrier)
         start_time = time.time()
-        while time.time() - start_time < timeout:
+        while True:
+            subscription_count = self.subscription_count
+            if not self._process_until_barrier(timeout - (time.time() - start_time)):
+                log.warning(f"Timed out after {timeout}s waiting for retained messages; continuing anyway.")
+                return
+            if self.subscription_count == subscription_count:
+                return
+
+    def _process_until_barrier(self, timeout):
+        """ Process callbacks until our barrier message comes back, returns False if it doesn't within timeout. """
+        end_time = time.time() + timeout
+        # Messages published before we're connected go nowhere, and (re)subscribing happens in on_connect.
+        while not self.connected_event.is_set():
+            if time.time() >= end_time:
+                return False
+            self.process_callbacks_for_time(0.1, quit_early=True)
+            self.connected_event.wait(0.1)
+
+        self.barrier_count += 1
+        token = str(self.barrier_count)
+        self.publish(self.barrier_topic, token, qos=0, retain=False)
+
+        while self.barrier_received != token:
+            remaining = end_time - time.time()
+            if remaining <= 0:
+                return False
             try:
-                item = self.main_thread_dispatch_queue.get(timeout=0.1)
+                item = self._next_dispatch_item(timeout=min(remaining, 0.1))
                 item['callback']()
-                if not self._is_seen_topic(item):
-                    start_time = time.time()  # Reset timeout only for the first message on a new topic
                 self.main_thread_dispatch_queue.task_done()
             except queue.Empty:
-                pass # Continue processing until timeout is reached
-
-    def _is_seen_topic(self, item):
-        if 'topic' not in item.keys():
-            return False
-        if item['topic'] in self.received_topics:
-            return True
-        self.received_topics.add(item['topic'])
-        return False
+                pass
+        return True
+
+    def _handle_barrier(self, message):
+        self.barrier_received = message
+
+
+class AsyncMQTTConnectionManager(MQTTConnectionManager):
+    """
+    MQTTConnectionManager for asyncio programs (i.e. the Discord bot.)
+
+    Until start_dispatch() is called this behaves exactly like MQTTConnectionManager, so the usual
+    process_initialization_callbacks() works at startup.  After that, events are handed to the running event loop as
+    they arrive and callbacks run on the loop, with no polling.
+    """
+    def __init__(self, *args, **kwargs):
+        self.loop = None
+        self.async_dispatch_queue = None
+        self.dispatch_task = None
+        super().__init__(*args, **kwargs)
+
+    def _dispatch(self, item):
+        # Locked so nothing can land in the thread queue after _run_dispatch has emptied it.
+        with self.lock:
+            if self.loop is None:
+                super()._dispatch(item)
+                return
+            self.loop.call_soon_threadsafe(self.async_dispatch_queue.put_nowait, item)
+
+    def start_dispatch(self):
+        """ Begin delivering callbacks on the running event loop.  Safe to call more than once. """
+        if self.dispatch_task is not None:
+            return
+        self.async_dispatch_queue = asyncio.Queue()
+        with self.lock:
+            self.loop = asyncio.get_running_loop()
+        self.dispatch_task = self.loop.create_task(self._run_dispatch())
+
+    async def _run_dispatch(self):
+        # Anything that arrived before we switched over is still in the thread queue; it goes first.
+        while True:
+            try:
+                item = self._next_dispatch_item(timeout=0)
+            except queue.Empty:
+                break
+            self._run_item(item)
+            self.main_thread_dispatch_queue.task_done()
+
+        while True:
+            items = [await self.async_dispatch_queue.get()]
+            while not self.async_dispatch_queue.empty() and len(items) < DISPATCH_BATCH_SIZE:
+                items.append(self.async_dispatch_queue.get_nowait())
+            for item in items:
+                self._run_item(item)
+
+    def _run_item(self, item):
+        # An exception here would kill the dispatch task and with it every future callback, so we just log it.
+        try:
+            item['callback']()
+        except Exception as e:
+            log.error(f"Ignoring error in MQTT {item['type']} callback: {e}\n{format_exc()}")
+
+    def disconnect(self):
+        if self.dispatch_task is not None:
+            self.dispatch_task.cancel()
+            self.dispatch_task = None
+        with self.lock:
+            self.loop = None
+        super().disconnect()
 
 
 def get_main_args():
@@ -218,6 +433,7 @@ def get_main_args():
     parser.add_argument('--username', help='MQTT username')
     parser.add_argument('--password', help='MQTT password')
     parser.add_argument('--client_id', help='MQTT client ID')
+    parser.add_argument('--topic_root', default='trol', help='Root topic for trol (default: trol)')
     parser.add_argument('--config', help='Load all the above from a trol2 config file.')
     parser.add_argument('--action', required=True, choices=['subscribe', 'publish', 'clear', 'dump'], help='Action to perform')
     parser.add_argument('--topic', required=True, help='MQTT topic')
@@ -234,6 +450,7 @@ def get_main_args():
         args.port = settings.mqtt.port
         args.username = settings.mqtt.username
         args.password = settings.mqtt.password
+        args.topic_root = settings.mqtt_root
 
     return args
 
@@ -298,7 +515,7 @@ def convert_mqttvar(value):
 
 def main():
     args = get_main_args()
-    mqtt_manager = MQTTConnectionManager(args.host, args.port, args.username, args.password, args.client_id)
+    mqtt_manager = MQTTConnectionManager(args.host, args.port, args.username, args.password, args.client_id, topic_root=args.topic_root)
 
     if args.action == 'publish':
         if args.message is None:
@@ -312,13 +529,15 @@ def main():
     if args.action in ['subscribe','clear','dump'] and args.topic:
         seen_topics = []
         def print_message(msg, topic):
+            # Raw so binary topics (thumbnails) still show up, and get cleared.
+            msg = msg.decode('utf-8', errors='replace')
             seen_topics.append((topic, msg))
             if args.action != 'dump':
                 if not args.notrunc:
                     msg = msg[:100]
                 print(f"Received message ({topic}): '{msg}'")
 
-        mqtt_manager.subscribe(args.topic, print_message)
+        mqtt_manager.subscribe(args.topic, print_message, raw=True)
 
         # Get (at least) all retained messages
         mqtt_manager.process_initialization_callbacks()
@@ -18,15 +18,21 @@ _CAMERA_ATTRIBUTES_: Tuple[Tuple[str, Type]] = (
             ("ishidden", bool),
             ("failure_count", int),
             ("last_screenshot_timestamp", str),
+            ("screenshot_interval", int),
+            ("change_score", float),
+            ("screenshot_schedule", dict),
             ("ptz_locked", str),
             ("ptz_arrived", dict),
             ("prior_ptz_positions", list),
-            ("known_ptz_positions", list)
+            ("known_ptz_positions", list),
+            ("mirrored_ptz_presets", dict)
         )
+# Not retained, and carries a screenshot, so ignored by lazy cameras until something wants it.
+_CAMERA_ON_DEMAND_ATTRIBUTES_: Tuple[str] = ("ptz_arrived",)
 
 class MQTTCamera(MQTTObject):
-    def __init__(self, mqtt_manager: MQTTConnectionManager, topic: str, name: str):
-        super().__init__(mqtt_manager, topic, name, _CAMERA_ATTRIBUTES_)
+    def __init__(self, mqtt_manager: MQTTConnectionManager, topic: str, name: str, lazy: bool = False):
+        super().__init__(mqtt_manager, topic, name, _CAMERA_ATTRIBUTES_, lazy, _CAMERA_ON_DEMAND_ATTRIBUTES_)
 
     def lockPTZ(self, lock_level='Discord user'):
         """ Really the only lock_level with any meaning here is 'root' """
@@ -57,8 +63,8 @@ class MQTTCamera(MQTTObject):
         return False
 
 class MQTTCameras(MQTTObjectList):
-    def __init__(self, mqtt_manager: MQTTConnectionManager, mqtt_topic: str):
-        super().__init__(mqtt_manager, mqtt_topic, 'Cameras', MQTTCamera)
+    def __init__(self, mqtt_manager: MQTTConnectionManager, mqtt_topic: str, lazy: bool = False):
+        super().__init__(mqtt_manager, mqtt_topic, 'Cameras', MQTTCamera, lazy)
 
     def getNameByUrl(self, search_url: str):
         for camera_name, camera in self.objects.items():
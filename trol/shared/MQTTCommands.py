@@ -119,7 +119,8 @@ class CameraCommands(MQTTCommands):
         command_definitions = {
                 "goto_ptz_position":    { 'camera_name': str, 'position_number': int },
                 "goto_absolute_coords": { 'camera_name': str, 'coords': tuple },
-                "goto_relative_vector": { 'camera_name': str, 'vector': tuple }
+                "goto_relative_vector": { 'camera_name': str, 'vector': tuple },
+                "store_ptz_position":   { 'camera_name': str, 'position_name': str }
             }
         super().__init__(mqtt, f"{topic_root}/commands/camera", command_definitions, command_handlers)
 
@@ -1,4 +1,6 @@
 import argparse
+import json
+from contextlib import contextmanager
 from typing import Tuple, Type, Any, Callable
 from trol.shared.MQTT import MQTTConnectionManager
 from trol.shared.MQTTVariable import MQTTVariable
@@ -7,40 +9,185 @@ log = setup_logger(__name__)
 
 
 class MQTTObject:
-    def __init__(self, mqtt_manager: MQTTConnectionManager, topic: str, name: str, mqtt_attribute_definitions: Tuple[Tuple[str, Type]]):
-        """ Holds a collection of MQTTVariables and treats them like attributes of an object. """
+    def __init__(self, mqtt_manager: MQTTConnectionManager, topic: str, name: str, mqtt_attribute_definitions: Tuple[Tuple[str, Type]], lazy: bool = False, on_demand: Tuple[str] = ()):
+        """
+        Holds a collection of MQTTVariables and treats them like attributes of an object.
+
+        With lazy=True we make one wildcard subscription ({topic}/+) instead of one per attribute, and only hold the
+        raw payload for an attribute until something actually uses it, at which point its MQTTVariable is created.
+        Services that touch a handful of attributes on many objects save most of the subscriptions and parsing.
+        Attributes named in on_demand (non-retained events, say) are dropped until something uses them, as there is
+        no stored value to miss.
+        """
         self._mqtt = mqtt_manager
         self._topic = topic
         self._name = name
         self._mqtt_attribute_definitions = mqtt_attribute_definitions
-        self._mqtt_attributes = {}
-        for attr_def in self._mqtt_attribute_definitions:
-            self._mqtt_attributes[attr_def[0]] = MQTTVariable(self._mqtt, f"{self._topic}/{attr_def[0]}", value_type = attr_def[1])
+        self._attribute_types = dict(mqtt_attribute_definitions)
+        self._lazy = lazy
+        self._on_demand = on_demand
+        self._mqtt_attributes = {}  # Attributes whose MQTTVariable exists (all of them, unless lazy)
+        self._raw_payloads = {}  # Lazy only: latest payload for attributes not yet materialized
+        self._callbacks = {}
+        # Outgoing batch: how deep in batch() we are and which attributes were written.
+        self._batch_depth = 0
+        self._batch_written = set()
+        # Incoming batch: payloads applied from a batch message, so the per-attribute copies that follow are quiet.
+        self._batch_applied = {}
+        self._applying_batch = False
+        if self._lazy:
+            # Raw, because the wildcard also matches topics that aren't our attributes, like binary screenshots.
+            self._mqtt.subscribe(f"{self._topic}/+", self._on_attribute_message, coalesce=True, raw=True)
+        else:
+            for attribute_name in self._attribute_types:
+                self._get_variable(attribute_name)
+        # Subscribed separately even when lazy so batches are never coalesced away.
+        self._mqtt.subscribe(f"{self._topic}/batch", self._on_batch_message)
+
+    def _get_variable(self, name):
+        """ The MQTTVariable for an attribute, creating it if needed. """
+        variable = self._mqtt_attributes.get(name)
+        if variable is not None:
+            return variable
+        if name not in self._attribute_types:
+            raise AttributeError(f"{self.__class__.__name__} object has no attribute '{name}'")
+        variable = MQTTVariable(self._mqtt, f"{self._topic}/{name}", value_type = self._attribute_types[name], subscribe = not self._lazy)
+        if name in self._raw_payloads:
+            # Decoding what we already got isn't a change anyone needs telling about.
+            variable._on_message(self._raw_payloads.pop(name))
+        variable.add_callback(lambda: self._attribute_changed(name))
+        self._mqtt_attributes[name] = variable
+        return variable
+
+    def _on_attribute_message(self, message, topic):
+        """ Lazy only: everything under our topic arrives here, as bytes. """
+        name = topic[len(self._topic) + 1:]
+        if name in self._mqtt_attributes:
+            self._mqtt_attributes[name]._on_message(message.decode('utf-8'))
+        elif name in self._attribute_types and name not in self._on_demand:
+            self._raw_payloads[name] = message.decode('utf-8')
+
+    def _receive_batched(self, name, payload):
+        if name in self._mqtt_attributes:
+            self._mqtt_attributes[name]._on_message(payload)
+        else:
+            # Nobody has looked at it, so nobody has a callback on it either.
+            self._raw_payloads[name] = payload
+
+    def unsubscribe(self):
+        """ Stop receiving updates, e.g. once we've been removed from our list. """
+        if self._lazy:
+            self._mqtt.unsubscribe(f"{self._topic}/+", self._on_attribute_message)
+        self._mqtt.unsubscribe(f"{self._topic}/batch", self._on_batch_message)
+        for variable in self._mqtt_attributes.values():
+            variable.unsubscribe()
 
     def add_callback(self, attribute_name: str, callback: Callable[[None],None]):
-        self._mqtt_attributes[attribute_name].add_callback(callback)
+        self._get_variable(attribute_name)
+        self._callbacks[attribute_name] = callback
 
-    def get_underlying_MQTTVariable(self, attribute_name):
-        if attribute_name in self._mqtt_attributes:
-            return self._mqtt_attributes[attribute_name]
+    @contextmanager
+    def batch(self):
+        """
+        Collect attribute writes made inside the with block and publish them together at the end, e.g.:
+            with position.batch():
+                position.locked_until = until
+                position.lock_level = 'admin'
+        Other MQTTObjects get all the values at once from {topic}/batch and fire each callback once, so they never act
+        on a half-applied change.  The attributes' own (retained) topics are still published for everyone else.
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self._publish_batch()
+
+    def _publish_batch(self):
+        names = [name for name in self._batch_written if self._mqtt_attributes[name].is_unpublished()]
+        self._batch_written = set()
+        if not names:
+            return
+        payloads = {name: self._mqtt_attributes[name].serialized_value() for name in names}
+        # The batch goes first; the broker delivers our messages in order, so receivers have already applied these
+        # values by the time the individual topics arrive.
+        self._mqtt.publish(f"{self._topic}/batch", json.dumps({'attributes': payloads}), retain=False)
+        for name in names:
+            self._mqtt_attributes[name].force_publish()
+
+    def _on_batch_message(self, message):
+        try:
+            payloads = json.loads(message)['attributes']
+        except (ValueError, KeyError, TypeError) as e:
+            log.error(f"Bad batch message on {self._topic}: {e}")
+            return
+        names = [name for name in payloads if name in self._attribute_types]
+        self._applying_batch = True
+        try:
+            for name in names:
+                self._receive_batched(name, payloads[name])
+                self._batch_applied[name] = payloads[name]
+        finally:
+            self._applying_batch = False
+        # Several attributes may share one callback; that's still only one change as far as it's concerned.
+        fired = []
+        for name in names:
+            callback = self._callbacks.get(name)
+            if callback is None or callback in fired:
+                continue
+            fired.append(callback)
+            self._run_callback(name, callback)
+
+    def _attribute_changed(self, name):
+        if self._applying_batch:
+            return
+        if name in self._batch_applied:
+            # Just the individual copy of a value we already got in a batch.
+            if self._batch_applied.pop(name) == self._mqtt_attributes[name].last_payload:
+                return
+        self._run_callback(name, self._callbacks.get(name))
+
+    def _run_callback(self, name, callback):
+        if callback is None:
+            return
+        try:
+            callback()
+        except Exception as e:
+            log.error(f"Ignoring error in {self._topic}/{name} callback: {e}")
+
+    def _set_attribute(self, name, value):
+        variable = self._get_variable(name)
+        if self._batch_depth:
+            variable.stage(value)
+            self._batch_written.add(name)
         else:
-            raise AttributeError(f"{self.__class__.__name__} object has no attribute '{attribute_name}'")
+            variable.value = value
+
+    def _forget_attribute(self, name):
+        # This is probably a bad idea.
+        self._attribute_types.pop(name, None)
+        self._mqtt_attributes.pop(name, None)
+        self._raw_payloads.pop(name, None)
+
+    def get_underlying_MQTTVariable(self, attribute_name):
+        return self._get_variable(attribute_name)
     def get_topic(self):
         return self._topic
 
     def __getattr__(self, name):
         if name.startswith('_'):
             super().__getattr__(name)
-        elif name in self._mqtt_attributes:
-            return self._mqtt_attributes[name].value
+        elif name in self._attribute_types:
+            return self._get_variable(name).value
         else:
             raise AttributeError(f"{self.__class__.__name__} object has no attribute '{name}'")
 
     def __setattr__(self, name, value):
         if name.startswith('_'):
             super().__setattr__(name, value)
-        elif name in self._mqtt_attributes:
-            self._mqtt_attributes[name].value = value
+        elif name in self._attribute_types:
+            self._set_attribute(name, value)
         else:
             raise AttributeError(f"{self.__class__.__name__} object has no attribute '{name}'")
 
@@ -48,35 +195,37 @@ class MQTTObject:
         log.debug(f"Deleting {name}")
         if name.startswith('_'):
             super().__delattr__(name)
-        elif name in self._mqtt_attributes:
-            del self._mqtt_attributes[name]  # This is probably a bad idea.
+        elif name in self._attribute_types:
+            self._forget_attribute(name)
         else:
             raise AttributeError(f"{self.__class__.__name__} object has no attribute '{name}'")
 
     def items(self):
-        return self.mqtt_attributes.items()
+        return ((key, self._get_variable(key)) for key in self._attribute_types)
     def keys(self):
-        return self._mqtt_attributes.keys()
+        return self._attribute_types.keys()
     def __getitem__(self, key):
-        return self._mqtt_attributes[key].value
+        return self._get_variable(key).value
     def __setitem__(self, key, value):
-        self._mqtt_attributes[key].value = value
+        self._set_attribute(key, value)
     def __delitem__(self, key):
-        del self._mqtt_attributes[key] # this is probably a bad idea
+        self._forget_attribute(key)
     def __contains__(self, key):
-        return key in self._mqtt_attributes.keys()
+        return key in self._attribute_types
     def get(self, key, default=None):
-        if(key in self._mqtt_attributes.keys()):
-            return self._mqtt_attributes[key].value
+        if(key in self._attribute_types):
+            return self._get_variable(key).value
         return default
 
     def __repr__(self):
-        items = (f"{key}={value.value!r}" for key, value in self._mqtt_attributes.items())
+        items = (f"{key}={value.value!r}" for key, value in self.items())
         return f"{self.__class__.__name__}=(_name={self._name}, _topic={self._topic}, {', '.join(items)})"
 
 class MQTTObjectList:
-    def __init__(self, mqtt_manager: MQTTConnectionManager, mqtt_topic: str, name: str, object_class: Type[MQTTObject] = MQTTObject):
+    def __init__(self, mqtt_manager: MQTTConnectionManager, mqtt_topic: str, name: str, object_class: Type[MQTTObject] = MQTTObject, lazy: bool = False):
+        """ lazy is passed on to each object; see MQTTObject. """
         self.mqtt = mqtt_manager
+        self.lazy = lazy
         self.mqtt_topic = mqtt_topic
         self.name = name
         self.object_class = object_class
@@ -95,7 +244,7 @@ class MQTTObjectList:
         log.debug(f"{self.name} updated list: {self.mqtt_name_list.value}")
         for object_name in self.mqtt_name_list.value:
             if self.getByName(object_name) is None:
-                self.objects[object_name] = self.object_class(self.mqtt, f"{self.mqtt_topic}/{object_name}", object_name)
+                self.objects[object_name] = self.object_class(self.mqtt, f"{self.mqtt_topic}/{object_name}", object_name, lazy=self.lazy)
         if self.callback is not None:
             self.callback()
 
@@ -107,13 +256,14 @@ class MQTTObjectList:
     def addOrGetByName(self, object_name: str):
         if object_name in self.objects:
             return self.objects[object_name]
-        self.objects[object_name] = self.object_class(self.mqtt, f"{self.mqtt_topic}/{object_name}", object_name)
+        self.objects[object_name] = self.object_class(self.mqtt, f"{self.mqtt_topic}/{object_name}", object_name, lazy=self.lazy)
         self.mqtt_name_list.value.append(object_name)
         return self.objects[object_name]
 
     def delByName(self, object_name: str):
         log.debug(f"Deleting {object_name}")
         if object_name in self.objects:
+            self.objects[object_name].unsubscribe()
             del self.objects[object_name]
         if object_name in self.mqtt_name_list.value:
             self.mqtt_name_list.value.remove(object_name)
@@ -19,8 +19,8 @@ _POSITION_ATTRIBUTES_: Tuple[Tuple[str, Type]] = (
 )
 
 class MQTTPosition(MQTTObject):
-    def __init__(self, mqtt_manager: MQTTConnectionManager, mqtt_topic: str, name: str):
-        super().__init__(mqtt_manager, mqtt_topic, name, _POSITION_ATTRIBUTES_)
+    def __init__(self, mqtt_manager: MQTTConnectionManager, mqtt_topic: str, name: str, lazy: bool = False):
+        super().__init__(mqtt_manager, mqtt_topic, name, _POSITION_ATTRIBUTES_, lazy)
 
     def isLocked(self, access_level='Discord user'):
         log.debug(f"Evaluating lock status for {self._name} LU: {self.locked_until:.0f}:{self.lock_level}.")
@@ -78,13 +78,14 @@ class MQTTPosition(MQTTObject):
             return
 
         # Everything checks out, let's lock it.
-        self.locked_until = lock_until
-        self.lock_level = access_level
+        with self.batch():
+            self.locked_until = lock_until
+            self.lock_level = access_level
         log.debug(f"{access_level} locked {self._name} until {self.locked_until:.0f}.")
 
 class MQTTPositions(MQTTObjectList):
-    def __init__(self, mqtt_manager: MQTTConnectionManager, mqtt_topic: str):
-        super().__init__(mqtt_manager, mqtt_topic, 'Positions', MQTTPosition)
+    def __init__(self, mqtt_manager: MQTTConnectionManager, mqtt_topic: str, lazy: bool = False):
+        super().__init__(mqtt_manager, mqtt_topic, 'Positions', MQTTPosition, lazy)
 
     # TODO: deprecated
     def positionIsLocked(self, position_name, access_level='Discord user'):
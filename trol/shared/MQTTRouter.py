@@ -0,0 +1,97 @@
+from typing import Dict, List, Optional
+
+from trol.shared.logger import setup_logger
+log = setup_logger(__name__)
+
+class _TopicNode:
+    """ One level of the wildcard subscription trie. """
+    __slots__ = ('children', 'filter')
+
+    def __init__(self):
+        self.children = {}  # type: Dict[str, _TopicNode]
+        self.filter = None  # type: Optional[str]  the subscription filter that ends at this level, if any
+
+class MQTTTopicRouter:
+    """
+    Index of MQTT subscription filters, so we can find every filter matching an incoming topic without
+    calling topic_matches_sub against all of them.
+
+    Filters without wildcards are kept in a set, making the common exact-topic case a single lookup.  Filters
+    containing '+' or '#' go into a trie keyed by topic level.  Both are updated incrementally by add()/remove().
+    """
+    def __init__(self):
+        self._exact = set()
+        self._root = _TopicNode()
+
+    @staticmethod
+    def _is_wildcard(topic_filter: str):
+        return '+' in topic_filter or '#' in topic_filter
+
+    def add(self, topic_filter: str):
+        if not self._is_wildcard(topic_filter):
+            self._exact.add(topic_filter)
+            return
+        node = self._root
+        for level in topic_filter.split('/'):
+            node = node.children.setdefault(level, _TopicNode())
+        node.filter = topic_filter
+
+    def remove(self, topic_filter: str):
+        if not self._is_wildcard(topic_filter):
+            self._exact.discard(topic_filter)
+            return
+        # Remember the path so we can prune nodes that no longer lead anywhere.
+        path = []
+        node = self._root
+        for level in topic_filter.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                log.warning(f"Removing unknown filter {topic_filter} from router.")
+                return
+            path.append((node, level))
+            node = child
+        node.filter = None
+        for parent, level in reversed(path):
+            child = parent.children[level]
+            if child.filter is not None or child.children:
+                break
+            del parent.children[level]
+
+    def match(self, topic: str) -> List[str]:
+        """ Return all the filters matching topic. """
+        matches = []
+        if topic in self._exact:
+            matches.append(topic)
+        if self._root.children:
+            self._match(self._root, topic.split('/'), 0, topic.startswith('$'), matches)
+        return matches
+
+    def _match(self, node: _TopicNode, levels: List[str], index: int, is_system: bool, matches: List[str]):
+        # Per the MQTT spec, wildcards in the first level don't match topics beginning with '$'
+        wildcards_allowed = not (is_system and index == 0)
+        if wildcards_allowed:
+            # '#' matches the parent level as well as everything below it.
+            multi = node.children.get('#')
+            if multi is not None and multi.filter is not None:
+                matches.append(multi.filter)
+        if index == len(levels):
+            if node.filter is not None:
+                matches.append(node.filter)
+            return
+        child = node.children.get(levels[index])
+        if child is not None:
+            self._match(child, levels, index + 1, is_system, matches)
+        if wildcards_allowed:
+            child = node.children.get('+')
+            if child is not None:
+                self._match(child, levels, index + 1, is_system, matches)
+
+    def __contains__(self, topic_filter: str):
+        if not self._is_wildcard(topic_filter):
+            return topic_filter in self._exact
+        node = self._root
+        for level in topic_filter.split('/'):
+            node = node.children.get(level)
+            if node is None:
+                return False
+        return node.filter == topic_filter
@@ -2,6 +2,7 @@ import json
 from trol.shared.MQTT import MQTTConnectionManager
 import time
 import argparse
+from collections import deque
 from typing import Any, Type, Union, Callable
 
 from trol.shared.logger import setup_logger
@@ -86,15 +87,27 @@ class ObservableList(list):
         self._trigger_callback()
 
 class MQTTVariable:
-    def __init__(self, mqtt_manager: MQTTConnectionManager, topic: str, value_type: Type = str, initial_value=None, callback: Callable[[None],None] = None):
+    def __init__(self, mqtt_manager: MQTTConnectionManager, topic: str, value_type: Type = str, initial_value=None, callback: Callable[[None],None] = None, publish_window: float = 0, subscribe: bool = True):
+        """
+        publish_window is how long (seconds) to collect in-place edits of a list/dict value before publishing them all
+        as one message.  0 publishes on the next pass through the manager's callback processing.
+        subscribe=False is for owners that receive the topic some other way and feed us through _on_message.
+        """
         self._mqtt_manager = mqtt_manager
         self._topic = topic
         self._value_type = value_type
         self._callback = callback
-        self._value = make_observable(initial_value, self.force_publish)
-
-        # Subscribe to the MQTT topic
-        self._mqtt_manager.subscribe(self._topic, self._on_message)
+        self._publish_window = publish_window
+        self._publish_pending = False
+        self._last_payload = None  # Last payload we sent or received, so we don't republish what the broker already has.
+        self._recent_publishes = deque(maxlen=8)  # So the echoes of our own publishes aren't taken for someone else's
+        self.publishes_saved = 0
+        self._value = make_observable(initial_value, self._schedule_publish)
+        self._subscribed = subscribe
+
+        # Subscribe to the MQTT topic.  We only ever hold the latest value, so stale queued updates can be skipped.
+        if self._subscribed:
+            self._mqtt_manager.subscribe(self._topic, self._on_message, coalesce=True)
 
     @property
     def value(self):
@@ -102,23 +115,75 @@ class MQTTVariable:
 
     @value.setter
     def value(self, new_value):
-        self._value = make_observable(new_value, self.force_publish)
+        self._value = make_observable(new_value, self._schedule_publish)
         self._publish(new_value)
 
-    def _publish(self, value):
+    def stage(self, new_value):
+        """ Set the value locally without publishing it; force_publish() sends it later. """
+        self._value = make_observable(new_value, self._schedule_publish)
+
+    def is_unpublished(self):
+        """ Whether our current value differs from the last one we sent or received. """
+        return self.serialized_value() != self._last_payload
+
+    def serialized_value(self):
+        return self._serialize(self._value)
+
+    @property
+    def last_payload(self):
+        return self._last_payload
+
+    @staticmethod
+    def _serialize(value):
         if isinstance(value, (dict, list)):
-            payload = json.dumps(value)
-        else:
-            payload = str(value)
+            return json.dumps(value)
+        return str(value)
+
+    def _publish(self, value, force=False):
+        # Whatever we publish now supersedes any in-place edits waiting to go out.
+        self._publish_pending = False
+        payload = self._serialize(value)
+        if payload == self._last_payload and not force:
+            self._count_saved_publish()
+            return
+        self._last_payload = payload
+        self._recent_publishes.append(payload)
         self._mqtt_manager.publish(self._topic, payload)
 
     def force_publish(self):
-        self._publish(self._value)
+        """ Publish the current value, even if it's what the broker already has. """
+        self._publish(self._value, force=True)
+
+    def _schedule_publish(self):
+        """ Called on in-place edits of list/dict values, which tend to come several at a time. """
+        if self._publish_pending:
+            self._count_saved_publish()
+            return
+        self._publish_pending = True
+        self._mqtt_manager.call_later(self._publish_window, self._publish_if_pending)
+
+    def _publish_if_pending(self):
+        if self._publish_pending:
+            self._publish(self._value)
+
+    def _count_saved_publish(self):
+        self.publishes_saved += 1
+        self._mqtt_manager.count_saved_publish()
 
     def add_callback(self, callback: Callable[[None],None] = None):
         self._callback = callback
 
     def _on_message(self, message):
+        if self._publish_pending:
+            if message in self._recent_publishes:
+                # Just the echo of something we published before our in-place edits, which still stand.
+                self._last_payload = message
+                return
+            # Someone else wrote it while we had edits waiting to go out.  Theirs is newer as far as the broker is
+            # concerned, so it wins.
+            log.warning(f"{self._topic} changed elsewhere before our edits were published; taking {message[:100]}")
+            self._publish_pending = False
+        self._last_payload = message
         try:
             if self._value_type == int:
                 self._value = int(message)
@@ -127,7 +192,7 @@ class MQTTVariable:
             elif self._value_type == bool:
                 self._value = message.lower() in ('true', '1')
             elif self._value_type in [dict, list]:
-                self._value = make_observable(json.loads(message), self.force_publish)
+                self._value = make_observable(json.loads(message), self._schedule_publish)
             else:
                 self._value = message
         except (ValueError, json.JSONDecodeError) as e:
@@ -139,11 +204,17 @@ class MQTTVariable:
             except Exception as e:
                 log.error(f"Ignoring error in {self._topic} callback: {e}")
 
-    def __del__(self):
-        pass
+    def unsubscribe(self):
+        if not self._subscribed:
+            return
+        self._subscribed = False
         log.debug(f"Cleaning up subscription to {self._topic}")
         self._mqtt_manager.unsubscribe(self._topic, self._on_message)
 
+    def __del__(self):
+        if getattr(self, '_subscribed', False):
+            self.unsubscribe()
+
 def main():
     parser = argparse.ArgumentParser(description='MQTT Variable Example')
     parser.add_argument('--host', required=True, help='MQTT broker host')
@@ -155,7 +226,7 @@ def main():
 
     args = parser.parse_args()
 
-    mqtt_manager = MQTTConnectionManager(args.host, args.port, args.username, args.password, args.client_id)
+    mqtt_manager = MQTTConnectionManager(args.host, args.port, args.username, args.password, args.client_id, topic_root=args.root_topic)
 
     # Create an MQTT variable
     update_var = MQTTVariable(mqtt_manager, f"{args.root_topic}/testing", initial_value="foo")
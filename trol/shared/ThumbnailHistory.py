@@ -0,0 +1,117 @@
+import asyncio
+import json
+import time
+import uuid
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Tuple
+
+from trol.shared.MQTT import MQTTConnectionManager
+from trol.shared.Thumbnails import encode_thumbnail, thumbnail_to_jpeg
+
+from trol.shared.logger import setup_logger
+log = setup_logger(__name__)
+
+class ThumbnailHistory:
+    """
+    The last few thumbnails published for each camera, kept by the screenshot service so anyone who wants to animate
+    them can ask, rather than every consumer collecting its own copy (and starting from nothing when it restarts.)
+
+    Requests go to {topic}/request as JSON {id, cameras: [names], frames: n, reply_to: topic}.  A service holding any
+    of those cameras answers on reply_to with {id, cameras: {name: [{timestamp, screenshot}, ...]}}, oldest first,
+    with each screenshot a data URI.  Cameras it holds but has no thumbnails for yet get an empty list, so nobody
+    waits for them.  With one service per camera a request gets one partial answer per camera.
+    """
+    def __init__(self, mqtt_manager: MQTTConnectionManager, topic: str, frames: int = 5):
+        self.mqtt = mqtt_manager
+        self.topic = topic
+        self.frames = frames
+        self.rings = {}  # type: Dict[str, Deque[Tuple[float, bytes]]]
+        self.mqtt.subscribe(f"{topic}/request", self._on_request)
+
+    def add_camera(self, camera_name: str):
+        """ Answer for camera_name from now on, even before it has any thumbnails. """
+        if camera_name not in self.rings:
+            self.rings[camera_name] = deque(maxlen=self.frames)
+
+    def add(self, camera_name: str, jpeg: bytes, timestamp: float = None):
+        self.add_camera(camera_name)
+        self.rings[camera_name].append((timestamp or time.time(), jpeg))
+
+    def forget(self, camera_name: str):
+        self.rings.pop(camera_name, None)
+
+    def get(self, camera_name: str, frames: int = None) -> List[Tuple[float, bytes]]:
+        """ Up to frames (timestamp, JPEG bytes), oldest first. """
+        ring = list(self.rings.get(camera_name, ()))
+        return ring[-frames:] if frames else ring
+
+    def _on_request(self, message: str):
+        try:
+            request = json.loads(message)
+            reply_to = request['reply_to']
+            camera_names = request.get('cameras') or []
+        except (ValueError, KeyError, TypeError) as e:
+            log.warning(f"Ignoring bad thumbnail history request {message!r:.100}: {e}")
+            return
+        frames = request.get('frames') or self.frames
+        cameras = {
+            camera_name: [{'timestamp': timestamp, 'screenshot': encode_thumbnail(jpeg)}
+                          for timestamp, jpeg in self.get(camera_name, frames)]
+            for camera_name in camera_names if camera_name in self.rings
+        }
+        if cameras:
+            self.mqtt.publish(reply_to, json.dumps({'id': request.get('id'), 'cameras': cameras}), retain=False)
+
+class ThumbnailHistoryClient:
+    """ Fetches recent thumbnails from ThumbnailHistory in the screenshot service(s), from async code. """
+    def __init__(self, mqtt_manager: MQTTConnectionManager, topic: str):
+        self.mqtt = mqtt_manager
+        self.topic = topic
+        self.reply_topic = f"{topic}/reply/{uuid.uuid4().hex}"
+        self.pending = {}
+        self.mqtt.subscribe(self.reply_topic, self._on_reply)
+
+    async def fetch(self, camera_names: Iterable[str], frames: int = 5, timeout: float = 3) -> Dict[str, List[bytes]]:
+        """
+        JPEG bytes of up to frames recent thumbnails per camera, oldest first.  Cameras nobody answered for within
+        timeout seconds are left out.
+        """
+        camera_names = list(camera_names)
+        if not camera_names:
+            return {}
+        request_id = uuid.uuid4().hex
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        results = {}
+        self.pending[request_id] = (loop, done, set(camera_names), results)
+        self.mqtt.publish(f"{self.topic}/request",
+                          json.dumps({'id': request_id, 'cameras': camera_names, 'frames': frames, 'reply_to': self.reply_topic}),
+                          retain=False)
+        try:
+            await asyncio.wait_for(done, timeout)
+        except asyncio.TimeoutError:
+            log.debug(f"Thumbnail history timed out waiting for {set(camera_names) - results.keys()}")
+        finally:
+            del self.pending[request_id]
+        return results
+
+    def _on_reply(self, message: str):
+        try:
+            reply = json.loads(message)
+            pending = self.pending.get(reply.get('id'))
+            cameras = reply.get('cameras', {}).items()
+        except (ValueError, AttributeError, TypeError) as e:
+            log.warning(f"Ignoring bad thumbnail history reply {message!r:.100}: {e}")
+            return
+        if pending is None:
+            # Too late; whoever asked has given up.
+            return
+        loop, done, wanted, results = pending
+        try:
+            for camera_name, frames in cameras:
+                results[camera_name] = [thumbnail_to_jpeg(frame['screenshot']) for frame in frames]
+        except (ValueError, KeyError, TypeError) as e:
+            log.warning(f"Ignoring bad thumbnail history reply {message!r:.100}: {e}")
+            return
+        if wanted <= results.keys():
+            loop.call_soon_threadsafe(lambda: done.done() or done.set_result(None))
@@ -0,0 +1,86 @@
+import io
+from base64 import b64encode, b64decode
+from typing import Union
+from PIL import Image
+import numpy as np
+
+from trol.shared.logger import setup_logger
+log = setup_logger(__name__)
+
+# How thumbnails go out on cameras/<name>/screenshot.  The JS client only understands data URIs.
+THUMBNAIL_FORMATS = ('data_uri', 'binary')
+
+DATA_URI_PREFIX = "data:image/jpg;base64,"
+# Every JPEG starts with an SOI marker, which doubles as our content type for binary payloads.
+JPEG_MAGIC = b'\xff\xd8'
+
+DEFAULT_QUALITY = 75
+DEFAULT_SUBSAMPLING = '4:2:0'
+
+def make_thumbnail(image_data: bytes, width: int = 240, height: int = 135, quality: int = DEFAULT_QUALITY, subsampling: str = DEFAULT_SUBSAMPLING) -> bytes:
+    """
+    Scale a camera image (usually a 1080p or 4K JPEG) to exactly width x height and return it as JPEG bytes.
+
+    Rather than decoding every pixel of the full image and resampling all of it:
+      - JPEGs are decoded in draft mode, letting libjpeg scale by 1/2, 1/4 or 1/8 during the DCT, to the smallest
+        size that is still at least what we want;
+      - reduce() box-averages by a whole factor down to roughly twice the target;
+      - only then does a proper resampling filter run, on a small image.
+    """
+    image = Image.open(io.BytesIO(image_data))
+    if image.format == 'JPEG':
+        image.draft('RGB', (width, height))
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    factor = min(image.width // (width * 2), image.height // (height * 2))
+    if factor > 1:
+        image = image.reduce(factor)
+    image = image.resize((width, height), Image.BICUBIC)
+    thumbIO = io.BytesIO()
+    image.save(thumbIO, format='JPEG', quality=quality, subsampling=subsampling)
+    return thumbIO.getvalue()
+
+def thumbnail_options(settings):
+    """ make_thumbnail() keyword arguments from the thumbnail_* settings. """
+    return {
+        'width': settings.thumbnail_width,
+        'height': settings.thumbnail_height,
+        'quality': settings.get('thumbnail_quality', DEFAULT_QUALITY),
+        'subsampling': settings.get('thumbnail_subsampling', DEFAULT_SUBSAMPLING),
+    }
+
+def thumbnail_signature(jpeg: bytes, width: int = 32, height: int = 18) -> np.ndarray:
+    """ A tiny greyscale version of a thumbnail, for change_score(). """
+    image = Image.open(io.BytesIO(jpeg))
+    image.draft('L', (width, height))
+    return np.asarray(image.convert('L').resize((width, height), Image.BOX), dtype=np.float32)
+
+def change_score(signature: np.ndarray, previous: np.ndarray, cell_threshold: float = 12) -> float:
+    """
+    Roughly how much of the picture changed between two thumbnail signatures, from 0 to 1: the fraction of signature
+    cells whose brightness moved by more than cell_threshold grey levels.  Each cell averages a lot of pixels, which
+    takes care of sensor noise and JPEG artifacts, and the median change is taken out first so the camera adjusting
+    its exposure doesn't count as the whole scene changing.
+    """
+    difference = signature - previous
+    difference -= np.median(difference)
+    return float((np.abs(difference) > cell_threshold).mean())
+
+def encode_thumbnail(jpeg: bytes, thumbnail_format: str = 'data_uri') -> Union[str, bytes]:
+    """ Turn JPEG bytes into a screenshot topic payload. """
+    if thumbnail_format == 'binary':
+        return jpeg
+    return DATA_URI_PREFIX + str(b64encode(jpeg), 'utf8')
+
+def thumbnail_to_jpeg(payload: Union[str, bytes]) -> bytes:
+    """
+    JPEG bytes from a screenshot topic payload in either format, or b'' for the blank "camera is dead" payload.
+    Subscribe with raw=True so binary payloads arrive as bytes.
+    """
+    if not payload:
+        return b''
+    if isinstance(payload, bytes):
+        if payload.startswith(JPEG_MAGIC):
+            return payload
+        payload = payload.decode('utf-8')
+    return b64decode(payload.removeprefix(DATA_URI_PREFIX))
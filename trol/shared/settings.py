@@ -282,7 +282,7 @@ def main():
             print(f"ERROR: No configuration in {args.mqtt_config}")
             return
 
-        mqtt = MQTTConnectionManager(**settings.mqtt.to_dict())
+        mqtt = MQTTConnectionManager(**settings.mqtt.to_dict(), topic_root=settings.get('mqtt_root', 'trol'))
 
     manipulated_config = get_settings('manipulated')
 